@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+FITS compression benchmark: file size, write time and read time of the lossless tile compression options of
+'rastro convert fits --all_planes --compression ...' against uncompressed output.
+
+By default it runs on a synthetic 14 bit frame (bias level, read noise, sky gradient and a sprinkling of
+stars), pass RAW files to measure real data instead.  Noise is what limits lossless compression, so real frames
+of the kind being archived are the numbers that count.
+
+  python3 benchmarks/fits_compression.py
+  python3 benchmarks/fits_compression.py --repeat 5 IMG_0001.CR2 IMG_0002.CR2
+  python3 benchmarks/fits_compression.py --output benchmarks/results/fits_compression.jsonl
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+from astropy.io import fits as astropy_fits
+
+from rastro.convert import fits
+
+def synthetic_color_planes(rows=2000, cols=3000, bit_depth=14, seed=0):
+  """Four color planes of a 24 MP sensor frame that looks roughly like a short sky exposure."""
+  rng = np.random.default_rng(seed)
+  max_adu = 2**bit_depth - 1
+
+  color_planes = {}
+  for color_plane_name, gain in (('R', 0.8), ('G1', 1.0), ('B', 0.6), ('G2', 1.0)):
+    sky = 2048 + gain * np.linspace(50, 150, cols)[np.newaxis, :] * np.ones((rows, 1))
+    plane = rng.normal(sky, 12)
+    # Stars: a few hundred saturated-ish points
+    star_rows = rng.integers(0, rows, 300)
+    star_cols = rng.integers(0, cols, 300)
+    plane[star_rows, star_cols] += gain * rng.uniform(500, max_adu, 300)
+    color_planes[color_plane_name] = np.clip(plane, 0, max_adu).astype(np.uint16)
+
+  return color_planes
+
+def raw_color_planes(raw_filename):
+  from rastro.extract import raw
+
+  return dict(
+      (color_plane_name, planes['2D'])
+      for color_plane_name, planes in raw.reader(raw_filename, copy=True).items()
+  )
+
+def write_multi_extension(fits_filename, color_planes, compression):
+  hdul = astropy_fits.HDUList([astropy_fits.PrimaryHDU()])
+  for color_plane_name, color_plane in color_planes.items():
+    hdul.append(fits.image_hdu(color_plane, astropy_fits.Header(), compression, name=color_plane_name))
+  hdul.writeto(fits_filename)
+
+def read_all(fits_filename):
+  with astropy_fits.open(fits_filename) as hdul:
+    for hdu in hdul[1:]:
+      hdu.data.sum()
+
+def benchmark(color_planes, compression, scratch_dir, repeat):
+  fits_filename = os.path.join(scratch_dir, 'benchmark.fits')
+  write_times = []
+  read_times = []
+  for _ in range(repeat):
+    if os.path.exists(fits_filename):
+      os.remove(fits_filename)
+    start_time = time.perf_counter()
+    write_multi_extension(fits_filename, color_planes, compression)
+    write_times.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    read_all(fits_filename)
+    read_times.append(time.perf_counter() - start_time)
+
+  return {
+      'bytes': os.path.getsize(fits_filename),
+      'write': statistics.median(write_times),
+      'read': statistics.median(read_times),
+  }
+
+def git_revision():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True, capture_output=True, text=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def main():
+  parser = argparse.ArgumentParser(description='Measure FITS tile compression size and speed.')
+  parser.add_argument('raw_filenames', nargs='*', help='RAW files to use instead of a synthetic frame')
+  parser.add_argument('--repeat', type=int, help='Writes/reads to time per option (median is reported)', default=3)
+  parser.add_argument('--output', type=str, help='Append the results as a JSON line to this file', default=None)
+  args = parser.parse_args()
+
+  if args.raw_filenames:
+    frames = [(os.path.basename(raw_filename), raw_color_planes(raw_filename)) for raw_filename in args.raw_filenames]
+  else:
+    frames = [('synthetic 14 bit', synthetic_color_planes())]
+
+  results = {}
+  scratch_dir = tempfile.mkdtemp(prefix='rastro-benchmark-')
+  try:
+    for frame_name, color_planes in frames:
+      print(frame_name)
+      print("{:<10} {:>12} {:>8} {:>10} {:>10}".format('option', 'bytes', 'ratio', 'write [s]', 'read [s]'))
+      frame_results = {}
+      for compression in [None] + list(fits.COMPRESSION_TYPES):
+        result = benchmark(color_planes, compression, scratch_dir, args.repeat)
+        result['ratio'] = frame_results['none']['bytes'] / result['bytes'] if frame_results else 1.0
+        frame_results[compression or 'none'] = result
+        print("{:<10} {:>12} {:>8.2f} {:>10.3f} {:>10.3f}".format(
+            compression or 'none', result['bytes'], result['ratio'], result['write'], result['read']))
+      results[frame_name] = frame_results
+  finally:
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+  if args.output:
+    with open(args.output, 'a') as output_file:
+      record = {'revision': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+      output_file.write(json.dumps(record) + '\n')
+
+if __name__ == '__main__':
+  main()
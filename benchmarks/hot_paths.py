@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Hot path benchmark: color plane extraction, the CFA histogram kernel, the stats behind 'analyze stats', the plane
+combination kernels, the TIFF/FITS/archive writers and sensor data previews, on synthetic 14 bit Bayer frames of
+real camera sizes.
+
+No camera files are needed.  SyntheticRawFrame is a RawFrame whose rawpy object and EXIF metadata are small
+fakes, so everything downstream of the decode (raw_info, color plane views, writers) runs the real code.
+
+Every run can be appended to a results file with the git revision, and compared against the previous run in
+that file to spot regressions across commits:
+
+  python3 benchmarks/hot_paths.py
+  python3 benchmarks/hot_paths.py --sizes 24 --filter fits --repeat 5
+  python3 benchmarks/hot_paths.py --output benchmarks/results/hot_paths.jsonl --compare
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from rastro.extract import archive, planes, raw
+
+# Full sensor (visible area) sizes, rows x cols
+FRAME_SIZES = {
+    18: (3456, 5184),   # e.g. Canon EOS 7D/550D
+    24: (4000, 6000),   # e.g. Nikon D3200/Sony A6000
+    50: (5792, 8688),   # e.g. Canon EOS 5DS
+}
+
+class FakeRawPy:
+  """Just the rawpy.RawPy attributes rastro reads, for an already decoded Canon style RGBG frame."""
+
+  def __init__(self, raw_image_visible):
+    self.raw_image_visible = raw_image_visible
+    self.raw_pattern = np.array([[0, 1], [3, 2]], dtype=np.uint8)
+    self.color_desc = b'RGBG'
+    self.num_colors = 3
+    self.black_level_per_channel = [2048, 2048, 2048, 2048]
+    self.white_level = 2**14 - 1
+    self.camera_whitebalance = [2.0, 1.0, 1.5, 1.0]
+    self.daylight_whitebalance = [2.1, 0.9, 1.2, 0.0]
+    self.raw_type = 'RawType.Flat'
+    self.sizes = 'ImageSizes(height={}, width={})'.format(*raw_image_visible.shape)
+
+  def close(self):
+    pass
+
+class FakeExifTag:
+  def __init__(self, value):
+    self.value = value
+
+class FakeMetadata(dict):
+  """EXIF tags by key, like pyexiv2.ImageMetadata.  None are listed in exif_keys, so stats doesn't print them."""
+  exif_keys = []
+
+class SyntheticRawFrame(raw.RawFrame):
+  """RawFrame over a synthetic sensor array, with fake EXIF metadata for the FITS header."""
+
+  def __init__(self, filename, raw_image_visible):
+    super().__init__(filename)
+    self._rawimage = FakeRawPy(raw_image_visible)
+    self._metadata = FakeMetadata({
+        'Exif.Photo.ApertureValue': FakeExifTag(4),
+        'Exif.Image.DateTime': FakeExifTag(datetime.datetime(2020, 3, 10, 21, 0, 0)),
+        'Exif.Photo.ExposureTime': FakeExifTag(30),
+        'Exif.Photo.ISOSpeedRatings': FakeExifTag(800),
+        'Exif.Image.Model': FakeExifTag('Synthetic'),
+    })
+
+  @property
+  def metadata(self):
+    return self._metadata
+
+  def close(self):
+    # The arrays belong to the benchmark, nothing to free
+    self._color_planes = None
+
+def synthetic_cfa(rows, cols, bit_depth=14, seed=0):
+  """A sky-like 14 bit CFA frame: bias, a gradient, read noise and a few thousand stars."""
+  rng = np.random.default_rng(seed)
+  max_adu = 2**bit_depth - 1
+
+  cfa = rng.integers(-24, 25, size=(rows, cols), dtype=np.int32)
+  cfa += 2048 + (np.arange(cols, dtype=np.int32) * 200 // cols)[np.newaxis, :]
+  star_count = rows * cols // 10000
+  cfa[rng.integers(0, rows, star_count), rng.integers(0, cols, star_count)] += rng.integers(500, max_adu, star_count)
+
+  return np.clip(cfa, 0, max_adu).astype(np.uint16)
+
+def numpy_rgb(raw_frame):
+  """The float64 average, astype() and np.stack() RGB assembly the interleave kernel replaced, as a baseline."""
+  color_planes = raw_frame.color_planes
+  green_color_plane = ((color_planes["G1"]["2D"].astype(np.int32) + color_planes["G2"]["2D"]) / 2.0).astype('uint16')
+  return np.stack((color_planes["R"]["2D"].astype('uint16'), green_color_plane, color_planes["B"]["2D"].astype('uint16')), axis=-1)
+
+def interleave_rgb(raw_frame):
+  color_planes = raw_frame.color_planes
+  rgb_color_planes = np.empty(color_planes["R"]["2D"].shape + (3,), dtype='uint16')
+  planes.interleave_rgb(color_planes, rgb_color_planes)
+  return rgb_color_planes
+
+def numpy_histograms(raw_frame):
+  """Plain numpy equivalent of the CFA histogram kernel, as a baseline for it."""
+  return dict(
+      (color_plane_name, np.bincount(color_plane['2D'].ravel(), minlength=2**16))
+      for color_plane_name, color_plane in raw_frame.color_planes.items()
+  )
+
+def get_benchmarks():
+  """Benchmark name: function taking a SyntheticRawFrame."""
+  from rastro.analyze import histogram, stats
+  from rastro.convert import fits, preview, tiff
+
+  def output_basic_stats(raw_frame):
+    with contextlib.redirect_stdout(io.StringIO()):
+      stats.output_basic_stats(raw_frame)
+
+  return {
+      'extract color planes (views)': lambda raw_frame: raw.extract_color_planes(
+          raw_frame.raw_image_visible, raw_frame.raw_pattern, raw_frame.color_plane_map),
+      'extract color planes (copy)': lambda raw_frame: raw.extract_color_planes(
+          raw_frame.raw_image_visible, raw_frame.raw_pattern, raw_frame.color_plane_map, copy=True),
+      'cfa histograms kernel': histogram.color_planes_histogram,
+      'cfa histograms numpy baseline': numpy_histograms,
+      'analyze stats': output_basic_stats,
+      'rgb interleave kernel': interleave_rgb,
+      'rgb numpy baseline': numpy_rgb,
+      'green Gi': lambda raw_frame: planes.get_green_plane(raw_frame, 'Gi'),
+      'green Gfull': lambda raw_frame: planes.get_green_plane(raw_frame, 'Gfull'),
+      # Integer planes averaged into a float output, which has to take the exact (not the bit twiddling) path
+      'tiff green Gi (float32)': lambda raw_frame: tiff.green_writer(raw_frame, 'Gi', 'float32'),
+      'tiff rgb (compress 6)': lambda raw_frame: tiff.rgb_writer(raw_frame, **tiff.tiff_options('deflate', 6)),
+      'tiff rgb (tiled, predictor)': lambda raw_frame: tiff.rgb_writer(
+          raw_frame, **tiff.tiff_options('deflate', 6, tile=256, predictor=True)),
+      'tiff rgb (zstd)': lambda raw_frame: tiff.rgb_writer(raw_frame, **tiff.tiff_options('zstd')),
+      'tiff rgb (memmap)': lambda raw_frame: tiff.rgb_writer(raw_frame, memmap=True),
+      'tiff all channels (memmap)': lambda raw_frame: tiff.all_channels_writer(raw_frame, 'uint16', memmap=True),
+      'fits G1': lambda raw_frame: fits.single_channel_writer_header(raw_frame, 'G1', 'benchmark', 'benchmark'),
+      'fits G1 (memmap)': lambda raw_frame: fits.single_channel_writer_header(
+          raw_frame, 'G1', 'benchmark', 'benchmark', memmap=True),
+      'fits all planes': lambda raw_frame: fits.multi_plane_writer(raw_frame, 'benchmark', 'benchmark'),
+      'fits all planes (rice)': lambda raw_frame: fits.multi_plane_writer(
+          raw_frame, 'benchmark', 'benchmark', compression='rice'),
+      'archive (zstd)': lambda raw_frame: archive.archive_writer(raw_frame, codec='zstd'),
+      'archive (zlib)': lambda raw_frame: archive.archive_writer(raw_frame, codec='zlib'),
+      'preview (block average, stretch)': lambda raw_frame: preview.preview_writer(raw_frame, thumbnail=False),
+  }
+
+def time_benchmark(function, cfa, scratch_dir, repeat):
+  timings = []
+  for i in range(repeat + 1):
+    # Writers refuse to overwrite, so every run gets an empty directory
+    run_dir = tempfile.mkdtemp(dir=scratch_dir)
+    raw_frame = SyntheticRawFrame(os.path.join(run_dir, 'frame.cr2'), cfa)
+    start_time = time.perf_counter()
+    function(raw_frame)
+    elapsed_time = time.perf_counter() - start_time
+    shutil.rmtree(run_dir, ignore_errors=True)
+    # The first run is a warm up (numba compilation or cache load, page faults)
+    if i > 0:
+      timings.append(elapsed_time)
+  return timings
+
+def git_revision():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True, capture_output=True, text=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def read_previous(output_filename):
+  """Last record of a results file, or None."""
+  try:
+    with open(output_filename) as output_file:
+      lines = output_file.read().splitlines()
+  except OSError:
+    return None
+  return json.loads(lines[-1]) if lines else None
+
+def main():
+  parser = argparse.ArgumentParser(description='Time rastro hot paths on synthetic Bayer frames.')
+  parser.add_argument('--sizes', type=str, help='Comma separated megapixel sizes from {}'.format(sorted(FRAME_SIZES)), default='18,24,50')
+  parser.add_argument('--repeat', type=int, help='Timed runs per benchmark (after one warm up run)', default=3)
+  parser.add_argument('--filter', type=str, help='Only run benchmarks whose name contains this', default=None)
+  parser.add_argument('--output', type=str, help='Append the results as a JSON line to this file', default=None)
+  parser.add_argument('--compare', action='store_true', help='Show the change against the last record in --output')
+  parser.add_argument('--scratch_dir', type=str, help='Where writers put their files (default system temp)', default=None)
+  args = parser.parse_args()
+
+  previous = read_previous(args.output) if args.compare and args.output else None
+  scratch_dir = tempfile.mkdtemp(prefix='rastro-benchmark-', dir=args.scratch_dir)
+
+  results = {}
+  try:
+    for size in [int(size) for size in args.sizes.split(',')]:
+      rows, cols = FRAME_SIZES[size]
+      cfa = synthetic_cfa(rows, cols)
+      print("{} MP ({}x{} 14 bit)".format(size, cols, rows))
+      print("{:<32} {:>10} {:>10} {:>10}".format('benchmark', 'min [s]', 'median [s]', 'change'))
+
+      for name, function in get_benchmarks().items():
+        if args.filter and args.filter not in name:
+          continue
+        key = '{} MP {}'.format(size, name)
+        try:
+          timings = time_benchmark(function, cfa, scratch_dir, args.repeat)
+        except Exception as error:
+          # e.g. a writer needing an optional codec, report it and carry on
+          results[key] = {'error': str(error)}
+          print("{:<32} failed: {}".format(name, error))
+          continue
+
+        results[key] = {'min': min(timings), 'median': statistics.median(timings)}
+        change = ''
+        previous_result = previous['results'].get(key, {}) if previous else {}
+        if 'min' in previous_result:
+          change = '{:+.1%}'.format(results[key]['min'] / previous_result['min'] - 1)
+        print("{:<32} {:>10.4f} {:>10.4f} {:>10}".format(name, results[key]['min'], results[key]['median'], change))
+  finally:
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+  if args.output:
+    with open(args.output, 'a') as output_file:
+      record = {'revision': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+      output_file.write(json.dumps(record) + '\n')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Startup benchmark: how long each rastro subcommand spends importing its dependencies before doing any work.
+
+Every measurement runs in a fresh interpreter, since that's what a script calling rastro once per file pays for.
+The "first kernel call" entry also includes numba compiling (or loading from its on-disk cache) the stats kernel.
+
+  python3 benchmarks/startup.py
+  python3 benchmarks/startup.py --repeat 10 --output benchmarks/results/startup.jsonl
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules each subcommand imports when rastro.cli dispatches it
+COMMAND_IMPORTS = {
+    '--version': [],
+    'convert tiff': ['rastro.batch', 'rastro.convert.tiff'],
+    'convert fits': ['rastro.batch', 'rastro.convert.fits'],
+    'convert archive': ['rastro.batch', 'rastro.extract.archive'],
+    'analyze stats': ['rastro.extract.raw', 'rastro.analyze.stats'],
+    'analyze histogram': ['rastro.extract.raw', 'rastro.analyze.histogram'],
+    'analyze rawpixels': ['rastro.batch', 'rastro.analyze.rawpixels'],
+    'analyze photometry': ['rastro.batch', 'rastro.analyze.photometry'],
+    'preview': ['rastro.batch', 'rastro.convert.preview'],
+    'index query': ['rastro.catalog'],
+}
+
+TIMER_TEMPLATE = '''
+import time
+start_time = time.perf_counter()
+import rastro.cli
+{imports}
+{code}
+print(time.perf_counter() - start_time)
+'''
+
+FIRST_KERNEL_CALL = '''
+import numpy as np
+stats.color_plane_histograms(np.zeros((4, 4), dtype=np.uint16), [[0, 1], [3, 2]], ['R', 'G1', 'B', 'G2'])
+'''
+
+def time_snippet(imports, code='', repeat=5):
+  timings = []
+  for _ in range(repeat):
+    source = TIMER_TEMPLATE.format(
+        imports='\n'.join('import ' + module for module in imports),
+        code=code
+    )
+    process = subprocess.run([sys.executable, '-c', source], capture_output=True, text=True)
+    if process.returncode != 0:
+      # Usually a missing optional dependency, report it and carry on with the other subcommands
+      return None, process.stderr.strip().splitlines()[-1]
+    timings.append(float(process.stdout.strip().splitlines()[-1]))
+  return timings, None
+
+def git_revision():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True, capture_output=True, text=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def main():
+  parser = argparse.ArgumentParser(description='Measure rastro import time per subcommand.')
+  parser.add_argument('--repeat', type=int, help='Fresh interpreters to time per subcommand', default=5)
+  parser.add_argument('--output', type=str, help='Append the results as a JSON line to this file', default=None)
+  args = parser.parse_args()
+
+  benchmarks = dict((command, (imports, '')) for command, imports in COMMAND_IMPORTS.items())
+  benchmarks['analyze stats (first kernel call)'] = (
+      ['rastro.analyze.stats'],
+      'from rastro.analyze import stats\n' + FIRST_KERNEL_CALL
+  )
+
+  results = {}
+  print("{:<36} {:>10} {:>10}".format('command', 'min [s]', 'median [s]'))
+  for command, (imports, code) in benchmarks.items():
+    timings, error = time_snippet(imports, code, args.repeat)
+    if error is not None:
+      results[command] = {'error': error}
+      print("{:<36} failed: {}".format(command, error))
+      continue
+    results[command] = {'min': min(timings), 'median': statistics.median(timings)}
+    print("{:<36} {:>10.3f} {:>10.3f}".format(command, results[command]['min'], results[command]['median']))
+
+  if args.output:
+    with open(args.output, 'a') as output_file:
+      record = {'revision': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+      output_file.write(json.dumps(record) + '\n')
+
+if __name__ == '__main__':
+  main()
@@ -1,57 +1,78 @@
 # -*- coding: utf-8 -*-
 
-import matplotlib as mpl
-# TODO: See what backends are available and fallback to tkinter with a warning if none are available
-mpl.use('Qt5Agg')  # Change plotting backend for increased performance: https://matplotlib.org/faq/usage_faq.html#what-is-a-backend
-from matplotlib import pyplot as plt
+from os.path import basename
 
-import numba
 import numpy as np
 
-# Stolen from numba histogram example: https://numba.pydata.org/numba-examples/examples/density_estimation/histogram/results.html
-@numba.jit(nopython=True)
-def get_bin_edges(a, bins):
-  bin_edges = np.zeros((bins+1,), dtype=np.float64)
-  a_min = a.min()
-  a_max = a.max()
-  delta = (a_max - a_min) / bins
-  for i in range(bin_edges.shape[0]):
-    bin_edges[i] = a_min + i * delta
-  
-  bin_edges[-1] = a_max  # Avoid roundoff error on last point
-  return bin_edges
+from rastro import profiling
+from rastro.analyze import stats
 
+def get_pyplot():
+  """
+    Import pyplot on first use.  Computing histograms doesn't need matplotlib (or a GUI backend), only plotting
+    them does.
+  """
+  import matplotlib as mpl
+  # TODO: See what backends are available and fallback to tkinter with a warning if none are available
+  mpl.use('Qt5Agg')  # Change plotting backend for increased performance: https://matplotlib.org/faq/usage_faq.html#what-is-a-backend
+  from matplotlib import pyplot as plt
 
-@numba.jit(nopython=True)
-def compute_bin(x, bin_edges):
-  # assuming uniform bins for now
-  n = bin_edges.shape[0] - 1
-  a_min = bin_edges[0]
-  a_max = bin_edges[-1]
+  return plt
 
-  # special case to mirror NumPy behavior for last bin
-  if x == a_max:
-    return n - 1 # a_max always in last bin
+# Exact histograms are kept at full ADU resolution (one count per possible 16 bit value), which is small enough to
+# merge across any number of frames.  Rebinning for display happens afterwards on the counts, not the pixels.
 
-  bin = int(n * (x - a_min) / (a_max - a_min))
+def color_planes_histogram(raw_frame):
+  """
+    Return a dictionary of exact ADU counts for each color plane of raw_frame.  All the planes are counted in
+    a single pass over the visible sensor data.
+  """
+  raw_image_visible = raw_frame.raw_image_visible
+  with profiling.stage('analysis'):
+    histograms = stats.color_plane_histograms(
+        raw_image_visible,
+        raw_frame.raw_pattern,
+        raw_frame.color_plane_map
+    )
 
-  if bin < 0 or bin >= n:
-    return None
-  else:
-    return bin
+  return {color_plane_name: histograms[color_plane_name] for color_plane_name in raw_frame.color_plane_map}
 
+def merge_histograms(merged_histograms, histograms):
+  """
+    Add the counts in histograms to merged_histograms (in place) and return it.  Start with an empty
+    dictionary to accumulate a histogram over many frames.
+  """
+  for color_plane_name, hist in histograms.items():
+    if color_plane_name in merged_histograms:
+      merged_histograms[color_plane_name] += hist
+    else:
+      merged_histograms[color_plane_name] = hist.astype(np.int64, copy=True)
+
+  return merged_histograms
 
-@numba.jit(nopython=True)
-def numba_histogram(a, bins):
-  hist = np.zeros((bins,), dtype=np.intp)
-  bin_edges = get_bin_edges(a, bins)
+def rebin_histogram(hist, bins, range_min, range_max):
+  """
+    Rebin exact ADU counts into bins uniform bins covering [range_min, range_max], following np.histogram
+    conventions (the last bin includes range_max).  Returns the counts and the bin edges.
+
+    If the range holds fewer ADU values than bins, one bin per ADU value is used instead.
+  """
+  if not 0 <= range_min <= range_max < len(hist):
+    raise ValueError("Expected 0 <= range min <= range max < {}, got {} and {}".format(len(hist), range_min, range_max))
+  if bins < 1:
+    raise ValueError("A histogram needs at least one bin, got {}".format(bins))
 
-  for x in a.flat:
-    bin = compute_bin(x, bin_edges)
-    if bin is not None:
-      hist[int(bin)] += 1
+  adu_count = range_max - range_min + 1
+  bins = min(bins, adu_count)
 
-  return hist, bin_edges
+  # Integer arithmetic puts every ADU value in exactly the bin a float edge comparison would, without roundoff
+  adu_offsets = np.arange(adu_count, dtype=np.int64)
+  bin_index = np.minimum((adu_offsets * bins) // (range_max - range_min or 1), bins - 1)
+
+  rebinned_hist = np.bincount(bin_index, weights=hist[range_min:range_max + 1], minlength=bins).astype(np.int64)
+  bin_edges = np.linspace(range_min, range_max, bins + 1)
+
+  return rebinned_hist, bin_edges
 
 def get_color_shade(color_plane_name):
   """
@@ -78,7 +99,11 @@ def get_color_shade(color_plane_name):
 
   return color_shade_rgb
 
-def plot_color_planes_histogram(color_planes, bins, raw_bit_depth):
+def plot_color_planes_histogram(histograms, bins, raw_bit_depth, range_min=0, range_max=None):
+  """
+    Plot exact ADU histograms (see color_planes_histogram()) rebinned to bins between range_min and range_max.
+    range_max defaults to the largest value a raw_bit_depth sensor can produce.
+  """
   # High DPI screen plot resolution hack
   # TODO: figure out how to add some intelligence for handling different display DPIs
   # Qt5Agg plotting backend seems to handle this gracefully (and plots faster!)
@@ -88,11 +113,17 @@ def plot_color_planes_histogram(color_planes, bins, raw_bit_depth):
   # TODO: do we still need this?
   #plt.gray()
 
-  for color_plane_name in color_planes:
-    # Use Numba to compute histogram, more performant than simply using numpy
-    color_plane_hist, color_plane_hist_bins = numba_histogram(
-      color_planes[color_plane_name]["1D"],
-      bins
+  if range_max is None:
+    range_max = 2**raw_bit_depth - 1
+
+  plt = get_pyplot()
+
+  for color_plane_name in histograms:
+    color_plane_hist, color_plane_hist_bins = rebin_histogram(
+      histograms[color_plane_name],
+      bins,
+      range_min,
+      range_max
     )
 
     # Create plot for a basic histogram of this color plane
@@ -104,10 +135,9 @@ def plot_color_planes_histogram(color_planes, bins, raw_bit_depth):
     )
 
     # Mess with axes dimensions
-    # TODO: implement args range_max & range_min
     ax = plt.gca();
     ax.set_ylim(0.0)
-    ax.set_xlim(0.0, 2**raw_bit_depth)
+    ax.set_xlim(range_min, range_max)
 
   # Draw histogram plot
   plt.title("RAW Image ADU counts")
@@ -122,3 +152,125 @@ def plot_color_planes_histogram(color_planes, bins, raw_bit_depth):
   # plt.close()
 
 
+
+class HistogramFigure:
+  """
+    Off screen (Agg) histogram figure for batch exports.  The figure, axes and one line per color plane are
+    created once and only the line data changes from file to file, so rendering hundreds of PNGs never needs a
+    display and never rebuilds matplotlib state.
+  """
+
+  def __init__(self, range_min, range_max):
+    # Using Figure directly (rather than pyplot) keeps us away from the GUI backend and pyplot's global state
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    self.figure = Figure()
+    FigureCanvasAgg(self.figure)
+    self.ax = self.figure.add_subplot()
+    self.ax.set_xlim(range_min, range_max)
+    self.ax.set_xlabel('ADU')
+    self.ax.set_ylabel('Count')
+    self.lines = {}
+
+  def update(self, bin_edges, histograms, title):
+    """Point each color plane line at a new (rebinned) histogram."""
+    for color_plane_name, hist in histograms.items():
+      if color_plane_name not in self.lines:
+        self.lines[color_plane_name], = self.ax.plot(
+            [], [],
+            color=get_color_shade(color_plane_name),
+            alpha=0.75,
+            linewidth=1,
+            label=color_plane_name
+        )
+        self.ax.legend()
+      self.lines[color_plane_name].set_data(bin_edges[:-1], hist)
+
+    self.ax.set_ylim(0.0, max(max(hist.max() for hist in histograms.values()) * 1.05, 1.0))
+    self.ax.set_title(title)
+
+  def add_overlay(self, bin_edges, histograms):
+    """Draw a faint, unlabelled line per color plane which stays on the figure, for multi-frame summaries."""
+    for color_plane_name, hist in histograms.items():
+      self.ax.plot(bin_edges[:-1], hist, color=get_color_shade(color_plane_name), alpha=0.1, linewidth=0.5)
+
+  def save(self, png_filename):
+    self.figure.savefig(png_filename)
+
+class HistogramExporter:
+  """
+    Writes histograms out as CSV (rebinned counts), NPZ (rebinned and exact ADU counts) and/or PNG without a
+    display.  Feed it per frame results with add() (it is shaped to be a batch.run() on_result callback) and
+    call finish() at the end.
+
+    By default every frame gets its own <raw_filename>.histogram.<format> files.  With summary_prefix the frames
+    are merged instead and written once to <summary_prefix>.<format>, the PNG overlays every frame's histogram
+    on top of the mean.
+  """
+
+  def __init__(self, export_formats, bins, range_min, range_max, summary_prefix=None):
+    self.export_formats = export_formats
+    self.bins = bins
+    self.range_min = range_min
+    self.range_max = range_max
+    self.summary_prefix = summary_prefix
+    self.merged_histograms = {}
+    self.frame_count = 0
+    self.figure = HistogramFigure(range_min, range_max) if 'png' in export_formats else None
+
+  def rebin(self, histograms):
+    rebinned_histograms = {}
+    for color_plane_name, hist in histograms.items():
+      rebinned_histograms[color_plane_name], bin_edges = rebin_histogram(hist, self.bins, self.range_min, self.range_max)
+    return rebinned_histograms, bin_edges
+
+  def add(self, raw_filename, histograms):
+    rebinned_histograms, bin_edges = self.rebin(histograms)
+
+    if self.summary_prefix is None:
+      self.write(raw_filename + '.histogram', histograms, rebinned_histograms, bin_edges, basename(raw_filename))
+    else:
+      merge_histograms(self.merged_histograms, histograms)
+      self.frame_count += 1
+      if self.figure is not None:
+        self.figure.add_overlay(bin_edges, rebinned_histograms)
+
+  def finish(self):
+    if self.summary_prefix is None or self.frame_count == 0:
+      return
+
+    rebinned_histograms, bin_edges = self.rebin(self.merged_histograms)
+    self.write(
+        self.summary_prefix,
+        self.merged_histograms,
+        rebinned_histograms,
+        bin_edges,
+        "Mean of {} frames".format(self.frame_count),
+        png_scale=1.0 / self.frame_count
+    )
+
+  def write(self, output_prefix, histograms, rebinned_histograms, bin_edges, title, png_scale=1.0):
+    color_plane_names = list(rebinned_histograms)
+
+    if 'csv' in self.export_formats:
+      np.savetxt(
+          output_prefix + '.csv',
+          np.column_stack([bin_edges[:-1], bin_edges[1:]] + [rebinned_histograms[name] for name in color_plane_names]),
+          delimiter=',',
+          header=','.join(['bin_start', 'bin_end'] + color_plane_names),
+          comments='',
+          fmt=['%.6g', '%.6g'] + ['%d'] * len(color_plane_names)
+      )
+
+    if 'npz' in self.export_formats:
+      arrays = {'bin_edges': bin_edges}
+      for color_plane_name in color_plane_names:
+        arrays[color_plane_name] = rebinned_histograms[color_plane_name]
+        arrays['adu_' + color_plane_name] = histograms[color_plane_name]
+      np.savez_compressed(output_prefix + '.npz', **arrays)
+
+    if 'png' in self.export_formats:
+      scaled_histograms = {name: hist * png_scale for name, hist in rebinned_histograms.items()}
+      self.figure.update(bin_edges, scaled_histograms, title)
+      self.figure.save(output_prefix + '.png')
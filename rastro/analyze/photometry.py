@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+"""
+Aperture photometry straight from RAW files.
+
+Star positions are given once, in visible sensor pixels, and measured on every frame of a session without
+converting anything to FITS first.  For each color plane (G1 and G2 by default) the positions are mapped into
+plane pixels and all the stars are measured together: a cutout around every star is gathered with a single
+fancy index into the plane, then centroids, aperture sums and sky annulus medians are array operations over
+the whole (stars, rows, cols) stack.  Frames are spread across worker processes by batch.run().
+
+Targets are measured against the ensemble (summed flux) of the comparison stars, giving a
+differential magnitude per frame and color plane.  DATE-OBS and EXPTIME come from the same EXIF translation
+the FITS writers use, see fits.exif_header().
+"""
+
+import csv
+import math
+import sys
+
+import numpy as np
+
+from rastro import batch, profiling
+from rastro.extract import raw
+
+COLUMNS = [
+    'filename', 'date_obs', 'exptime', 'iso', 'color_plane', 'star', 'role', 'x', 'y', 'flux', 'flux_err',
+    'sky', 'sky_std', 'peak', 'saturated', 'mag', 'mag_err', 'diff_mag', 'diff_mag_err'
+]
+
+def read_star_file(star_filename):
+  """
+    Read a star list, one star per line as "role name x y" where role is target or comparison and x, y are
+    visible sensor pixel coordinates.  Blank lines and lines starting with # are skipped.
+  """
+  stars = []
+  with open(star_filename) as star_file:
+    for line_number, line in enumerate(star_file, 1):
+      line = line.strip()
+      if not line or line.startswith('#'):
+        continue
+      fields = line.replace(',', ' ').split()
+      if len(fields) != 4 or fields[0] not in ('target', 'comparison'):
+        raise ValueError("{} line {}: expected <target|comparison> <name> <x> <y>, got [{}]".format(
+            star_filename, line_number, line))
+      stars.append((fields[0], fields[1], float(fields[2]), float(fields[3])))
+  return stars
+
+def get_stamps(color_plane, xs, ys, half_size):
+  """
+    Gather a (2 * half_size + 1) square cutout around the nearest pixel of every (xs, ys) plane position with a
+    single fancy index.  Returns the float64 (stars, rows, cols) stack with pixels off the plane set to NaN,
+    along with the row and column coordinates of every cutout pixel.
+  """
+  rows, cols = color_plane.shape
+  offsets = np.arange(-half_size, half_size + 1)
+  stamp_rows = np.rint(ys).astype(np.intp)[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+  stamp_cols = np.rint(xs).astype(np.intp)[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+  inside = (stamp_rows >= 0) & (stamp_rows < rows) & (stamp_cols >= 0) & (stamp_cols < cols)
+
+  stamps = color_plane[stamp_rows.clip(0, rows - 1), stamp_cols.clip(0, cols - 1)].astype(np.float64)
+  stamps[~inside] = np.nan
+  return stamps, stamp_rows, stamp_cols
+
+def find_centroids(color_plane, xs, ys, box_radius):
+  """
+    Intensity weighted centroids within box_radius plane pixels of each position, after subtracting the box
+    median.  Positions with no signal above the median are kept as given.
+  """
+  stamps, stamp_rows, stamp_cols = get_stamps(color_plane, xs, ys, box_radius)
+  weights = np.nan_to_num(stamps - np.nanmedian(stamps, axis=(1, 2), keepdims=True)).clip(0, None)
+  total_weights = weights.sum(axis=(1, 2))
+
+  with np.errstate(invalid='ignore', divide='ignore'):
+    centroid_xs = np.where(total_weights > 0, (weights * stamp_cols).sum(axis=(1, 2)) / total_weights, xs)
+    centroid_ys = np.where(total_weights > 0, (weights * stamp_rows).sum(axis=(1, 2)) / total_weights, ys)
+  return centroid_xs, centroid_ys
+
+def measure_stars(color_plane, xs, ys, aperture_radius, annulus_inner, annulus_outer):
+  """
+    Aperture photometry of every (xs, ys) plane position at once.  Returns a dictionary of arrays (one value
+    per star): sky (annulus median), sky_std, flux (aperture sum minus sky), aperture and annulus pixel counts
+    and the aperture peak.
+  """
+  stamps, stamp_rows, stamp_cols = get_stamps(color_plane, xs, ys, int(math.ceil(annulus_outer)))
+  distances = np.hypot(stamp_rows - ys[:, np.newaxis, np.newaxis], stamp_cols - xs[:, np.newaxis, np.newaxis])
+  inside = ~np.isnan(stamps)
+  aperture = inside & (distances <= aperture_radius)
+  annulus = inside & (distances >= annulus_inner) & (distances < annulus_outer)
+
+  with np.errstate(invalid='ignore'):
+    sky_pixels = np.where(annulus, stamps, np.nan)
+    sky = np.nanmedian(sky_pixels, axis=(1, 2))
+    sky_std = np.nanstd(sky_pixels, axis=(1, 2))
+
+  aperture_pixels = aperture.sum(axis=(1, 2))
+  return {
+      'sky': sky,
+      'sky_std': sky_std,
+      'flux': np.where(aperture, stamps, 0.0).sum(axis=(1, 2)) - aperture_pixels * sky,
+      'aperture_pixels': aperture_pixels,
+      'annulus_pixels': annulus.sum(axis=(1, 2)),
+      'peak': np.where(aperture, stamps, -np.inf).max(axis=(1, 2)),
+  }
+
+def get_flux_errors(measurements, gain):
+  """CCD equation flux uncertainty in ADU, gain in e-/ADU."""
+  aperture_pixels = measurements['aperture_pixels']
+  annulus_pixels = np.maximum(measurements['annulus_pixels'], 1)
+  sky_variance = measurements['sky_std']**2
+  return np.sqrt(
+      np.maximum(measurements['flux'], 0) / gain
+      + aperture_pixels * sky_variance * (1 + aperture_pixels / annulus_pixels)
+  )
+
+def to_magnitudes(flux, flux_err):
+  """Magnitudes and their errors, NaN where the flux isn't positive."""
+  with np.errstate(invalid='ignore', divide='ignore'):
+    positive = flux > 0
+    mag = np.where(positive, -2.5 * np.log10(np.where(positive, flux, 1.0)), np.nan)
+    mag_err = np.where(positive, 2.5 / np.log(10) * flux_err / np.where(positive, flux, 1.0), np.nan)
+  return mag, mag_err
+
+def photometry_task(raw_frame, stars, color_plane_names, aperture_radius, annulus_inner, annulus_outer,
+                    box_radius=None, gain=1.0):
+  """
+    batch.run() task, measure every star on each of color_plane_names of one frame and return the light curve
+    rows (dictionaries of COLUMNS) for it.
+
+    stars is a list of (role, name, x, y) in visible sensor pixels, radii are in color plane pixels.
+  """
+  from rastro.convert import fits
+
+  color_planes = raw_frame.color_planes
+  header = fits.exif_header(raw_frame.metadata, color_plane_names[0])
+  exptime = header['EXPTIME'][0]
+  white_level = raw_frame.raw_info['white_level']
+
+  # Sensor coordinates are relative to the region of interest, when only a region was extracted
+  x_origin, y_origin = raw_frame.roi[:2] if raw_frame.roi is not None else (0, 0)
+  sensor_xs = np.array([x for role, name, x, y in stars], dtype=np.float64) - x_origin
+  sensor_ys = np.array([y for role, name, x, y in stars], dtype=np.float64) - y_origin
+  targets = np.array([role == 'target' for role, name, x, y in stars])
+  has_comparisons = not targets.all()
+  color_plane_offsets = dict(zip(raw_frame.color_plane_map, raw.get_color_plane_offsets(raw_frame.raw_pattern)))
+
+  rows = []
+  for color_plane_name in color_plane_names:
+    if color_plane_name not in color_planes:
+      raise ValueError("No {} color plane, the frame has {}".format(color_plane_name, list(color_planes)))
+    color_plane = color_planes[color_plane_name]['2D']
+    row_offset, col_offset = color_plane_offsets[color_plane_name]
+
+    with profiling.stage('analysis'):
+      # Sensor to color plane pixels
+      xs = (sensor_xs - col_offset) / 2
+      ys = (sensor_ys - row_offset) / 2
+      if box_radius:
+        xs, ys = find_centroids(color_plane, xs, ys, box_radius)
+
+      measurements = measure_stars(color_plane, xs, ys, aperture_radius, annulus_inner, annulus_outer)
+      flux = measurements['flux']
+      flux_err = get_flux_errors(measurements, gain)
+      mag, mag_err = to_magnitudes(flux / exptime, flux_err / exptime)
+
+      # Targets against the ensemble of comparison stars, the exposure time cancels out
+      comparison_flux = flux[~targets].sum()
+      comparison_err = np.sqrt((flux_err[~targets]**2).sum())
+      with np.errstate(invalid='ignore', divide='ignore'):
+        ratio_err = np.sqrt((flux_err / flux)**2 + (comparison_err / comparison_flux)**2)
+        diff_mag, diff_mag_err = to_magnitudes(flux / comparison_flux, ratio_err * flux / comparison_flux)
+
+    for i, (role, name, x, y) in enumerate(stars):
+      rows.append({
+          'filename': raw_frame.filename,
+          'date_obs': header['DATE-OBS'][0],
+          'exptime': exptime,
+          'iso': header['ISO'][0],
+          'color_plane': color_plane_name,
+          'star': name,
+          'role': role,
+          # Back to sensor coordinates
+          'x': 2 * xs[i] + col_offset + x_origin,
+          'y': 2 * ys[i] + row_offset + y_origin,
+          'flux': flux[i],
+          'flux_err': flux_err[i],
+          'sky': measurements['sky'][i],
+          'sky_std': measurements['sky_std'][i],
+          'peak': measurements['peak'][i],
+          'saturated': bool(measurements['peak'][i] >= white_level),
+          'mag': mag[i],
+          'mag_err': mag_err[i],
+          'diff_mag': diff_mag[i] if role == 'target' and has_comparisons else float('nan'),
+          'diff_mag_err': diff_mag_err[i] if role == 'target' and has_comparisons else float('nan'),
+      })
+
+  return rows
+
+def write_light_curve(output_filename, rows):
+  """Write the rows as CSV, ordered by DATE-OBS, to output_filename (stdout when None)."""
+  rows = sorted(rows, key=lambda row: (row['date_obs'], row['filename']))
+
+  output_file = sys.stdout if output_filename is None else open(output_filename, 'w', newline='')
+  try:
+    writer = csv.DictWriter(output_file, fieldnames=COLUMNS)
+    writer.writeheader()
+    for row in rows:
+      writer.writerow(dict(
+          (column, '{:.6g}'.format(value) if isinstance(value, float) else value)
+          for column, value in row.items()
+      ))
+  finally:
+    if output_file is not sys.stdout:
+      output_file.close()
+
+def check_options(stars, aperture_radius, annulus_inner, annulus_outer):
+  """Raise ValueError when there are no stars or the radii don't nest."""
+  if not stars:
+    raise ValueError("No stars to measure, give at least one target or comparison star")
+  if not 0 < aperture_radius <= annulus_inner < annulus_outer:
+    raise ValueError("Expected 0 < aperture radius <= annulus inner radius < annulus outer radius, got {}, {}, {}".format(
+        aperture_radius, annulus_inner, annulus_outer))
+
+def light_curve(raw_filenames, stars, output_filename=None, color_plane_names=('G1', 'G2'), aperture_radius=4.0,
+                annulus_inner=8.0, annulus_outer=12.0, box_radius=3, gain=1.0, jobs=1, cache=None, profiler=None,
+                roi=None):
+  """
+    Measure stars on every frame and write the light curve.  Returns the list of (raw_filename, error) for the
+    files that failed.
+  """
+  check_options(stars, aperture_radius, annulus_inner, annulus_outer)
+
+  rows = []
+  failed = batch.run(
+      photometry_task,
+      raw_filenames,
+      task_args=(stars, list(color_plane_names), aperture_radius, annulus_inner, annulus_outer),
+      task_kwargs={'box_radius': box_radius, 'gain': gain},
+      jobs=jobs,
+      on_result=lambda raw_filename, frame_rows: rows.extend(frame_rows),
+      cache=cache,
+      profiler=profiler,
+      roi=roi
+  )
+
+  write_light_curve(output_filename, rows)
+  return failed
@@ -1,20 +1,192 @@
 # -*- coding: utf-8 -*-
 
-from rawpy import enhance
+"""
+Hot and dead pixel detection.
 
-def enhance_rawpixels(hot_pixel_file, dead_pixel_file, raw_filenames):
-  # See: https://letmaik.github.io/rawpy/api/rawpy.enhance.html
-  dead_pixels = rawpy.enhance.find_bad_pixels(raw_filenames, find_hot=False, find_dead=True, confirm_ratio=1)
-  hot_pixels = rawpy.enhance.find_bad_pixels(raw_filenames, find_hot=True, find_dead=False, confirm_ratio=1)
-  #bad_pixels = rawpy.enhance.find_bad_pixels(raw_files, find_hot=True, find_dead=True, confirm_ratio=0.9)
-  #bad_pixels = rawpy.enhance.find_bad_pixels(['focus-test-inf-_shutterspeed-30_10-02-20_CRW_5737.CRW'], find_hot=True, find_dead=False, confirm_ratio=0.9)
+Each frame is decoded once and every color plane is compared against the median of each pixel's 8 same color
+neighbors.  Pixels sitting more than a threshold above the median are hot candidates, more than the threshold
+below are dead candidates, both found in the same pass.  Candidates are counted across frames and only the ones
+seen in at least confirm_ratio of the frames are reported.
 
-  # Eventually we should just write a complete RAW image conversion script in Python
-  # This could include calling:
-  # rawpy.enhance.repair_bad_pixels
+This follows the approach of rawpy.enhance.find_bad_pixels (same default threshold and confirm ratio rules), but
+without decoding every file once per pixel type or needing OpenCV/scikit-image for the median filter.
+"""
 
-  # Since we're still processing with dcraw/rawtran, we need the equivalent coordinates
-  # This should account for image area borders, etc...
-  rawpy.enhance.save_dcraw_bad_pixels(dead_pixel_file, dead_pixels)
-  rawpy.enhance.save_dcraw_bad_pixels(hot_pixel_file, hot_pixels)
+import math
+import sys
 
+import numpy as np
+from astropy.io import fits
+
+from rastro import batch, profiling
+from rastro.extract import raw
+
+# Same color neighbors of a pixel, as (row, col) offsets within a color plane
+NEIGHBOR_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+def get_threshold(raw_image_visible):
+  """Default detection threshold, as used by rawpy.enhance.find_bad_pixels."""
+  return max(int(raw_image_visible.max()) // 150, 20)
+
+def find_color_plane_candidates(color_plane, threshold, band_rows=256):
+  """
+    Return the (row, col) plane coordinates of the hot and dead candidates of a single color plane.
+
+    The plane is processed in bands of rows so only one padded int32 copy of a band (with a row above and below
+    it) and its 8 neighbor copies are ever in memory.
+  """
+  rows, cols = color_plane.shape
+
+  hot_candidates = []
+  dead_candidates = []
+  for row_start in range(0, rows, band_rows):
+    row_stop = min(row_start + band_rows, rows)
+    band_length = row_stop - row_start
+
+    # The band and its neighboring rows, edges of the plane are mirrored so every pixel has 8 neighbors
+    halo_start = max(row_start - 1, 0)
+    halo_stop = min(row_stop + 1, rows)
+    padded_band = np.pad(
+        color_plane[halo_start:halo_stop],
+        ((1 - (row_start - halo_start), 1 - (halo_stop - row_stop)), (1, 1)),
+        mode='reflect'
+    ).astype(np.int32)
+
+    neighbors = np.stack([
+        padded_band[1 + row_offset:band_length + 1 + row_offset, 1 + col_offset:cols + 1 + col_offset]
+        for row_offset, col_offset in NEIGHBOR_OFFSETS
+    ])
+    # Median of 8 values is the mean of the 4th and 5th smallest, doubled here to stay in integers
+    neighbors.partition((3, 4), axis=0)
+    double_median = neighbors[3] + neighbors[4]
+    double_difference = 2 * padded_band[1:band_length + 1, 1:cols + 1] - double_median
+
+    hot_rows, hot_cols = np.nonzero(double_difference > 2 * threshold)
+    dead_rows, dead_cols = np.nonzero(double_difference < -2 * threshold)
+    hot_candidates.append((hot_rows + row_start, hot_cols))
+    dead_candidates.append((dead_rows + row_start, dead_cols))
+
+  return (
+      tuple(np.concatenate(axis) for axis in zip(*hot_candidates)),
+      tuple(np.concatenate(axis) for axis in zip(*dead_candidates))
+  )
+
+def find_bad_pixel_candidates(raw_frame, threshold=None):
+  """
+    batch.run() task, return (visible shape, hot indexes, dead indexes) for one frame, where the indexes are flat
+    indexes into raw_image_visible.
+  """
+  raw_image_visible = raw_frame.raw_image_visible
+  color_planes = raw_frame.color_planes
+
+  with profiling.stage('analysis'):
+    if threshold is None:
+      threshold = get_threshold(raw_image_visible)
+
+    color_plane_offsets = raw.get_color_plane_offsets(raw_frame.raw_pattern)
+    visible_cols = raw_image_visible.shape[1]
+
+    hot_indexes = []
+    dead_indexes = []
+    for color_plane_name, (row_offset, col_offset) in zip(raw_frame.color_plane_map, color_plane_offsets):
+      (hot_rows, hot_cols), (dead_rows, dead_cols) = find_color_plane_candidates(
+          color_planes[color_plane_name]['2D'],
+          threshold
+      )
+
+      # Back from color plane to sensor coordinates
+      hot_indexes.append((2 * hot_rows + row_offset) * visible_cols + 2 * hot_cols + col_offset)
+      dead_indexes.append((2 * dead_rows + row_offset) * visible_cols + 2 * dead_cols + col_offset)
+
+  return raw_image_visible.shape, np.concatenate(hot_indexes), np.concatenate(dead_indexes)
+
+def confirm_candidates(candidate_indexes, frame_count, confirm_ratio):
+  """Flat indexes which were candidates in at least confirm_ratio of the frames."""
+  if not candidate_indexes:
+    return np.array([], dtype=np.int64)
+
+  unique_indexes, counts = np.unique(np.concatenate(candidate_indexes), return_counts=True)
+  # Rounded up, so 0.95 of 10 frames needs all 10.  The tolerance keeps e.g. 0.7 * 10 = 7.000000000000001 at 7.
+  return unique_indexes[counts >= max(math.ceil(frame_count * confirm_ratio - 1e-9), 1)]
+
+def save_dcraw_bad_pixels(bad_pixel_file, bad_pixels, title):
+  """
+    Write (row, col) pixels in the dcraw bad pixel file format ("col row timestamp" per line, in unrotated visible
+    sensor coordinates), like rawpy.enhance.save_dcraw_bad_pixels.  Writes to stdout when bad_pixel_file is None, with title as a comment
+    line (which dcraw ignores) so the hot and dead lists can be told apart.
+  """
+  lines = ''.join('{} {} 0\n'.format(col, row) for row, col in bad_pixels)
+  if bad_pixel_file is None:
+    sys.stdout.write('# ' + title + '\n' + lines)
+  else:
+    with open(bad_pixel_file, 'w') as f:
+      f.write(lines)
+
+def save_bad_pixel_mask(mask_file, shape, hot_indexes, dead_indexes):
+  """
+    Write a mask of the visible sensor area, as boolean 'hot' and 'dead' arrays in an NPZ file, or as a uint8 FITS
+    image (1 = hot, 2 = dead) for any other extension.
+  """
+  hot_mask = np.zeros(shape, dtype=bool)
+  hot_mask.flat[hot_indexes] = True
+  dead_mask = np.zeros(shape, dtype=bool)
+  dead_mask.flat[dead_indexes] = True
+
+  if mask_file.endswith('.npz'):
+    np.savez_compressed(mask_file, hot=hot_mask, dead=dead_mask)
+  else:
+    mask = hot_mask.astype(np.uint8)
+    mask[dead_mask] = 2
+    hdr = fits.Header()
+    hdr['COMMENT'] = 'Bad pixel mask: 1 = hot, 2 = dead'
+    fits.PrimaryHDU(mask, header=hdr).writeto(mask_file)
+
+def enhance_rawpixels(hot_pixel_file, dead_pixel_file, raw_filenames, confirm_ratio=1.0, threshold=None,
+                      mask_file=None, jobs=1, cache=None, profiler=None):
+  """
+    Find hot and dead pixels across raw_filenames and write them out as dcraw bad pixel lists (stdout when no
+    file is given) and optionally a mask.  Returns the list of (raw_filename, error) for files that failed, raises
+    ValueError when the frames that decoded don't all have the same visible size.
+  """
+  shapes = set()
+  hot_candidates = []
+  dead_candidates = []
+
+  def collect_candidates(raw_filename, candidates):
+    shape, hot_indexes, dead_indexes = candidates
+    shapes.add(shape)
+    hot_candidates.append(hot_indexes)
+    dead_candidates.append(dead_indexes)
+
+  failed = batch.run(
+      find_bad_pixel_candidates,
+      raw_filenames,
+      task_kwargs={'threshold': threshold},
+      jobs=jobs,
+      on_result=collect_candidates,
+      cache=cache,
+      profiler=profiler
+  )
+
+  if not shapes:
+    return failed
+  if len(shapes) > 1:
+    raise ValueError("All frames must have the same visible size, got {}".format(sorted(shapes)))
+  shape = shapes.pop()
+
+  frame_count = len(hot_candidates)
+  hot_indexes = confirm_candidates(hot_candidates, frame_count, confirm_ratio)
+  dead_indexes = confirm_candidates(dead_candidates, frame_count, confirm_ratio)
+  print("Found {} hot and {} dead pixels in {} frames".format(len(hot_indexes), len(dead_indexes), frame_count),
+        file=sys.stderr)
+
+  # Since we're still processing with dcraw/rawtran, we need the equivalent coordinates.  These are
+  # raw_image_visible coordinates, the sensor with libraw's top and left margins already cut off, which is the
+  # width x height area dcraw -P checks its list against, before any rotation is applied.
+  save_dcraw_bad_pixels(dead_pixel_file, zip(*np.unravel_index(dead_indexes, shape)), 'Dead pixels')
+  save_dcraw_bad_pixels(hot_pixel_file, zip(*np.unravel_index(hot_indexes, shape)), 'Hot pixels')
+
+  if mask_file is not None:
+    save_bad_pixel_mask(mask_file, shape, hot_indexes, dead_indexes)
+
+  return failed
@@ -1,46 +1,122 @@
 # -*- coding: utf-8 -*-
 
-import rawpy
-import io
-import pyexiv2
 from pyexiv2.exif import ExifTag, ExifValueError
+import csv
+import json
 import numba
 import numpy as np
-import numpy.ma as ma
 
+from rastro import batch, profiling
 from rastro.extract import raw
 
-## ### Numba Function Speedups ###
-## # TODO: These should probably move to a new package/module soon
-## @numba.jit(nopython=True)
-## def numba_mean(a):
-##   return np.mean(a)
-## 
-## @numba.jit(nopython=True)
-## def numba_amin(a):
-##   return np.amin(a)
-## 
-## @numba.jit(nopython=True)
-## def numba_amax(a):
-##   return np.amax(a)
-## 
-## @numba.jit(nopython=True)
-## def numba_median(a):
-##   return np.median(a)
-## 
-## @numba.jit(nopython=True)
-## def numba_std(a):
-##   return np.std(a)
-## 
-## @numba.jit(nopython=True)
-## def numba_var(a):
-##   return np.var(a)
-
-def output_basic_stats(raw_filename):
-  # see: https://python3-exiv2.readthedocs.io/en/latest/api.html#buffer
-  # Little hack to not have to open the RAW file more than once to gather stats/info
-  metadata = pyexiv2.ImageMetadata(raw_filename)
-  metadata.read()
+### Histogram based statistics ###
+# RAW data is made of bounded unsigned integers (at most 16 bit), so one pass to count every ADU value gives us
+# exact min, max, median, percentiles, mean and variance from a 64K entry array instead of a pass (and for the
+# median a full partition) per statistic.
+
+# Number of possible ADU values for 16 bit (or smaller) RAW data
+ADU_COUNT = 2**16
+
+# cache=True keeps the compiled kernel on disk (__pycache__, or the user wide numba cache when that isn't writable)
+# so it isn't recompiled on every invocation.
+@numba.jit(nopython=True, nogil=True, cache=True)
+def cfa_histograms(raw_image_visible, raw_pattern, adu_count):
+  """
+    Count ADU values of each CFA color plane in a single pass over the visible sensor data.
+
+    Returns a (color plane count + 1, adu_count) array, row i is the histogram of color plane i (raw_pattern
+    index) and the last row counts the trailing odd row/column pixels that extract_color_planes() trims.
+  """
+  rows, cols = raw_image_visible.shape
+  even_rows = rows - rows % 2
+  even_cols = cols - cols % 2
+  edge_index = raw_pattern.size
+  hist = np.zeros((edge_index + 1, adu_count), dtype=np.int64)
+
+  for row in range(even_rows):
+    row_pattern = raw_pattern[row & 1]
+    for col in range(even_cols):
+      hist[row_pattern[col & 1], raw_image_visible[row, col]] += 1
+    for col in range(even_cols, cols):
+      hist[edge_index, raw_image_visible[row, col]] += 1
+
+  for row in range(even_rows, rows):
+    for col in range(cols):
+      hist[edge_index, raw_image_visible[row, col]] += 1
+
+  return hist
+
+def color_plane_histograms(raw_image_visible, raw_pattern, color_plane_map):
+  """
+    Return a dictionary of exact ADU histograms, one per color plane name plus "Bayer" for the whole visible
+    sensor area.
+  """
+  if raw_image_visible.dtype.kind != 'u' or raw_image_visible.dtype.itemsize > 2:
+    raise ValueError("Expected unsigned 16 bit (or smaller) RAW data, got {}".format(raw_image_visible.dtype))
+
+  # Validates the pattern, each plane index must appear exactly once
+  raw.get_color_plane_offsets(raw_pattern)
+
+  hist = cfa_histograms(raw_image_visible, np.asarray(raw_pattern, dtype=np.intp), ADU_COUNT)
+
+  histograms = {"Bayer": hist.sum(axis=0)}
+  for i, color_plane_name in enumerate(color_plane_map):
+    histograms[color_plane_name] = hist[i]
+
+  return histograms
+
+def histogram_percentile(hist, q):
+  """
+    Percentile q (0-100) of the values counted in hist, using the same linear interpolation as np.percentile
+    so that q=50 matches np.median.
+  """
+  cumulative_count = np.cumsum(hist)
+  count = int(cumulative_count[-1])
+
+  position = (count - 1) * q / 100.0
+  lower_rank = int(np.floor(position))
+  upper_rank = int(np.ceil(position))
+
+  # The k-th smallest value (0 based) is the first ADU whose cumulative count exceeds k
+  lower_value, upper_value = np.searchsorted(cumulative_count, [lower_rank, upper_rank], side='right')
+
+  return float(lower_value + (position - lower_rank) * (upper_value - lower_value))
+
+def histogram_stats(hist):
+  """
+    Exact summary statistics of the values counted in hist.  Mean and variance are accumulated as python
+    integers, so nothing is lost to floating point summation.
+  """
+  adu = np.arange(hist.size, dtype=np.int64)
+  nonzero_adu = np.flatnonzero(hist)
+
+  count = int(hist.sum())
+  adu_sum = int(np.dot(hist, adu))
+  adu_square_sum = int(np.dot(hist, adu * adu))
+  variance = (adu_square_sum * count - adu_sum * adu_sum) / (count * count)
+
+  return {
+      'count': count,
+      'max': int(nonzero_adu[-1]),
+      'min': int(nonzero_adu[0]),
+      'median': histogram_percentile(hist, 50),
+      'mean': adu_sum / count,
+      'std': variance ** 0.5,
+      'var': variance,
+  }
+
+def print_stats(title, plane_stats):
+  print("------ {} stats ------\n".format(title))
+  print("Max pixel value: ", plane_stats['max'])
+  print("Min pixel value: ", plane_stats['min'])
+  print("Median pixel value: ", plane_stats['median'])
+  print("Average pixel value: ", plane_stats['mean'])
+  print("Stdev of pixel values: ", plane_stats['std'])
+  print("Variance of pixel values: ", plane_stats['var'])
+
+def output_basic_stats(raw_frame):
+  # EXIF and pixel data both come from the same RawFrame buffer
+  metadata = raw_frame.metadata
 
   # Print out all the exif data
   for key in metadata.exif_keys:
@@ -50,88 +126,145 @@ def output_basic_stats(raw_filename):
     except ExifValueError:
       print("Unable to decode raw value for key [{}]".format(key))
 
-  # Create io buffer to re-use with rawpy
-  byteio = io.BytesIO(metadata.buffer)
-
-  # Operate on the IO buffer
-  with rawpy.imread(byteio) as rawimage:
-  #  rgb = rawimage.postprocess()
-    print("Black level per channel: ", rawimage.black_level_per_channel)
-    print("Camera White Balance: ", rawimage.camera_whitebalance)
-    print("Camera Color Description: ", rawimage.color_desc)
-  #  print("Camera Color Matrix: ", rawimage.color_matrix)
-    print("Daylight White Balance: ", rawimage.daylight_whitebalance)
-    print("Number of Colors: ", rawimage.num_colors)
-  #  print("Raw Colors: ", rawimage.raw_colors)
-    print("Raw Type: ", rawimage.raw_type)
-    print("Sizes: ", rawimage.sizes)
-
-    # Get RAW CFA image data for overall stats
-    raw_bayer_plane = rawimage.raw_image_visible
-
-    # Visible sensor stats
-    #print("Raw Bayer Plane: \n", raw_bayer_plane)
-    # TODO: convert numpy stats to numba stats (if available)
-    print("------ Bayer plane stats ------\n")
-    print("Max pixel value: ", np.amax(raw_bayer_plane))
-    print("Min pixel value: ", np.amin(raw_bayer_plane))
-    print("Median pixel value: ", np.median(raw_bayer_plane))
-    print("Average pixel value: ", np.average(raw_bayer_plane))
-    print("Stdev of pixel values: ", np.std(raw_bayer_plane))
-    print("Variance of pixel values: ", np.var(raw_bayer_plane))
-
-    # These are actually slower than standard numpy...  Probably something I'm doing wrong
-    #print("------ Bayer plane stats ------\n")
-    #print("Max pixel value: ", numba_amax(raw_bayer_plane))
-    #print("Min pixel value: ", numba_amin(raw_bayer_plane))
-    #print("Median pixel value: ", numba_median(raw_bayer_plane))
-    #print("Average pixel value: ", numba_mean(raw_bayer_plane))
-    #print("Stdev of pixel values: ", numba_std(raw_bayer_plane))
-    #print("Variance of pixel values: ", numba_var(raw_bayer_plane))
-
-    # Analyze color plane data
-    color_plane_count = rawimage.num_colors + 1
-
-    # Extract individual color planes
-    color_plane_map = raw.get_color_plane_map(color_plane_count, rawimage.color_desc)
-
-    # Color plane dictionary 
-    # TODO: make this more pythony and use an OO approach
-    color_planes = {}
-    for i in range(color_plane_count):
-      color_planes[color_plane_map[i]] = {}
-
-      # TODO: Document exactly what is taking place with this numpy array transformation
-      mask = (rawimage.raw_colors_visible != i)
-      color_plane_masked = ma.masked_array(np.copy(rawimage.raw_image_visible), mask)
-      # TODO: Do camera sensors ever have an odd number of pixels in x/y?  This would skew results slightly.
-      half_size_shape = tuple(int(dim/2) for dim in rawimage.raw_image_visible.shape)
-      color_planes[color_plane_map[i]]["1D"] = color_plane_masked[~color_plane_masked.mask]
-
-      # Individual color plane stats
-      # TODO: Do we need to remove the mask before calculating stats?
-      # /usr/lib/python3/dist-packages/numpy/core/fromnumeric.py:745: UserWarning: Warning: 'partition' will ignore the 'mask' of the MaskedArray.  a.partition(kth, axis=axis, kind=kind, order=order)
-
-      print("------ {} color plane stats ------\n".format(color_plane_map[i]))
-      print("Max pixel value: ", np.amax(color_planes[color_plane_map[i]]["1D"]))
-      print("Min pixel value: ", np.amin(color_planes[color_plane_map[i]]["1D"]))
-      print("Median pixel value: ", np.median(color_planes[color_plane_map[i]]["1D"]))
-      print("Average pixel value: ", np.average(color_planes[color_plane_map[i]]["1D"]))
-      print("Stdev of pixel values: ", np.std(color_planes[color_plane_map[i]]["1D"]))
-      print("Variance of pixel values: ", np.var(color_planes[color_plane_map[i]]["1D"]))
-
-      # Reshape the array
-      # TODO: Is this the best way?
-      # See: https://docs.scipy.org/doc/numpy/reference/generated/numpy.reshape.html
-      #color_planes[color_plane_map[i]]["2D"] = np.reshape(color_planes[color_plane_map[i]]["1D"], half_size_shape)
-      # For now, I don't think we need 2D for stats
-
-
-
-  #print("Raw Image: ", rawimage.raw_image)
-#  print("Raw Image (Visible): ", rawimage.raw_image_visible)
-#  print("Raw Pattern: ", rawimage.raw_pattern)
-#
-#  print("Raw Colors (Visible): ", rawimage.raw_colors_visible)
+  # From rawpy, or the decode cache
+  raw_info = raw_frame.raw_info
+  print("Black level per channel: ", raw_info['black_level_per_channel'])
+  print("Camera White Balance: ", raw_info['camera_whitebalance'])
+  print("Camera Color Description: ", raw_info['color_desc'])
+  print("Daylight White Balance: ", raw_info['daylight_whitebalance'])
+  print("Number of Colors: ", raw_info['num_colors'])
+  print("Raw Type: ", raw_info['raw_type'])
+  print("Sizes: ", raw_info['sizes'])
+
+  # Count every ADU value of every color plane in a single pass, all the stats come from these histograms
+  raw_image_visible = raw_frame.raw_image_visible
+  if raw_frame.roi is not None:
+    print("Region of interest (x0, y0, width, height): ", raw_frame.roi)
+  histograms = color_plane_histograms(
+      raw_image_visible,
+      raw_frame.raw_pattern,
+      raw_frame.color_plane_map
+  )
+
+  # Visible sensor stats first, then the individual color planes
+  print_stats("Bayer plane", histogram_stats(histograms["Bayer"]))
+  for color_plane_name in raw_frame.color_plane_map:
+    print_stats("{} color plane".format(color_plane_name), histogram_stats(histograms[color_plane_name]))
+
+### Multi frame summary ###
+# One row per frame and plane, for QA of a whole session.  Frames are processed in parallel by batch.run(),
+# each worker only sends back its few rows.
+
+SUMMARY_COLUMNS = [
+    'filename', 'date_obs', 'exptime', 'iso', 'instrume', 'color_plane', 'black_level', 'white_level', 'count',
+    'min', 'max', 'median', 'mean', 'std', 'saturated', 'clipped'
+]
+
+SUMMARY_FORMATS = ['csv', 'jsonl', 'parquet']
+
+def frame_summary(raw_frame):
+  """
+    batch.run() task, return the summary rows (dictionaries of SUMMARY_COLUMNS) of one frame: the whole visible
+    sensor as "Bayer", then every color plane.  saturated counts pixels at or above the white level, clipped
+    the ones at 0 ADU (the bottom of the ADC range, e.g. a black level offset set too low).
+  """
+  from rastro.convert import fits
+
+  raw_image_visible = raw_frame.raw_image_visible
+  raw_info = raw_frame.raw_info
+  header = fits.exif_header(raw_frame.metadata, 'G')
+
+  with profiling.stage('analysis'):
+    histograms = color_plane_histograms(raw_image_visible, raw_frame.raw_pattern, raw_frame.color_plane_map)
+
+    # Black levels are per color plane index, the sensor as a whole gets their mean
+    black_levels = raw_info['black_level_per_channel']
+    plane_black_levels = {"Bayer": float(np.mean(black_levels[:len(raw_frame.color_plane_map)]))}
+    for i, color_plane_name in enumerate(raw_frame.color_plane_map):
+      plane_black_levels[color_plane_name] = black_levels[i]
+
+    white_level = raw_info['white_level']
+    rows = []
+    for color_plane_name in ["Bayer"] + list(raw_frame.color_plane_map):
+      hist = histograms[color_plane_name]
+      plane_stats = histogram_stats(hist)
+      rows.append({
+          'filename': raw_frame.filename,
+          'date_obs': header['DATE-OBS'][0],
+          'exptime': header['EXPTIME'][0],
+          'iso': header['ISO'][0],
+          'instrume': header['INSTRUME'][0],
+          'color_plane': color_plane_name,
+          'black_level': plane_black_levels[color_plane_name],
+          'white_level': white_level,
+          'count': plane_stats['count'],
+          'min': plane_stats['min'],
+          'max': plane_stats['max'],
+          'median': plane_stats['median'],
+          'mean': plane_stats['mean'],
+          'std': plane_stats['std'],
+          'saturated': int(hist[white_level:].sum()),
+          'clipped': int(hist[0]),
+      })
+
+  return rows
+
+def get_summary_format(summary_filename):
+  """Output format from the summary filename's extension (.json is taken as JSON lines)."""
+  extension = summary_filename.rsplit('.', 1)[-1].lower()
+  summary_format = 'jsonl' if extension == 'json' else extension
+  if summary_format not in SUMMARY_FORMATS:
+    raise ValueError("Unknown summary format [{}], use a .csv, .jsonl or .parquet filename".format(summary_filename))
+  return summary_format
+
+def import_parquet():
+  """pyarrow.parquet, an optional dependency only needed for .parquet summaries."""
+  try:
+    import pyarrow.parquet
+  except ImportError:
+    raise ValueError("Parquet output needs pyarrow (pip3 install pyarrow), or use a .csv or .jsonl filename")
+  return pyarrow.parquet
+
+def write_summary(summary_filename, rows):
+  summary_format = get_summary_format(summary_filename)
+
+  if summary_format == 'csv':
+    with open(summary_filename, 'w', newline='') as summary_file:
+      writer = csv.DictWriter(summary_file, fieldnames=SUMMARY_COLUMNS)
+      writer.writeheader()
+      writer.writerows(rows)
+  elif summary_format == 'jsonl':
+    with open(summary_filename, 'w') as summary_file:
+      for row in rows:
+        summary_file.write(json.dumps(row) + '\n')
+  else:
+    parquet = import_parquet()
+    import pyarrow
+
+    columns = dict((column, [row[column] for row in rows]) for column in SUMMARY_COLUMNS)
+    parquet.write_table(pyarrow.table(columns), summary_filename)
+
+def summarize_frames(raw_filenames, summary_filename, jobs=1, cache=None, profiler=None, roi=None):
+  """
+    Compute the per plane statistics of every frame and write them, ordered by DATE-OBS, to summary_filename
+    as CSV, JSON lines or Parquet (see get_summary_format()).  Returns the list of (raw_filename, error) for
+    the files that failed.
+  """
+  # Fail on a bad filename (or missing pyarrow) before decoding a whole session
+  if get_summary_format(summary_filename) == 'parquet':
+    import_parquet()
 
+  rows = []
+  failed = batch.run(
+      frame_summary,
+      raw_filenames,
+      jobs=jobs,
+      on_result=lambda raw_filename, frame_rows: rows.extend(frame_rows),
+      cache=cache,
+      profiler=profiler,
+      roi=roi
+  )
 
+  rows.sort(key=lambda row: (row['date_obs'], row['filename']))
+  write_summary(summary_filename, rows)
+  return failed
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""rastro.batch: runs a per file task over many RAW files, optionally spread across a process pool."""
+
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from os.path import basename, getsize
+
+from rastro import profiling
+
+def process_file(task, raw_filename, task_args=(), task_kwargs=None, cache=None, profile=False, roi=None):
+  """
+     Open raw_filename as a RawFrame, hand it to task and return the elapsed time in seconds, whatever task
+     returned and (with profile set) the file's rastro.profiling stage times, otherwise None.  This is what runs
+     inside the worker processes, so task has to be a module level (picklable) function and its result has to
+     be picklable too.  roi is the RawFrame's region of interest.
+  """
+  # Imported here so a parent process that only hands out files and collects results (the catalog, say) never
+  # loads rawpy and the rest of the decoding stack, the workers import it once on their first file
+  from rastro.extract import raw
+
+  if profile:
+    profiling.start_file()
+  start_time = time.perf_counter()
+  try:
+    with raw.RawFrame(raw_filename, cache=cache, roi=roi) as raw_frame:
+      result = task(raw_frame, *task_args, **(task_kwargs or {}))
+  finally:
+    elapsed_time = time.perf_counter() - start_time
+    file_profile = profiling.finish_file(elapsed_time) if profile else None
+  return elapsed_time, result, file_profile
+
+def process_pool(jobs):
+  """
+     ProcessPoolExecutor of jobs workers for batch.run() style tasks.  libraw is built with OpenMP, which can
+     deadlock in forked children, so the workers are always spawned fresh.
+  """
+  return ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'))
+
+def report_progress(done_count, total_count, raw_filename, elapsed_time=None, error=None):
+  if error is None:
+    print("[{}/{}] {} ({:.2f}s)".format(done_count, total_count, basename(raw_filename), elapsed_time))
+  else:
+    print("[{}/{}] {} FAILED: {}".format(done_count, total_count, basename(raw_filename), error), file=sys.stderr)
+
+def report_throughput(raw_filenames, failed, elapsed_time):
+  # Input size gives a rough idea of whether we're keeping the disks busy
+  input_bytes = 0
+  for raw_filename in raw_filenames:
+    try:
+      input_bytes += getsize(raw_filename)
+    except OSError:
+      pass
+
+  converted_count = len(raw_filenames) - len(failed)
+  elapsed_time = max(elapsed_time, 1e-9)
+  print("Processed {} of {} files in {:.2f}s ({:.2f} files/s, {:.1f} MB/s), {} failed".format(
+      converted_count,
+      len(raw_filenames),
+      elapsed_time,
+      converted_count / elapsed_time,
+      input_bytes / elapsed_time / 1e6,
+      len(failed)
+  ))
+
+def run(task, raw_filenames, task_args=(), task_kwargs=None, jobs=1, max_in_flight=None, on_result=None, cache=None,
+        profiler=None, roi=None):
+  """
+     Call task(raw_frame, *task_args, **task_kwargs) for every RAW file and return a list of
+     (raw_filename, error) tuples for the files that failed.
+
+     If on_result is given it is called in this process as on_result(raw_filename, result) as each file
+     finishes (in completion order), which is how per file results get collected or merged.
+
+     A failing file is reported and skipped, it never stops the rest of the batch.
+
+     With jobs > 1 the files are spread across a pool of worker processes (jobs=0 uses every core).  At most
+     max_in_flight files (default 2 * jobs) are submitted to the pool at any time, and each worker only holds
+     one decoded frame, so memory use stays bounded no matter how many files are in the batch.
+
+     cache is an optional rastro.extract.cache.PlaneCache every RawFrame is opened with.
+
+     profiler is an optional rastro.profiling.BatchProfile, which gets the stage times of every file that
+     succeeded.
+
+     roi is an optional region of interest (x0, y0, width, height) every RawFrame is cropped to.
+  """
+  if jobs == 0:
+    jobs = os.cpu_count() or 1
+  if max_in_flight is None:
+    max_in_flight = 2 * jobs
+
+  total_count = len(raw_filenames)
+  done_count = 0
+  failed = []
+  start_time = time.perf_counter()
+  profile = profiler is not None
+
+  def add_result(raw_filename, result, file_profile):
+    if on_result is not None:
+      on_result(raw_filename, result)
+    if profile:
+      profiler.add(raw_filename, file_profile)
+
+  if jobs <= 1:
+    for raw_filename in raw_filenames:
+      done_count += 1
+      try:
+        elapsed_time, result, file_profile = process_file(task, raw_filename, task_args, task_kwargs, cache, profile, roi)
+        add_result(raw_filename, result, file_profile)
+      except Exception as error:
+        failed.append((raw_filename, error))
+        report_progress(done_count, total_count, raw_filename, error=error)
+      else:
+        report_progress(done_count, total_count, raw_filename, elapsed_time)
+  else:
+    with process_pool(jobs) as executor:
+      pending = {}
+      raw_filename_iter = iter(raw_filenames)
+      while True:
+        # Keep the pool fed without queueing the whole batch up front
+        for raw_filename in raw_filename_iter:
+          future = executor.submit(process_file, task, raw_filename, task_args, task_kwargs, cache, profile, roi)
+          pending[future] = raw_filename
+          if len(pending) >= max_in_flight:
+            break
+
+        if not pending:
+          break
+
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          raw_filename = pending.pop(future)
+          done_count += 1
+          try:
+            elapsed_time, result, file_profile = future.result()
+            add_result(raw_filename, result, file_profile)
+          except Exception as error:
+            failed.append((raw_filename, error))
+            report_progress(done_count, total_count, raw_filename, error=error)
+          else:
+            report_progress(done_count, total_count, raw_filename, elapsed_time)
+
+  report_throughput(raw_filenames, failed, time.perf_counter() - start_time)
+
+  return failed
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""
+Apply master calibration frames (see rastro.calibrate.stack) to color planes during conversion.
+
+Masters are prepared once per batch: for every color plane the offset to subtract (the dark, or the bias when
+there is no dark) and the reciprocal of the normalized flat are computed up front and saved as native float32
+.npy files.  Every worker memory maps those, so the masters are shared through the page cache instead of being
+loaded and normalized again per worker or per frame.
+
+Per frame the arithmetic is done in place in a reusable float32 buffer per color plane, never in float64.  The
+buffers are per thread, so a pipelined batch (rastro.pipeline) can calibrate several frames at once.
+"""
+
+import contextlib
+import glob
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+from astropy.io import fits
+
+from rastro import profiling
+
+def read_master(master_prefix):
+  """
+    Load the <master_prefix>.<color plane>.fits files written by 'rastro stack' into a dictionary of float32
+    arrays keyed by color plane name.
+  """
+  master = {}
+  for fits_filename in glob.glob(glob.escape(master_prefix) + '.*.fits'):
+    color_plane_name = fits_filename[len(master_prefix) + 1:-len('.fits')]
+    # memmap so only the planes (not the whole file) are ever brought in, astype() gives native byte order
+    with fits.open(fits_filename, memmap=True) as hdul:
+      master[color_plane_name] = hdul[0].data.astype(np.float32)
+
+  if not master:
+    raise ValueError("No master frame files found matching [{}.<color plane>.fits]".format(master_prefix))
+
+  return master
+
+def prepare_masters(output_dir, bias_prefix=None, dark_prefix=None, flat_prefix=None):
+  """
+    Normalize the masters per color plane and save them to output_dir as <color plane>.offset.npy and
+    <color plane>.flat.npy (the reciprocal of the flat, so applying it is a multiply).
+
+    The dark master is assumed to still contain the bias (darks straight from the camera) and to match the
+    exposure of the lights, so only one of them is subtracted.  The flat has the bias removed when one is given
+    and is normalized to a median of 1.
+  """
+  bias = read_master(bias_prefix) if bias_prefix else None
+  dark = read_master(dark_prefix) if dark_prefix else None
+  flat = read_master(flat_prefix) if flat_prefix else None
+
+  masters = [master for master in (bias, dark, flat) if master is not None]
+  color_plane_names = sorted(masters[0])
+  for master in masters[1:]:
+    if sorted(master) != color_plane_names:
+      raise ValueError("Master frames have different color planes {} and {}".format(color_plane_names, sorted(master)))
+
+  history = []
+  if dark is not None:
+    history.append('Dark subtracted: ' + dark_prefix)
+  elif bias is not None:
+    history.append('Bias subtracted: ' + bias_prefix)
+  if flat is not None:
+    history.append('Flat fielded: ' + flat_prefix)
+
+  for color_plane_name in color_plane_names:
+    offset = dark[color_plane_name] if dark is not None else (bias[color_plane_name] if bias is not None else None)
+    if offset is not None:
+      np.save(os.path.join(output_dir, color_plane_name + '.offset.npy'), offset)
+
+    if flat is not None:
+      flat_field = flat[color_plane_name]
+      if bias is not None:
+        flat_field -= bias[color_plane_name]
+      flat_field /= np.median(flat_field)
+
+      # Dead flat pixels are left uncorrected rather than blown up to infinity
+      inverse_flat = np.ones_like(flat_field)
+      np.divide(1.0, flat_field, out=inverse_flat, where=flat_field > 0)
+      np.save(os.path.join(output_dir, color_plane_name + '.flat.npy'), inverse_flat)
+
+  with open(os.path.join(output_dir, 'history.txt'), 'w') as history_file:
+    history_file.write('\n'.join(history))
+
+@contextlib.contextmanager
+def prepared_masters(bias_prefix=None, dark_prefix=None, flat_prefix=None):
+  """Prepare the masters into a temporary directory which is removed when the batch is done."""
+  calibration_dir = tempfile.mkdtemp(prefix='rastro-calibration-')
+  try:
+    prepare_masters(calibration_dir, bias_prefix, dark_prefix, flat_prefix)
+    yield calibration_dir
+  finally:
+    shutil.rmtree(calibration_dir, ignore_errors=True)
+
+# Per process cache of memory mapped masters, so each worker loads them once per batch
+_calibrations = {}
+
+# Per thread float32 work buffers and integer output planes, keyed by calibration directory and then buffer name
+_thread_state = threading.local()
+
+def get_buffers(calibration_dir):
+  if not hasattr(_thread_state, 'buffers'):
+    _thread_state.buffers = {}
+  return _thread_state.buffers.setdefault(calibration_dir, {})
+
+def load_masters(calibration_dir):
+  if calibration_dir not in _calibrations:
+    masters = {}
+    for npy_filename in glob.glob(os.path.join(glob.escape(calibration_dir), '*.npy')):
+      color_plane_name, kind = os.path.basename(npy_filename).split('.')[:2]
+      masters.setdefault(color_plane_name, {})[kind] = np.load(npy_filename, mmap_mode='r')
+
+    with open(os.path.join(calibration_dir, 'history.txt')) as history_file:
+      history = history_file.read().splitlines()
+
+    _calibrations[calibration_dir] = (masters, history)
+  return _calibrations[calibration_dir]
+
+def crop_master(master_plane, roi):
+  """
+    View of the window of a full sensor master plane covering an aligned region of interest (x0, y0, width,
+    height on the sensor, see raw.align_roi()).  Aligned regions start on even sites, so every color plane's
+    window starts at half the origin.
+  """
+  x0, y0, width, height = roi
+  return master_plane[y0 // 2:y0 // 2 + height // 2, x0 // 2:x0 // 2 + width // 2]
+
+def calibrate_color_planes(color_planes, calibration_dir, output_dtype, roi=None, pedestal=0):
+  """
+    Subtract the offset and apply the flat to every color plane, replacing the planes in the color_planes
+    dictionary (the sensor data they were sliced from is never modified).  With an (aligned) region of interest
+    roi the planes only cover that region, and the same window of the full sensor masters is applied.
+
+    For integer output_dtype pedestal ADU are added to the result, which is then rounded and clipped to the range
+    of output_dtype, keeping the plane's dtype.  Dark or bias subtracted data scatters around 0, and without a
+    pedestal the clipping drops the negative half of the noise, biasing faint signal upwards.  For float output
+    the result is float32 and never offset or clipped.  Either way the new planes are buffers reused for the
+    next frame in the same thread, so write them out before calibrating another frame.  Returns the history
+    lines describing what was done.
+  """
+  masters, history = load_masters(calibration_dir)
+  buffers = get_buffers(calibration_dir)
+  integer_output = np.issubdtype(np.dtype(output_dtype), np.integer)
+
+  for color_plane_name in color_planes:
+    color_plane = color_planes[color_plane_name]['2D']
+    master = masters[color_plane_name]
+    if roi is not None:
+      master = dict((kind, crop_master(master_plane, roi)) for kind, master_plane in master.items())
+
+    for master_plane in master.values():
+      if master_plane.shape != color_plane.shape:
+        raise ValueError("{} master frame size {} doesn't match the image {}".format(
+            color_plane_name, master_plane.shape, color_plane.shape))
+
+    buffer = buffers.get(color_plane_name)
+    if buffer is None or buffer.shape != color_plane.shape:
+      buffer = buffers[color_plane_name] = np.empty(color_plane.shape, dtype=np.float32)
+
+    if 'offset' in master:
+      np.subtract(color_plane, master['offset'], out=buffer)
+    else:
+      np.copyto(buffer, color_plane)
+    if 'flat' in master:
+      np.multiply(buffer, master['flat'], out=buffer)
+
+    if integer_output:
+      if pedestal:
+        buffer += pedestal
+      # Clipped to what the output can hold, so the writer's cast can't wrap (e.g. 300 ADU in uint8 output)
+      np.clip(buffer, 0, min(np.iinfo(output_dtype).max, np.iinfo(color_plane.dtype).max), out=buffer)
+      np.rint(buffer, out=buffer)
+      integer_buffer_name = color_plane_name + '.integer'
+      integer_buffer = buffers.get(integer_buffer_name)
+      if integer_buffer is None or integer_buffer.shape != color_plane.shape or integer_buffer.dtype != color_plane.dtype:
+        integer_buffer = buffers[integer_buffer_name] = np.empty(color_plane.shape, dtype=color_plane.dtype)
+      np.copyto(integer_buffer, buffer, casting='unsafe')
+      color_planes[color_plane_name]['2D'] = integer_buffer
+    else:
+      color_planes[color_plane_name]['2D'] = buffer
+
+  if integer_output and pedestal:
+    return history + ['Pedestal added: {} ADU'.format(pedestal)]
+  return history
+
+def calibrated_writer(raw_frame, calibration_dir, output_dtype, pedestal, writer, *writer_args, **writer_kwargs):
+  """batch.run() task, calibrate raw_frame's color planes (see calibrate_color_planes()) and then hand it to writer."""
+  color_planes = raw_frame.color_planes
+  with profiling.stage('calibrate'):
+    raw_frame.history.extend(
+        calibrate_color_planes(color_planes, calibration_dir, output_dtype, raw_frame.roi, pedestal))
+  return writer(raw_frame, *writer_args, **writer_kwargs)
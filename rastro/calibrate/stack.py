@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+"""
+Master calibration frame (bias, dark, flat) stacking.
+
+Stacking works out of core in two phases:
+
+  1. Ingest: each RAW file's color planes are written into a memory mapped scratch array of shape
+     (frames, color planes, rows, cols).  Files are decoded in parallel by rastro.batch.
+  2. Combine: the scratch array is processed in bands of rows, each band holds every frame for those rows only,
+     and bands are spread across worker processes which write into a memory mapped output array.
+
+So neither the stack of frames nor the master itself ever has to fit in RAM.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from rastro import batch
+from rastro.convert import fits
+from rastro.extract import raw
+
+COMBINE_METHODS = ['mean', 'median', 'sigma_clip']
+
+# Peak bytes used by combine_band() per stacked value (the uint16 band included) and per master pixel, for each
+# method, as measured with tracemalloc and rounded up.  mean reduces straight into float32, median partitions a
+# uint16 copy, sigma_clip holds a float32 copy, a float32 work array and two masks (plus per pixel statistics).
+BAND_BYTES_PER_ELEMENT = {
+    'mean': (2, 8),
+    'median': (4, 12),
+    'sigma_clip': (12, 64),
+}
+
+# FITS IMAGETYP values, see https://diffractionlimited.com/help/maximdl/FITS_File_Header_Definitions.htm
+FRAME_TYPES = {
+    'bias': 'Bias Frame',
+    'dark': 'Dark Frame',
+    'flat': 'Flat Field',
+}
+
+def sigma_clipped_mean(band, sigma, iterations):
+  """
+    Mean along the first (frame) axis after iteratively rejecting values more than sigma standard deviations
+    from the median.
+
+    Besides the float32 copy of the band only one float32 and two boolean arrays of the band's size are used
+    (see BAND_BYTES_PER_ELEMENT): rejected values become NaN, which sorting in place moves to the end of each
+    pixel's frames, so the median is read off at the middle of the valid ones, and the standard deviation and
+    mean skip them with where= instead of the copies np.nanmedian() and np.nanstd() would make.
+  """
+  data = band.astype(np.float32)
+  deviation = np.empty_like(data)
+  valid = np.ones(data.shape, dtype=bool)
+  clipped = np.empty(data.shape, dtype=bool)
+  valid_counts = np.full(data.shape[1:], data.shape[0])
+
+  for _ in range(iterations):
+    data.sort(axis=0)
+    np.logical_not(np.isnan(data, out=clipped), out=valid)
+    valid.sum(axis=0, out=valid_counts)
+
+    lower = np.take_along_axis(data, ((valid_counts - 1) // 2)[np.newaxis], axis=0)[0]
+    upper = np.take_along_axis(data, (valid_counts // 2)[np.newaxis], axis=0)[0]
+    center = (lower + upper) / 2
+
+    mean = data.sum(axis=0, where=valid) / valid_counts
+    np.subtract(data, mean, out=deviation)
+    np.square(deviation, out=deviation)
+    spread = np.sqrt(deviation.sum(axis=0, where=valid) / valid_counts)
+
+    np.subtract(data, center, out=deviation)
+    np.abs(deviation, out=deviation)
+    # NaN compares False, so only values still in the stack can be clipped
+    np.greater(deviation, sigma * spread, out=clipped)
+    # With few frames (or sigma < 1) every value of a pixel can be out, e.g. both of two frames are exactly one
+    # std from their median.  Those pixels keep what they have rather than ending up with nothing to average.
+    emptied = clipped.sum(axis=0) >= valid_counts
+    clipped &= ~emptied
+    if not clipped.any():
+      break
+    data[clipped] = np.nan
+
+  np.logical_not(np.isnan(data, out=clipped), out=valid)
+  return data.sum(axis=0, where=valid) / valid.sum(axis=0)
+
+def combine(band, method, sigma=3.0, iterations=5):
+  """Combine a (frames, ...) array along the frame axis into a float32 array."""
+  if method == 'mean':
+    return band.mean(axis=0, dtype=np.float32)
+  elif method == 'median':
+    return np.median(band, axis=0).astype(np.float32)
+  elif method == 'sigma_clip':
+    return sigma_clipped_mean(band, sigma, iterations).astype(np.float32)
+  else:
+    raise ValueError("Unknown combine method [{}]".format(method))
+
+def ingest_frame(raw_frame, scratch_filename, frame_indexes, color_plane_names):
+  """batch.run() task, copy one frame's color planes into its slot of the scratch array."""
+  scratch = np.load(scratch_filename, mmap_mode='r+')
+  color_planes = raw_frame.color_planes
+
+  if sorted(color_planes) != sorted(color_plane_names):
+    raise ValueError("Color planes {} don't match the rest of the stack {}".format(list(color_planes), color_plane_names))
+
+  for i, color_plane_name in enumerate(color_plane_names):
+    color_plane = color_planes[color_plane_name]['2D']
+    if color_plane.shape != scratch.shape[2:]:
+      raise ValueError("Frame size {} doesn't match the rest of the stack {}".format(color_plane.shape, scratch.shape[2:]))
+    scratch[frame_indexes[raw_frame.filename], i] = color_plane
+
+  scratch.flush()
+
+def combine_band(scratch_filename, master_filename, frame_indexes, row_start, row_stop, method, sigma, iterations):
+  """Worker task, combine rows [row_start, row_stop) of every color plane of the frames in frame_indexes."""
+  scratch = np.load(scratch_filename, mmap_mode='r')
+  master = np.load(master_filename, mmap_mode='r+')
+
+  # Only this band of every frame is ever in memory
+  band = scratch[frame_indexes, :, row_start:row_stop, :]
+  master[:, row_start:row_stop, :] = combine(band, method, sigma, iterations)
+  master.flush()
+
+def get_band_rows(frame_count, color_plane_count, cols, memory_limit, method):
+  """Rows per band so that combining a band of every frame with method peaks within memory_limit bytes."""
+  element_bytes, pixel_bytes = BAND_BYTES_PER_ELEMENT[method]
+  row_bytes = color_plane_count * cols * (frame_count * element_bytes + pixel_bytes)
+  return max(1, int(memory_limit // row_bytes))
+
+def stack(raw_filenames, output_prefix, frame_type, method, rastro_command, VERSION,
+          sigma=3.0, iterations=5, jobs=1, memory_limit=256 * 2**20, scratch_dir=None, cache=None):
+  """
+    Combine raw_filenames into a master frame, written as one FITS file per color plane named
+    <output_prefix>.<color plane>.fits.  Returns the list of (raw_filename, error) for files which couldn't be
+    read, those are left out of the master.
+  """
+  if not raw_filenames:
+    raise ValueError("No frames to stack")
+  if sigma <= 0:
+    raise ValueError("The sigma_clip threshold has to be positive, got {}".format(sigma))
+  if jobs == 0:
+    jobs = os.cpu_count() or 1
+
+  # Every file gets its own slot in the scratch array, a file given twice would leave one of its slots empty
+  raw_filenames = list(dict.fromkeys(raw_filenames))
+
+  # The first frame defines the color planes and plane size, and provides the EXIF data for the header
+  with raw.RawFrame(raw_filenames[0], cache=cache) as raw_frame:
+    color_plane_names = list(raw_frame.color_planes)
+    rows, cols = raw_frame.color_planes[color_plane_names[0]]['2D'].shape
+    fits_headers = dict(
+        (color_plane_name, fits.exif_header(raw_frame.metadata, color_plane_name))
+        for color_plane_name in color_plane_names
+    )
+
+  scratch_dir = tempfile.mkdtemp(prefix='rastro-stack-', dir=scratch_dir)
+  try:
+    scratch_filename = os.path.join(scratch_dir, 'frames.npy')
+    master_filename = os.path.join(scratch_dir, 'master.npy')
+
+    frame_indexes = dict((raw_filename, i) for i, raw_filename in enumerate(raw_filenames))
+    np.lib.format.open_memmap(
+        scratch_filename,
+        mode='w+',
+        dtype=np.uint16,
+        shape=(len(raw_filenames), len(color_plane_names), rows, cols)
+    )
+    np.lib.format.open_memmap(
+        master_filename,
+        mode='w+',
+        dtype=np.float32,
+        shape=(len(color_plane_names), rows, cols)
+    )
+
+    print("Reading {} frames".format(len(raw_filenames)))
+    failed = batch.run(
+        ingest_frame,
+        raw_filenames,
+        task_args=(scratch_filename, frame_indexes, color_plane_names),
+        jobs=jobs,
+        cache=cache
+    )
+
+    # Frames which failed to read are simply left out of the combine
+    failed_filenames = set(raw_filename for raw_filename, error in failed)
+    good_indexes = [frame_indexes[raw_filename] for raw_filename in raw_filenames if raw_filename not in failed_filenames]
+    if not good_indexes:
+      raise ValueError("None of the frames could be read")
+
+    band_rows = get_band_rows(len(good_indexes), len(color_plane_names), cols, memory_limit, method)
+    bands = [(row_start, min(row_start + band_rows, rows)) for row_start in range(0, rows, band_rows)]
+
+    print("Combining {} frames ({}) in {} bands of {} rows".format(len(good_indexes), method, len(bands), band_rows))
+    start_time = time.perf_counter()
+    band_args = [
+        (scratch_filename, master_filename, good_indexes, row_start, row_stop, method, sigma, iterations)
+        for row_start, row_stop in bands
+    ]
+    if jobs <= 1:
+      for args in band_args:
+        combine_band(*args)
+    else:
+      with batch.process_pool(jobs) as executor:
+        # list() to surface any worker exceptions
+        list(executor.map(combine_band, *zip(*band_args)))
+    print("Combined in {:.2f}s".format(time.perf_counter() - start_time))
+
+    master = np.load(master_filename, mmap_mode='r')
+    for i, color_plane_name in enumerate(color_plane_names):
+      fits_header = fits_headers[color_plane_name]
+      fits_header['IMAGETYP'] = (FRAME_TYPES[frame_type], 'Type of image')
+      fits_header['NCOMBINE'] = (len(good_indexes), 'Number of frames combined')
+      fits_header['COMBINE'] = (method, 'Frame combine method')
+      if method == 'sigma_clip':
+        fits_header['CLIPSIG'] = (sigma, 'Sigma clipping threshold')
+
+      fits_filename = output_prefix + '.' + color_plane_name + '.fits'
+      fits.plane_writer(fits_filename, master[i], fits_header, rastro_command, VERSION)
+      print("Wrote {}".format(fits_filename))
+
+    # Let go of the memory map before the scratch directory is removed
+    del master
+  finally:
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+  return failed
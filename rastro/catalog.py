@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+"""
+rastro.catalog: SQLite catalog of RAW file headers, for finding frames without opening them.
+
+Only headers are read: EXIF through pyexiv2 (translated exactly like the FITS writers do, see
+fits.exif_header()) and the sensor sizes libraw reports when it opens a file.  The pixel data is never unpacked,
+except for the optional black levels, which libraw only knows after unpacking the sensor data.
+
+The catalog is updated incrementally, a file is only read again when its mtime or size changed.
+"""
+
+import os
+import sqlite3
+import sys
+
+from rastro import batch
+
+# Extensions picked up when walking directories, files named explicitly are always indexed
+RAW_EXTENSIONS = {
+    '.3fr', '.arw', '.cr2', '.cr3', '.crw', '.dng', '.erf', '.kdc', '.mef', '.mos', '.mrw', '.nef', '.nrw', '.orf',
+    '.pef', '.raf', '.raw', '.rw2', '.rwl', '.sr2', '.srf', '.srw', '.x3f'
+}
+
+# Header columns, named after the FITS keywords they correspond to where there is one
+COLUMNS = [
+    ('date_obs', 'TEXT'),
+    ('exptime', 'REAL'),
+    ('iso', 'INTEGER'),
+    ('instrume', 'TEXT'),
+    ('aperture', 'TEXT'),
+    ('raw_width', 'INTEGER'),
+    ('raw_height', 'INTEGER'),
+    ('width', 'INTEGER'),
+    ('height', 'INTEGER'),
+    ('top_margin', 'INTEGER'),
+    ('left_margin', 'INTEGER'),
+    ('color_desc', 'TEXT'),
+    ('black_levels', 'TEXT'),
+    ('white_level', 'INTEGER'),
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+  path TEXT PRIMARY KEY,
+  mtime REAL NOT NULL,
+  size INTEGER NOT NULL,
+  {columns}
+);
+CREATE INDEX IF NOT EXISTS frames_exposure ON frames (iso, exptime);
+CREATE INDEX IF NOT EXISTS frames_date_obs ON frames (date_obs);
+""".format(columns=',\n  '.join(name + ' ' + sql_type for name, sql_type in COLUMNS))
+
+# Rows are committed every so often so an interrupted scan of a large archive keeps most of its work
+COMMIT_INTERVAL = 100
+
+def connect(catalog_filename):
+  connection = sqlite3.connect(catalog_filename)
+  connection.executescript(SCHEMA)
+  return connection
+
+def find_raw_files(paths):
+  """Yield the absolute path of every RAW file in paths, walking directories recursively."""
+  for path in paths:
+    if os.path.isdir(path):
+      for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+          if os.path.splitext(filename)[1].lower() in RAW_EXTENSIONS:
+            yield os.path.abspath(os.path.join(dirpath, filename))
+    else:
+      yield os.path.abspath(path)
+
+def read_header(raw_frame, black_levels=False):
+  """
+    batch.run() task, return a dictionary of COLUMNS values for one file.  Only raw_frame.filename is used,
+    the file is opened header only rather than read into the RawFrame buffer.
+  """
+  # Imported here so the parent process, which only talks to SQLite, doesn't pay for them
+  import pyexiv2
+  import rawpy
+  from rastro.convert import fits
+
+  # exiv2 only reads the parts of the file holding metadata
+  metadata = pyexiv2.ImageMetadata(raw_frame.filename)
+  metadata.read()
+  fits_header = fits.exif_header(metadata, 'G')
+  header = {
+      'date_obs': fits_header['DATE-OBS'][0],
+      'exptime': fits_header['EXPTIME'][0],
+      'iso': fits_header['ISO'][0],
+      'instrume': fits_header['INSTRUME'][0],
+      'aperture': str(fits_header['APERTURE'][0]),
+  }
+
+  # open_file() only parses the headers, unpack() is what reads the sensor data
+  rawimage = rawpy.RawPy()
+  try:
+    rawimage.open_file(raw_frame.filename)
+    sizes = rawimage.sizes
+    header.update({
+        'raw_width': sizes.raw_width,
+        'raw_height': sizes.raw_height,
+        'width': sizes.width,
+        'height': sizes.height,
+        'top_margin': sizes.top_margin,
+        'left_margin': sizes.left_margin,
+        'color_desc': rawimage.color_desc.decode(),
+    })
+    if black_levels:
+      # These unpack the sensor data
+      header['black_levels'] = ','.join(str(level) for level in rawimage.black_level_per_channel)
+      header['white_level'] = rawimage.white_level
+  finally:
+    rawimage.close()
+
+  return header
+
+def update(catalog_filename, paths, black_levels=False, jobs=1):
+  """
+    Add new and changed RAW files under paths to the catalog and drop the ones that have disappeared.  Returns
+    the list of (raw_filename, error) for files whose headers couldn't be read, those are retried next time.
+  """
+  connection = connect(catalog_filename)
+  try:
+    known = dict(
+        (path, (mtime, size))
+        for path, mtime, size in connection.execute('SELECT path, mtime, size FROM frames')
+    )
+
+    stats = {}
+    for raw_filename in find_raw_files(paths):
+      try:
+        stat = os.stat(raw_filename)
+      except OSError as error:
+        print("Skipping {}: {}".format(raw_filename, error), file=sys.stderr)
+        continue
+      stats[raw_filename] = (stat.st_mtime, stat.st_size)
+
+    # Anything the walk of a directory didn't find again is gone
+    removed = []
+    for path in paths:
+      if os.path.isdir(path):
+        prefix = os.path.join(os.path.abspath(path), '')
+        removed.extend(known_path for known_path in known if known_path.startswith(prefix) and known_path not in stats)
+    connection.executemany('DELETE FROM frames WHERE path = ?', ((path,) for path in removed))
+
+    changed = [raw_filename for raw_filename, stat in stats.items() if known.get(raw_filename) != stat]
+    print("{} files found, {} new or changed, {} removed".format(len(stats), len(changed), len(removed)))
+
+    column_names = [name for name, sql_type in COLUMNS]
+    insert = 'INSERT OR REPLACE INTO frames (path, mtime, size, {}) VALUES ({})'.format(
+        ', '.join(column_names),
+        ', '.join(['?'] * (len(column_names) + 3))
+    )
+    inserted = []
+
+    def store_header(raw_filename, header):
+      mtime, size = stats[raw_filename]
+      connection.execute(insert, [raw_filename, mtime, size] + [header.get(name) for name in column_names])
+      inserted.append(raw_filename)
+      if len(inserted) % COMMIT_INTERVAL == 0:
+        connection.commit()
+
+    failed = []
+    if changed:
+      failed = batch.run(read_header, changed, task_kwargs={'black_levels': black_levels}, jobs=jobs, on_result=store_header)
+    connection.commit()
+  finally:
+    connection.close()
+
+  return failed
+
+def query(catalog_filename, exptime=None, iso=None, instrume=None, date_from=None, date_to=None, path=None):
+  """
+    Return the catalog rows (as dictionaries, ordered by date_obs) matching every given filter.  exptime matches
+    within 0.5% (EXIF exposure times are rationals), instrume and path match substrings, date_from/date_to are
+    inclusive bounds on the ISO 8601 UTC DATE-OBS.
+  """
+  conditions = []
+  parameters = []
+  if exptime is not None:
+    conditions.append('exptime BETWEEN ? AND ?')
+    parameters.extend([exptime * 0.995, exptime * 1.005])
+  if iso is not None:
+    conditions.append('iso = ?')
+    parameters.append(iso)
+  if instrume is not None:
+    conditions.append('instrume LIKE ?')
+    parameters.append('%' + instrume + '%')
+  if date_from is not None:
+    conditions.append('date_obs >= ?')
+    parameters.append(date_from)
+  if date_to is not None:
+    # A bare date includes the whole day
+    conditions.append('date_obs <= ?')
+    parameters.append(date_to + 'T23:59:59.999999' if len(date_to) == 10 else date_to)
+  if path is not None:
+    conditions.append('path LIKE ?')
+    parameters.append('%' + path + '%')
+
+  sql = 'SELECT * FROM frames'
+  if conditions:
+    sql += ' WHERE ' + ' AND '.join(conditions)
+  sql += ' ORDER BY date_obs, path'
+
+  connection = connect(catalog_filename)
+  try:
+    connection.row_factory = sqlite3.Row
+    return [dict(row) for row in connection.execute(sql, parameters)]
+  finally:
+    connection.close()
+
+def print_frames(frames, paths_only=False):
+  """Print query results, either just the paths (to feed other rastro commands) or a summary line per frame."""
+  for frame in frames:
+    if paths_only:
+      print(frame['path'])
+    else:
+      print("{}\t{}\t{}s\tISO {}\t{}\t{}x{}".format(
+          frame['path'],
+          frame['date_obs'],
+          frame['exptime'],
+          frame['iso'],
+          frame['instrume'],
+          frame['width'],
+          frame['height']
+      ))
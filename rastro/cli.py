@@ -3,15 +3,93 @@
 """rastro.cli: provides entry point main()."""
 
 import argparse
+import contextlib
 import sys
-from os.path import basename
+from os.path import basename, isdir
 from . import __version__ as VERSION
 
-# Import our libraries
-#from rastro.extract import raw, exif
-from rastro.extract import raw
-from rastro.convert import tiff, fits
-from rastro.analyze import histogram, stats, rawpixels
+# Our libraries pull in heavy dependencies (rawpy, numba, astropy, tifffile, matplotlib), so they are imported
+# by each command when it is dispatched rather than here.  This keeps --version, --help and scripts calling
+# rastro once per file from paying for modules they never use.  See benchmarks/startup.py.
+
+def add_cache_arguments(parser):
+  parser.add_argument(
+      '--cache_dir',
+      type=str,
+      help='Keep decoded sensor data in this directory and reuse it when the same files are processed again',
+      default=None
+  )
+  parser.add_argument(
+      '--cache_size',
+      type=int,
+      help='Maximum size of the --cache_dir cache in MB, least recently used files are evicted first',
+      default=4096
+  )
+
+def add_profile_arguments(parser):
+  parser.add_argument(
+      '--profile',
+      type=str,
+      help='Time every stage (read, decode, encode, write...) of every file and write a summary, JSON for .json filenames otherwise CSV',
+      default=None
+  )
+
+def parse_roi(value):
+  """argparse type for --roi x0,y0,width,height"""
+  try:
+    roi = tuple(int(part) for part in value.split(','))
+  except ValueError:
+    roi = ()
+  if len(roi) != 4 or roi[0] < 0 or roi[1] < 0 or roi[2] <= 0 or roi[3] <= 0:
+    raise argparse.ArgumentTypeError("expected x0,y0,width,height with a positive width and height, got [{}]".format(value))
+  return roi
+
+def parse_star(value):
+  """argparse type for --target / --comparison NAME,X,Y"""
+  parts = value.split(',')
+  try:
+    if len(parts) != 3 or not parts[0]:
+      raise ValueError
+    return parts[0], float(parts[1]), float(parts[2])
+  except ValueError:
+    raise argparse.ArgumentTypeError("expected NAME,X,Y in visible sensor pixels, got [{}]".format(value))
+
+def parse_annulus(value):
+  """argparse type for --annulus INNER,OUTER"""
+  try:
+    annulus = tuple(float(part) for part in value.split(','))
+  except ValueError:
+    annulus = ()
+  if len(annulus) != 2:
+    raise argparse.ArgumentTypeError("expected INNER,OUTER radii, got [{}]".format(value))
+  return annulus
+
+def add_roi_arguments(parser):
+  parser.add_argument(
+      '--roi',
+      type=parse_roi,
+      help='Only extract, analyze and write the region x0,y0,width,height of the visible sensor (aligned to the CFA pattern)',
+      default=None
+  )
+
+def add_pipeline_arguments(parser):
+  parser.add_argument(
+      '--pipeline',
+      action='store_true',
+      help='Overlap reading, decoding and encoding/writing of different files in one process (instead of --jobs)'
+  )
+  parser.add_argument(
+      '--pipeline_threads',
+      type=int,
+      help='With --pipeline, number of threads encoding and writing output files',
+      default=2
+  )
+  parser.add_argument(
+      '--prefetch',
+      type=int,
+      help='With --pipeline, number of files read ahead of the decoder',
+      default=2
+  )
 
 def main():
   # Used the following guides to organize this python project
@@ -57,12 +135,12 @@ def main():
      e. Add tags to indicate image type (light, dark, flat, bias, etc...).  Is there a standard for this?
      f. Use local Astrometry.net installation to plate solve (should be easy to test on Ubuntu)
   6. Have some math fun with color planes.
-     a. Output averaged green plane (g1 + g2)/2 like rawtran "Gi" plane.
+     a. Output averaged green plane (g1 + g2)/2 like rawtran "Gi" plane.  (done, Gi)
      b. Mess around with different interpolation methods to create a full resolution interpolated Green 
         frame from g1 and g2.  Could also use red and blue planes to increase interpolation accuracy.  
         I don't think this type of output would be useful for photometry, but it might be helpful for 
-        finding small image details.  Plus, why waste that nice extra green data!
-  7. Add memory saving options like memory mapped files so that very large images can be processed
+        finding small image details.  Plus, why waste that nice extra green data!  (bilinear done, Gfull)
+  7. Add memory saving options like memory mapped files so that very large images can be processed  (done, --memmap)
   
   Stretch Goals:
   1. Build easy to use binaries for different platforms using:
@@ -79,6 +157,7 @@ def main():
   #    a. Yuck, this is harder than I thought: https://www.libraw.org/node/2205
   # 2. Profile python scripts using pyinstrument
   #    a. eg. pyinstrument /opt/rawconvert/raw_analyze.py 20200310_0065.cr2
+  #    b. --profile gives a per stage breakdown of a whole batch without a profiler
   
   # Set some variables
   # Default bit RAW image bit depth
@@ -117,7 +196,8 @@ def main():
   )
  
   # Add subcommands for different image types
-  parser_tiff = convert_commands.add_parser('tiff', help='Export in TIFF format')
+  # The format options are defined once as parent parsers and shared by 'convert' and 'watch'
+  parser_tiff = argparse.ArgumentParser(add_help=False)
   # TODO: ensure RGB image output must be in uint8
   parser_tiff.add_argument(
       '--bit_depth_type',
@@ -136,17 +216,220 @@ def main():
       action='store_true',
       help='Create uninterpolated 16bit RGB TIFF similar to <dcraw -h -T>',
   )
+  parser_tiff.add_argument(
+      '--green_plane',
+      type=str,
+      help='Export just a green plane: Gi (average of G1 and G2) or Gfull (full resolution interpolated green)',
+      choices=['Gi', 'Gfull'],
+      default=None
+  )
+  parser_tiff.add_argument(
+      '--codec',
+      type=str,
+      help='Lossless TIFF compression, lzw and zstd need imagecodecs (see --benchmark_codecs)',
+      choices=['none', 'deflate', 'lzw', 'zstd'],
+      default='deflate'
+  )
+  parser_tiff.add_argument(
+      '--level',
+      type=int,
+      help='Compression level of deflate (default 6) or zstd',
+      default=None
+  )
+  parser_tiff.add_argument(
+      '--tile',
+      type=int,
+      help='Write square tiles of this many pixels (a multiple of 16) instead of strips',
+      default=None
+  )
+  parser_tiff.add_argument(
+      '--compress_threads',
+      type=int,
+      help='Threads compressing the tiles or strips of each file (0 lets tifffile decide, use 1 with --jobs)',
+      default=0
+  )
+  parser_tiff.add_argument(
+      '--predictor',
+      action='store_true',
+      help='Horizontal differencing before compression, usually smaller 16 bit files'
+  )
+  parser_tiff.add_argument(
+      '--jobs',
+      type=int,
+      help='Number of worker processes to convert files with (0 uses all cores)',
+      default=1
+  )
   
   # Add FITS subcommand
-  parser_fits = convert_commands.add_parser('fits', help='Export in FITS format')
+  parser_fits = argparse.ArgumentParser(add_help=False)
   
   parser_fits.add_argument(
       '--color_plane_name',
       type=str,
-      help='Single color plane/channel to export in FITS format',
-      choices=['R', 'G1', 'G2', 'B'],
+      help='Single color plane/channel to export in FITS format, Gi is the average of G1 and G2 and Gfull the full resolution interpolated green',
+      choices=['R', 'G1', 'G2', 'B', 'Gi', 'Gfull'],
       default='G1'
   )
+  parser_fits.add_argument(
+      '--all_planes',
+      action='store_true',
+      help='Export every color plane from one decode, as image extensions of a single <RAW>.fits file'
+  )
+  parser_fits.add_argument(
+      '--average_green',
+      action='store_true',
+      help='With --all_planes, also export the average of G1 and G2 as a Gi plane'
+  )
+  parser_fits.add_argument(
+      '--interpolated_green',
+      action='store_true',
+      help='With --all_planes, also export the full resolution interpolated green as a Gfull plane'
+  )
+  parser_fits.add_argument(
+      '--separate_files',
+      action='store_true',
+      help='With --all_planes, write each plane to its own <RAW>.<color plane>.fits instead of one multi extension file'
+  )
+  parser_fits.add_argument(
+      '--compression',
+      type=str,
+      help='Lossless tile compression (RICE is integer data only, see benchmarks/fits_compression.py)',
+      choices=['rice', 'gzip', 'gzip2'],
+      default=None
+  )
+  parser_fits.add_argument(
+      '--jobs',
+      type=int,
+      help='Number of worker processes to convert files with (0 uses all cores)',
+      default=1
+  )
+
+  # Options shared by the conversion subcommands
+  for parser_format in (parser_tiff, parser_fits):
+    parser_format.add_argument(
+        '--memmap',
+        action='store_true',
+        help='Preallocate uncompressed output files and fill them through a memory map (lowest memory use)'
+    )
+    parser_format.add_argument(
+        '--bias',
+        type=str,
+        help='Master bias prefix (<BIAS>.<color plane>.fits as written by rastro stack), subtracted when there is no dark',
+        default=None
+    )
+    parser_format.add_argument(
+        '--dark',
+        type=str,
+        help='Master dark prefix, subtracted from each color plane (should match the exposure and include the bias)',
+        default=None
+    )
+    parser_format.add_argument(
+        '--flat',
+        type=str,
+        help='Master flat prefix, each color plane is divided by the normalized flat',
+        default=None
+    )
+    parser_format.add_argument(
+        '--pedestal',
+        type=int,
+        help='ADU added to calibrated planes written as integers (TIFF), which are otherwise clipped at 0 and lose the negative half of the noise (FITS is float32 and never clipped)',
+        default=0
+    )
+    add_cache_arguments(parser_format)
+    add_profile_arguments(parser_format)
+    add_roi_arguments(parser_format)
+
+  parser_convert_tiff = convert_commands.add_parser('tiff', parents=[parser_tiff], help='Export in TIFF format')
+  parser_convert_fits = convert_commands.add_parser('fits', parents=[parser_fits], help='Export in FITS format')
+  # Pipelining only applies to a batch of files, not watch
+  for parser_convert_format in (parser_convert_tiff, parser_convert_fits):
+    add_pipeline_arguments(parser_convert_format)
+  parser_convert_tiff.add_argument(
+      '--benchmark_codecs',
+      action='store_true',
+      help='Instead of converting, report the size and write speed of every codec and level on the first file'
+  )
+
+  # Add archive subcommand, lossless bit packed sensor data any command can read in place of the RAW file
+  parser_archive = convert_commands.add_parser('archive', help='Archive the sensor data as a rastro CFA archive (.rcfa)')
+  parser_archive.add_argument(
+      '--codec',
+      type=str,
+      help='Compression of the bit packed tiles, zstd is smaller and faster to read but needs zstandard',
+      choices=['zlib', 'zstd'],
+      default='zlib'
+  )
+  parser_archive.add_argument(
+      '--level',
+      type=int,
+      help='Compression level (default 9 for zstd, 6 for zlib)',
+      default=None
+  )
+  parser_archive.add_argument(
+      '--tile',
+      type=int,
+      help='Side of the independently compressed square tiles, in color plane pixels',
+      default=512
+  )
+  parser_archive.add_argument(
+      '--jobs',
+      type=int,
+      help='Number of worker processes to archive files with (0 uses all cores)',
+      default=1
+  )
+  add_cache_arguments(parser_archive)
+  add_profile_arguments(parser_archive)
+  add_pipeline_arguments(parser_archive)
+  # Archives always hold the whole, uncalibrated visible sensor
+  parser_archive.set_defaults(roi=None, bias=None, dark=None, flat=None)
+
+  # Add command for converting frames as they are written to a directory (e.g. tethered capture)
+  parser_watch = commands.add_parser('watch', help='Convert and check RAW files as they land in a directory')
+
+  # Enable watch subcommands, same formats and options as convert plus stats only
+  watch_commands = parser_watch.add_subparsers(
+      title='watch_commands',
+      description='valid watch commands',
+      help='Watch Command help',
+      dest='convert_command'
+  )
+
+  parser_watch_options = argparse.ArgumentParser(add_help=False)
+  parser_watch_options.add_argument(
+      '--poll_interval',
+      type=float,
+      help='Seconds between directory scans',
+      default=0.5
+  )
+  parser_watch_options.add_argument(
+      '--settle_time',
+      type=float,
+      help='Seconds a file size has to stay the same before the file counts as finished',
+      default=1.0
+  )
+  parser_watch_options.add_argument(
+      '--process_existing',
+      action='store_true',
+      help='Also process the RAW files already in the directory when watching starts'
+  )
+  parser_watch_options.add_argument(
+      '--idle_timeout',
+      type=float,
+      help='Stop after this many seconds without a new file (default: watch until interrupted)',
+      default=None
+  )
+
+  watch_commands.add_parser('tiff', parents=[parser_tiff, parser_watch_options], help='Export in TIFF format')
+  watch_commands.add_parser('fits', parents=[parser_fits, parser_watch_options], help='Export in FITS format')
+  parser_watch_stats = watch_commands.add_parser('stats', parents=[parser_watch_options], help='Only report quick stats')
+  parser_watch_stats.add_argument(
+      '--jobs',
+      type=int,
+      help='Number of worker processes to check files with (0 uses all cores)',
+      default=1
+  )
+  add_cache_arguments(parser_watch_stats)
+  add_roi_arguments(parser_watch_stats)
 
   # Add command for analysis tasks
   parser_analyze = commands.add_parser('analyze', help='Analyze RAW image data')
@@ -164,11 +447,42 @@ def main():
   parser_histogram.add_argument('--raw_bit_depth', type=int, help='Bit depth of original RAW image', default=raw_bit_depth)
   parser_histogram.add_argument('--bins', type=int, help='Number of bins to divide histogram into', default=256)
   # bins will be scaled to be equal to range if a range that is smaller than bins is selected
-  parser_histogram.add_argument('--range_max', type=int, help='Maximum value to represent on histogram', default=raw_bit_depth)
+  parser_histogram.add_argument('--range_max', type=int, help='Maximum value to represent on histogram (default 2^raw_bit_depth - 1)', default=None)
   parser_histogram.add_argument('--range_min', type=int, help='Minimum value to represent on histogram', default=0)
+  # Headless batch mode, any --export switches off the interactive plot
+  parser_histogram.add_argument(
+      '--export',
+      action='append',
+      help='Write histograms to files instead of plotting them, may be given more than once',
+      choices=['csv', 'npz', 'png']
+  )
+  parser_histogram.add_argument(
+      '--summary',
+      type=str,
+      help='Merge all files into a single exported histogram named <SUMMARY>.<format> (PNG overlays every frame)',
+      default=None
+  )
+  parser_histogram.add_argument(
+      '--jobs',
+      type=int,
+      help='Number of worker processes to compute histograms with (0 uses all cores)',
+      default=1
+  )
 
   # Add stats subcommand
   parser_stats = analyze_commands.add_parser('stats', help='Output basic stats of RAW image data')
+  parser_stats.add_argument(
+      '--summary',
+      type=str,
+      help='Summarize every file instead, one row per frame and plane written as CSV, JSON lines or Parquet (by extension)',
+      default=None
+  )
+  parser_stats.add_argument(
+      '--jobs',
+      type=int,
+      help='Number of worker processes to summarize files with (0 uses all cores)',
+      default=1
+  )
 
   # Add rawpixels subcommand
   parser_rawpixels = analyze_commands.add_parser('rawpixels', help='Try to determine hot/bad pixels in one or more RAW image files')
@@ -176,8 +490,205 @@ def main():
   # Process rawpixel enhancement args
   #parser_rawpixels.add_argument('--hot_pixel_file', nargs=1, help='Hot pixel filename', type=str)
   #parser_rawpixels.add_argument('--dead_pixel_file', nargs=1, help='Dead pixel filename', type=str)
-  parser_rawpixels.add_argument('--hot_pixel_file', help='Hot pixel filename', type=str)
-  parser_rawpixels.add_argument('--dead_pixel_file', help='Dead pixel filename', type=str)
+  parser_rawpixels.add_argument(
+      '--hot_pixel_file',
+      type=str,
+      help='Hot pixel filename, dcraw -P format in visible sensor coordinates (margins cut off, unrotated)'
+  )
+  parser_rawpixels.add_argument('--dead_pixel_file', help='Dead pixel filename, same format as --hot_pixel_file', type=str)
+  parser_rawpixels.add_argument(
+      '--mask_file',
+      type=str,
+      help='Also write a bad pixel mask, NPZ for .npz filenames otherwise FITS (1 = hot, 2 = dead)'
+  )
+  parser_rawpixels.add_argument(
+      '--confirm_ratio',
+      type=float,
+      help='Fraction of the files a pixel has to be flagged in to be reported',
+      default=1.0
+  )
+  parser_rawpixels.add_argument(
+      '--threshold',
+      type=int,
+      help='ADU difference from the same color neighborhood median (default max(max ADU / 150, 20) per file)',
+      default=None
+  )
+  parser_rawpixels.add_argument(
+      '--jobs',
+      type=int,
+      help='Number of worker processes to analyze files with (0 uses all cores)',
+      default=1
+  )
+
+  # Add photometry subcommand
+  parser_photometry = analyze_commands.add_parser('photometry', help='Aperture photometry of target and comparison stars straight from RAW files')
+  parser_photometry.add_argument(
+      '--target',
+      type=parse_star,
+      action='append',
+      help='Target star as NAME,X,Y in visible sensor pixels, may be given more than once',
+      default=[]
+  )
+  parser_photometry.add_argument(
+      '--comparison',
+      type=parse_star,
+      action='append',
+      help='Comparison star as NAME,X,Y in visible sensor pixels, may be given more than once',
+      default=[]
+  )
+  parser_photometry.add_argument(
+      '--stars',
+      type=str,
+      help='File listing stars, one "<target|comparison> NAME X Y" per line',
+      default=None
+  )
+  parser_photometry.add_argument(
+      '--color_planes',
+      type=str,
+      help='Comma separated color planes to measure',
+      default='G1,G2'
+  )
+  parser_photometry.add_argument('--aperture', type=float, help='Aperture radius in color plane pixels', default=4.0)
+  parser_photometry.add_argument(
+      '--annulus',
+      type=parse_annulus,
+      help='Sky annulus INNER,OUTER radii in color plane pixels',
+      default='8,12'
+  )
+  parser_photometry.add_argument(
+      '--centroid_box',
+      type=int,
+      help='Recenter within this many color plane pixels of each position (0 keeps the positions as given)',
+      default=3
+  )
+  parser_photometry.add_argument('--gain', type=float, help='Camera gain in e-/ADU, for the flux errors', default=1.0)
+  parser_photometry.add_argument('--output', type=str, help='Light curve CSV file', default='lightcurve.csv')
+  parser_photometry.add_argument(
+      '--jobs',
+      type=int,
+      help='Number of worker processes to measure files with (0 uses all cores)',
+      default=1
+  )
+
+  # Add command for combining calibration frames
+  parser_stack = commands.add_parser('stack', help='Combine bias/dark/flat frames into a master calibration frame')
+  parser_stack.add_argument(
+      '--frame_type',
+      type=str,
+      help='Type of calibration frames being combined',
+      choices=['bias', 'dark', 'flat'],
+      default='dark'
+  )
+  parser_stack.add_argument(
+      '--method',
+      type=str,
+      help='How to combine the frames',
+      choices=['mean', 'median', 'sigma_clip'],
+      default='median'
+  )
+  parser_stack.add_argument('--sigma', type=float, help='Rejection threshold for sigma_clip', default=3.0)
+  parser_stack.add_argument('--sigma_iters', type=int, help='Maximum rejection iterations for sigma_clip', default=5)
+  parser_stack.add_argument(
+      '--output',
+      type=str,
+      help='Output prefix, one <OUTPUT>.<color plane>.fits file is written per color plane (default master_<frame_type>)',
+      default=None
+  )
+  parser_stack.add_argument(
+      '--jobs',
+      type=int,
+      help='Number of worker processes to read and combine with (0 uses all cores)',
+      default=1
+  )
+  parser_stack.add_argument(
+      '--memory_limit',
+      type=int,
+      help='Peak memory per worker for combining each band of rows (the combine method is accounted for), in MB',
+      default=256
+  )
+  parser_stack.add_argument(
+      '--scratch_dir',
+      type=str,
+      help='Directory for the temporary memory mapped frame stack (default system temp directory)',
+      default=None
+  )
+
+  # Add command for quick look previews
+  parser_preview = commands.add_parser(
+      'preview',
+      help='Write <raw>.preview.jpg quick looks (embedded camera thumbnail when there is one), or one contact sheet',
+      description='Quick looks from the embedded camera thumbnail take well under 100 ms per frame.  Files without '
+                  'one (or with --no_thumbnail or a region of interest) are built from the sensor data, which has to '
+                  'be unpacked first and takes a few hundred ms per frame, use --jobs for those.'
+  )
+  parser_preview.add_argument('--size', type=int, help='Longest side of each preview in pixels', default=1024)
+  parser_preview.add_argument(
+      '--contact_sheet',
+      type=str,
+      help='Write a single contact sheet JPEG of every file to this filename instead of a preview per file',
+      default=None
+  )
+  parser_preview.add_argument('--columns', type=int, help='Contact sheet tiles per row', default=8)
+  parser_preview.add_argument('--tile_size', type=int, help='Longest side of each contact sheet tile in pixels', default=256)
+  parser_preview.add_argument(
+      '--no_thumbnail',
+      action='store_true',
+      help='Always build previews from the sensor data, ignoring the embedded camera thumbnail (several times slower)'
+  )
+  parser_preview.add_argument('--quality', type=int, help='JPEG quality', default=90)
+  parser_preview.add_argument(
+      '--jobs',
+      type=int,
+      help='Number of worker processes to build previews with (0 uses all cores)',
+      default=1
+  )
+
+  # Decoded sensor data cache, for the commands that decode RAW files
+  for parser_decode in (parser_stats, parser_histogram, parser_rawpixels, parser_photometry, parser_stack, parser_preview):
+    add_cache_arguments(parser_decode)
+
+  # Per stage timing, for the commands running a batch.run() task per file
+  for parser_batch in (parser_stats, parser_histogram, parser_rawpixels, parser_photometry, parser_preview):
+    add_profile_arguments(parser_batch)
+
+  for parser_region in (parser_stats, parser_histogram, parser_photometry, parser_preview):
+    add_roi_arguments(parser_region)
+
+  # Add command for the header catalog
+  parser_index = commands.add_parser('index', help='Catalog RAW file headers in SQLite and query them')
+
+  # Enable catalog subcommands
+  index_commands = parser_index.add_subparsers(
+      title='index_commands',
+      description='valid catalog commands',
+      help='Index Command help',
+      dest='index_command'
+  )
+
+  parser_update = index_commands.add_parser('update', help='Add new and changed RAW files (or directories of them) to the catalog')
+  parser_update.add_argument(
+      '--black_levels',
+      action='store_true',
+      help='Also record black and white levels (libraw has to unpack the sensor data for these, much slower)'
+  )
+  parser_update.add_argument(
+      '--jobs',
+      type=int,
+      help='Number of worker processes to read headers with (0 uses all cores)',
+      default=1
+  )
+
+  parser_query = index_commands.add_parser('query', help='List cataloged frames matching every given filter')
+  parser_query.add_argument('--exptime', type=float, help='Exposure time in seconds', default=None)
+  parser_query.add_argument('--iso', type=int, help='ISO speed', default=None)
+  parser_query.add_argument('--instrume', type=str, help='Camera model, matches any part of it (e.g. 40D)', default=None)
+  parser_query.add_argument('--date_from', type=str, help='Earliest DATE-OBS (UTC), e.g. 2020-03-10 or 2020-03-10T20:00', default=None)
+  parser_query.add_argument('--date_to', type=str, help='Latest DATE-OBS (UTC), a bare date includes the whole day', default=None)
+  parser_query.add_argument('--path', type=str, help='Matches any part of the file path', default=None)
+  parser_query.add_argument('--paths_only', action='store_true', help='Only print the file paths, one per line')
+
+  for parser_catalog in (parser_update, parser_query):
+    parser_catalog.add_argument('--catalog', type=str, help='SQLite catalog file', default='rastro_catalog.sqlite')
 
   # Add argument for our input file(s)
   #parser.add_argument('raw_filenames', help='Raw Filename(s) for processing', nargs=argparse.REMAINDER, type=str)
@@ -192,75 +703,220 @@ def main():
   #print("unknown :", unknown)
   #print("raw_filenames :", raw_filenames)
 
+  plane_cache = None
+  if getattr(args, 'cache_dir', None):
+    from rastro.extract import cache
+
+    plane_cache = cache.PlaneCache(args.cache_dir, args.cache_size * 2**20)
+
+  if getattr(args, 'pipeline', False) and args.jobs != 1:
+    parser.error('--pipeline overlaps the stages in a single process, use it without --jobs')
+
+  profiler = None
+  if getattr(args, 'profile', None):
+    from rastro import profiling
+
+    profiler = profiling.BatchProfile()
+
+  if args.command == 'analyze' and args.analyze_command == 'stats' and args.summary:
+    from rastro.analyze import stats
+
+    # Unknown extensions and missing pyarrow are reported before any file is read
+    try:
+      if stats.get_summary_format(args.summary) == 'parquet':
+        stats.import_parquet()
+    except ValueError as error:
+      parser.error(str(error))
 
-  if args.command == 'analyze' and args.analyze_command == 'stats':
-    # TODO: pop an error if trying to run basic stats on more than one file.
-    #      OR, we could fall back to a summarization mode?
-    stats.output_basic_stats(raw_filenames[0])
+    # Every file, in parallel with --jobs
+    failed = stats.summarize_frames(
+        raw_filenames,
+        args.summary,
+        jobs=args.jobs,
+        cache=plane_cache,
+        profiler=profiler,
+        roi=args.roi
+    )
+    if profiler is not None:
+      profiler.write(args.profile)
+    if failed:
+      sys.exit(1)
+  elif args.command == 'analyze' and args.analyze_command == 'stats':
+    from rastro.extract import raw
+    from rastro.analyze import stats
+
+    if not raw_filenames:
+      parser.error('analyze stats needs a RAW file')
+    if profiler is not None:
+      parser.error('--profile times every file of a batch, use it with --summary')
+
+    # TODO: pop an error if trying to run basic stats on more than one file (--summary handles many files)
+    with raw.RawFrame(raw_filenames[0], cache=plane_cache, roi=args.roi) as raw_frame:
+      stats.output_basic_stats(raw_frame)
   elif args.command == 'analyze' and args.analyze_command == 'rawpixels':
+    from rastro.analyze import rawpixels
+
     # Note that this function takes one or more RAW files.  The more the better for analysis.
-    # TODO: Pass hot/dead pixel files as named arguments.  If no output files are provided, 
-    # simply output pixel list to STDOUT
-    rawpixels.enhance_rawpixels(args.hot_pixel_file, args.dead_pixel_file, raw_filenames)
-  else:
-    # Extract color planes from RAW file
-    #color_planes = raw.reader(raw_filenames[0])
-    pass
+    # If no output files are provided the pixel lists go to STDOUT
+    try:
+      failed = rawpixels.enhance_rawpixels(
+          args.hot_pixel_file,
+          args.dead_pixel_file,
+          raw_filenames,
+          confirm_ratio=args.confirm_ratio,
+          threshold=args.threshold,
+          mask_file=args.mask_file,
+          jobs=args.jobs,
+          cache=plane_cache,
+          profiler=profiler
+      )
+    except ValueError as error:
+      # Frames from different cameras (or crop modes) can't be compared pixel for pixel
+      parser.error(str(error))
+    if profiler is not None:
+      profiler.write(args.profile)
+    if failed:
+      sys.exit(1)
+
+  elif args.command == 'analyze' and args.analyze_command == 'photometry':
+    from rastro.analyze import photometry
+
+    annulus_inner, annulus_outer = args.annulus
+    try:
+      stars = photometry.read_star_file(args.stars) if args.stars else []
+      for role, star_args in (('target', args.target), ('comparison', args.comparison)):
+        for name, x, y in star_args:
+          stars.append((role, name, x, y))
+      photometry.check_options(stars, args.aperture, annulus_inner, annulus_outer)
+    except (OSError, ValueError) as error:
+      parser.error(str(error))
+
+    failed = photometry.light_curve(
+        raw_filenames,
+        stars,
+        args.output,
+        color_plane_names=args.color_planes.split(','),
+        aperture_radius=args.aperture,
+        annulus_inner=annulus_inner,
+        annulus_outer=annulus_outer,
+        box_radius=args.centroid_box,
+        gain=args.gain,
+        jobs=args.jobs,
+        cache=plane_cache,
+        profiler=profiler,
+        roi=args.roi
+    )
+    if profiler is not None:
+      profiler.write(args.profile)
+    if failed:
+      sys.exit(1)
 
   # Write output
-  if args.command == 'convert':
+  # Each RAW file is read and decoded once, the writers share the RawFrame's EXIF data and color plane views.
+  # batch.run() opens the RawFrame for each file, in a pool of worker processes when --jobs is used.
+  # watch runs the same writers on each file as it lands in a directory instead.
+  if args.command in ('convert', 'watch'):
+    from rastro import batch
+
+    if args.command == 'watch':
+      if len(raw_filenames) != 1:
+        parser.error("watch needs a directory (and only one)")
+      if not isdir(raw_filenames[0]):
+        parser.error("Not a directory [{}]".format(raw_filenames[0]))
+
+    # Pick the writer (and the dtype its planes end up in) for the requested output, then run it over every file
+    task = None
+    task_args = ()
+    task_kwargs = {}
+    failed = []
     if args.convert_command == 'tiff':
+      from rastro.convert import tiff
+
+      try:
+        output_options = {'memmap': True} if args.memmap else tiff.tiff_options(
+            args.codec, args.level, args.tile, args.compress_threads, args.predictor)
+      except ValueError as error:
+        parser.error(str(error))
+
+      if getattr(args, 'benchmark_codecs', False):
+        from rastro.extract import raw
+
+        # Same frame (and region) as the conversion would start with, written with every codec
+        with raw.RawFrame(raw_filenames[0], cache=plane_cache, roi=args.roi) as raw_frame:
+          results = tiff.benchmark_codecs(raw_frame, tile=args.tile, threads=args.compress_threads,
+                                          predictor=args.predictor)
+        layout = 'tiles of {} pixels'.format(args.tile) if args.tile else 'strips'
+        print("{}, {}{}".format(basename(raw_filenames[0]), layout, ', predictor' if args.predictor else ''))
+        tiff.print_codec_benchmark(results)
+        sys.exit(0)
+
       if args.all_channels:
-        for raw_filename in raw_filenames:
-          color_planes = raw.reader(raw_filename)
-
-          # Emulate libraw 4channel example tiff file output
-          tiff.all_channels_writer(
-              raw_filename,
-              color_planes,
-              args.bit_depth_type,
-              compress=6
-          )
+        # Emulate libraw 4channel example tiff file output
+        task = tiff.all_channels_writer
+        task_args = (args.bit_depth_type,)
+        task_kwargs = output_options
+        output_dtype = args.bit_depth_type
+      elif args.green_plane:
+        # Averaged (rawtran "Gi") or full resolution interpolated green, see rastro.extract.planes
+        task = tiff.green_writer
+        task_args = (args.green_plane, args.bit_depth_type)
+        task_kwargs = output_options
+        output_dtype = args.bit_depth_type
       elif args.uninterpolated_rgb:
-        for raw_filename in raw_filenames:
-          color_planes = raw.reader(raw_filename)
-
-          # Most basic extraction mode, write single RGB tiff with no interpolation.  Kind of like "dcraw -h -T".
-          # see interesting discussion here: https://photo.stackexchange.com/questions/92926/is-there-a-demosaicing-algorithm-that-discards-the-2%C2%BA-green-pixel-and-produces-a
-          # Method #1, do all raw processing manually
-          # Method #2, use libraw's handy RGB conversion
-          # Initially we will just do method 1 to ensure data is as unmodified as possible.
-          tiff.rgb_writer(
-              raw_filename,
-              color_planes,
-              compress=6
-          )
+        # Most basic extraction mode, write single RGB tiff with no interpolation.  Kind of like "dcraw -h -T".
+        # see interesting discussion here: https://photo.stackexchange.com/questions/92926/is-there-a-demosaicing-algorithm-that-discards-the-2%C2%BA-green-pixel-and-produces-a
+        # Method #1, do all raw processing manually
+        # Method #2, use libraw's handy RGB conversion
+        # Initially we will just do method 1 to ensure data is as unmodified as possible.
+        task = tiff.rgb_writer
+        task_kwargs = output_options
+        output_dtype = 'uint16'
       else:
-        for raw_filename in raw_filenames:
-          color_planes = raw.reader(raw_filename)
-
-          # By default, just spit out an RGB tiff
-          tiff.rgb_writer(
-              raw_filename,
-              color_planes,
-              compress=6
-          )
+        # By default, just spit out an RGB tiff
+        task = tiff.rgb_writer
+        task_kwargs = output_options
+        output_dtype = 'uint16'
     elif args.convert_command == 'fits':
-      if args.color_plane_name:
+      from rastro.convert import fits
+
+      # A multi extension file is written by astropy in one go, only one plane per file can be memory mapped
+      if args.memmap and args.all_planes and not args.separate_files:
+        parser.error("--memmap with --all_planes needs --separate_files (one plane per file)")
+      if args.memmap and args.compression is not None:
+        parser.error("--memmap writes uncompressed files, it can't be combined with --compression")
+
+      if args.all_planes:
+        # Every color plane from a single decode
+        task = fits.multi_plane_writer
+        task_args = (rastro_command, VERSION)
+        task_kwargs = {
+            'average_green': args.average_green,
+            'interpolated_green': args.interpolated_green,
+            'separate_files': args.separate_files,
+            'compression': args.compression,
+            'memmap': args.memmap
+        }
+        output_dtype = 'float32'
+      elif args.color_plane_name:
         # Translate EXIF data to FITS format 
-        fits.single_channel_writer_header(raw_filenames, args.color_plane_name, rastro_command, VERSION)
-
-#        for raw_filename in raw_filenames:
-#          color_planes = raw.reader(raw_filename)
-#
-#          fits.single_channel_writer(
-#              raw_filename,
-#              color_planes[args.color_plane_name]['2D'],
-#              args.color_plane_name
-#          )
+        task = fits.single_channel_writer_header
+        task_args = (args.color_plane_name, rastro_command, VERSION)
+        task_kwargs = {'memmap': args.memmap, 'compression': args.compression}
+        output_dtype = 'float32'
       else:
         # TBD
         pass
+    elif args.convert_command == 'archive':
+      from rastro.extract import archive
+
+      # Fail before the batch if the codec isn't installed
+      try:
+        archive.get_compressor(args.codec, args.level)
+      except ValueError as error:
+        parser.error(str(error))
+
+      task = archive.archive_writer
+      task_kwargs = {'codec': args.codec, 'level': args.level, 'tile': args.tile}
     elif args.command == 'png':
       # Placeholder for PNG file support
       pass
@@ -281,10 +937,217 @@ def main():
     else:
       # Due to how subparsers work in Python, we never actually make it here...  Still figuring out if I care :)
       pass
+
+    with contextlib.ExitStack() as context:
+      if task is not None and (args.bias or args.dark or args.flat):
+        from rastro.calibrate import master
+
+        # Masters are normalized once for the whole batch and memory mapped by every worker
+        calibration_dir = context.enter_context(master.prepared_masters(args.bias, args.dark, args.flat))
+        task_args = (calibration_dir, output_dtype, args.pedestal, task) + task_args
+        task = master.calibrated_writer
+
+      if args.command == 'watch':
+        from rastro import watch
+
+        # Runs until interrupted (or --idle_timeout), a task of None only reports the quick stats
+        failed = watch.watch(
+            raw_filenames[0],
+            task,
+            task_args=task_args,
+            task_kwargs=task_kwargs,
+            jobs=args.jobs,
+            poll_interval=args.poll_interval,
+            settle_time=args.settle_time,
+            process_existing=args.process_existing,
+            idle_timeout=args.idle_timeout,
+            cache=plane_cache,
+            profiler=profiler,
+            roi=args.roi
+        )
+      elif task is not None and args.pipeline:
+        from rastro import pipeline
+
+        # Single process, reading, decoding and writing of different files overlapped in threads
+        failed = pipeline.run(
+            task,
+            raw_filenames,
+            task_args=task_args,
+            task_kwargs=task_kwargs,
+            threads=args.pipeline_threads,
+            prefetch=args.prefetch,
+            cache=plane_cache,
+            profiler=profiler,
+            roi=args.roi
+        )
+      elif task is not None:
+        failed = batch.run(
+            task,
+            raw_filenames,
+            task_args=task_args,
+            task_kwargs=task_kwargs,
+            jobs=args.jobs,
+            cache=plane_cache,
+            profiler=profiler,
+            roi=args.roi
+        )
+
+    if profiler is not None:
+      profiler.write(args.profile)
+
+    # One bad file doesn't stop the batch, but make sure scripts can tell something went wrong
+    if failed:
+      sys.exit(1)
+  if args.command == 'stack':
+    from rastro.calibrate import stack
+
+    if not raw_filenames:
+      parser.error('stack needs at least one RAW file')
+    if args.sigma <= 0:
+      parser.error('--sigma has to be positive, got {}'.format(args.sigma))
+
+    failed = stack.stack(
+        raw_filenames,
+        args.output or 'master_' + args.frame_type,
+        args.frame_type,
+        args.method,
+        rastro_command,
+        VERSION,
+        sigma=args.sigma,
+        iterations=args.sigma_iters,
+        jobs=args.jobs,
+        memory_limit=args.memory_limit * 2**20,
+        scratch_dir=args.scratch_dir,
+        cache=plane_cache
+    )
+
+    if failed:
+      sys.exit(1)
+
+  if args.command == 'preview':
+    from rastro import batch
+    from rastro.convert import preview
+
+    try:
+      if args.contact_sheet:
+        preview.check_options(args.tile_size, args.columns, args.quality)
+      else:
+        preview.check_options(args.size, quality=args.quality)
+    except ValueError as error:
+      parser.error(str(error))
+
+    if args.contact_sheet:
+      # Workers only send back the tile sized previews, the sheet is laid out here in input order
+      failed = preview.contact_sheet(
+          raw_filenames,
+          args.contact_sheet,
+          tile_size=args.tile_size,
+          columns=args.columns,
+          thumbnail=not args.no_thumbnail,
+          quality=args.quality,
+          jobs=args.jobs,
+          cache=plane_cache,
+          profiler=profiler,
+          roi=args.roi
+      )
+    else:
+      failed = batch.run(
+          preview.preview_writer,
+          raw_filenames,
+          task_kwargs={'max_size': args.size, 'thumbnail': not args.no_thumbnail, 'quality': args.quality},
+          jobs=args.jobs,
+          cache=plane_cache,
+          profiler=profiler,
+          roi=args.roi
+      )
+    if profiler is not None:
+      profiler.write(args.profile)
+
+    if failed:
+      sys.exit(1)
+
+  if args.command == 'index':
+    from rastro import catalog
+
+    if args.index_command == 'update':
+      failed = catalog.update(args.catalog, raw_filenames, black_levels=args.black_levels, jobs=args.jobs)
+      if failed:
+        sys.exit(1)
+    elif args.index_command == 'query':
+      frames = catalog.query(
+          args.catalog,
+          exptime=args.exptime,
+          iso=args.iso,
+          instrume=args.instrume,
+          date_from=args.date_from,
+          date_to=args.date_to,
+          path=args.path
+      )
+      catalog.print_frames(frames, paths_only=args.paths_only)
+
   if args.command == 'analyze':
     if args.analyze_command == 'histogram':
-      color_planes = raw.reader(raw_filenames[0])
-      histogram.plot_color_planes_histogram(color_planes, args.bins, args.raw_bit_depth)
+      from rastro import batch
+      from rastro.analyze import histogram
+
+      if args.range_max is None:
+        args.range_max = 2**args.raw_bit_depth - 1
+      if not 0 <= args.range_min <= args.range_max < 2**args.raw_bit_depth:
+        parser.error('Expected 0 <= --range_min <= --range_max < 2^{} (--raw_bit_depth), got {} and {}'.format(
+            args.raw_bit_depth, args.range_min, args.range_max))
+      if args.bins < 1:
+        parser.error('--bins has to be at least 1, got {}'.format(args.bins))
+
+      # Exact ADU counts are tiny compared to the pixel data, so they are computed per file (in the worker
+      # processes with --jobs) and merged or exported here.  Rebinning only happens on those counts.
+      if args.export:
+        exporter = histogram.HistogramExporter(
+            args.export,
+            args.bins,
+            args.range_min,
+            args.range_max,
+            summary_prefix=args.summary
+        )
+        failed = batch.run(
+            histogram.color_planes_histogram,
+            raw_filenames,
+            jobs=args.jobs,
+            on_result=exporter.add,
+            cache=plane_cache,
+            profiler=profiler,
+            roi=args.roi
+        )
+        exporter.finish()
+        if profiler is not None:
+          profiler.write(args.profile)
+
+        if failed:
+          sys.exit(1)
+      else:
+        color_planes_histograms = {}
+        failed = batch.run(
+            histogram.color_planes_histogram,
+            raw_filenames,
+            jobs=args.jobs,
+            on_result=lambda raw_filename, histograms: histogram.merge_histograms(color_planes_histograms, histograms),
+            cache=plane_cache,
+            profiler=profiler,
+            roi=args.roi
+        )
+        if profiler is not None:
+          profiler.write(args.profile)
+
+        # Plot whatever was read, but still let scripts know about the files that weren't
+        if color_planes_histograms:
+          histogram.plot_color_planes_histogram(
+              color_planes_histograms,
+              args.bins,
+              args.raw_bit_depth,
+              args.range_min,
+              args.range_max
+          )
+        if failed:
+          sys.exit(1)
     else:
       pass
 
@@ -1,18 +1,17 @@
 # -*- coding: utf-8 -*-
 
-import rawpy
-import io
 from astropy.io import fits
-import pyexiv2
 from pyexiv2.exif import ExifTag, ExifValueError
 
 from datetime import timezone
 
-from rastro.extract import raw
+import numpy as np
+
+from rastro import profiling
+from rastro.extract import planes
 
 # TODO:
 #   * Write unit tests for these functions!
-#   * Create class which wraps RAW file open and metadata capture process
 
 """
 FITS Reference Information
@@ -21,91 +20,280 @@ Links:
     https://heasarc.gsfc.nasa.gov/docs/fcg/standard_dict.html
 """
 
-def single_channel_writer_header(raw_filenames, color_plane_name, rastro_command, VERSION):
-  # Handle multiple raw files
-  for raw_filename in raw_filenames:
-    # see: https://python3-exiv2.readthedocs.io/en/latest/api.html#buffer
-    # Little hack to not have to open the RAW file more than once to gather stats/info
-    metadata = pyexiv2.ImageMetadata(raw_filename)
-    metadata.read()
-
-    # Check for weird edge case noticed on Canon 40D with nonstandard lens and the stored value for 
-    # Exif.Photo.ApertureValue, typically for a nonstandard lens the value would should be 0 or -2147483648
-    # For some reason the value is set to POSITIVE 2147483648. This causes the APEX value calculation to return
-    # basically an infinite value.  See: https://rt.cpan.org/Public/Bug/Display.html?id=29609
-    # Ideally, we'll squash the garbage value with an manually specified aperture value during image capture. But just in case.
-    if metadata['Exif.Photo.ApertureValue'].value == int(2**32/2):
-      aperture = 'F0.0'
-    else:
-      aperture = metadata['Exif.Photo.ApertureValue'].value
-  
-    # Build FITS header data structure
-    # This initial structure is inspired by the format used by rawtran.
-    # See https://www.aavso.org/aavso-extended-file-format
-    #     https://diffractionlimited.com/help/maximdl/FITS_File_Header_Definitions.htm
-    #     https://fits.gsfc.nasa.gov/fits_standard.html
-    #     https://www.cv.nrao.edu/fits/documents/standards/year2000.txt
-    # Add option to include sub-second timing if available
-    #    * Exif.Photo.SubSecTime and strftime('%Y-%m-%dT%H:%M:%S.%f')
-    # Add option to choose time zone of RAW camera set image timestamp.  Default would be to use system timezone on computer where
-    # rastro is run.  UTC would probably be the best choice in the future on the camera.  Newer cameras hopefully support 
-    # datetime with TZ information.
-    # CRITICAL! Write tests to check these date conversions and assumptions...
-    #print(metadata['Exif.Photo.ApertureValue'].value)
-    fits_header = {
-       'PHOTSYS': ('Instrumental', 'Photometry filter system'),
-       'FILTER': ('T' + color_plane_name[0], 'Spectral filter'),    # Using "tri-color" RGB nomenclature from AAVSO for DSLR & CCD
-       'DATE-OBS': (metadata['Exif.Image.DateTime'].value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f'), 'Date and time of the observation'), 
-       # Default in FITS standard is UTC
-       # represents the START of observation
-       'TIMESYS': ('UTC', 'Time system for dates'),
-       'EXPTIME': (float(metadata['Exif.Photo.ExposureTime'].value), '[s] exposure time in seconds'),
-       'ISO': (int(metadata['Exif.Photo.ISOSpeedRatings'].value), 'ISO speed'),
-       'INSTRUME': (str(metadata['Exif.Image.Model'].value), 'Camera manufacturer and model'),
-       #'APERTURE': ('f/' + str(float(metadata['Exif.Photo.ApertureValue'].value)), 'Aperture'),
-       'APERTURE': (aperture, 'Aperture'),
+# FITS files are made of 2880 byte blocks
+FITS_BLOCK_SIZE = 2880
+
+# Lossless tile compression (astropy CompImageHDU compression_type), see
+#   https://fits.gsfc.nasa.gov/registry/tilecompression.html
+COMPRESSION_TYPES = {
+    'rice': 'RICE_1',
+    'gzip': 'GZIP_1',
+    'gzip2': 'GZIP_2',
+}
+
+def exif_header(metadata, color_plane_name):
+  """
+    Build the FITS header entries (keyword: (value, comment)) that are translated from the RAW file's EXIF data.
+  """
+  # Check for weird edge case noticed on Canon 40D with nonstandard lens and the stored value for 
+  # Exif.Photo.ApertureValue, typically for a nonstandard lens the value would should be 0 or -2147483648
+  # For some reason the value is set to POSITIVE 2147483648. This causes the APEX value calculation to return
+  # basically an infinite value.  See: https://rt.cpan.org/Public/Bug/Display.html?id=29609
+  # Ideally, we'll squash the garbage value with an manually specified aperture value during image capture. But just in case.
+  if metadata['Exif.Photo.ApertureValue'].value == int(2**32/2):
+    aperture = 'F0.0'
+  else:
+    aperture = metadata['Exif.Photo.ApertureValue'].value
+
+  # Build FITS header data structure
+  # This initial structure is inspired by the format used by rawtran.
+  # See https://www.aavso.org/aavso-extended-file-format
+  #     https://diffractionlimited.com/help/maximdl/FITS_File_Header_Definitions.htm
+  #     https://fits.gsfc.nasa.gov/fits_standard.html
+  #     https://www.cv.nrao.edu/fits/documents/standards/year2000.txt
+  # Add option to include sub-second timing if available
+  #    * Exif.Photo.SubSecTime and strftime('%Y-%m-%dT%H:%M:%S.%f')
+  # Add option to choose time zone of RAW camera set image timestamp.  Default would be to use system timezone on computer where
+  # rastro is run.  UTC would probably be the best choice in the future on the camera.  Newer cameras hopefully support 
+  # datetime with TZ information.
+  # CRITICAL! Write tests to check these date conversions and assumptions...
+  #print(metadata['Exif.Photo.ApertureValue'].value)
+  fits_header = {
+     'PHOTSYS': ('Instrumental', 'Photometry filter system'),
+     'FILTER': ('T' + color_plane_name[0], 'Spectral filter'),    # Using "tri-color" RGB nomenclature from AAVSO for DSLR & CCD
+     'DATE-OBS': (metadata['Exif.Image.DateTime'].value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f'), 'Date and time of the observation'), 
+     # Default in FITS standard is UTC
+     # represents the START of observation
+     'TIMESYS': ('UTC', 'Time system for dates'),
+     'EXPTIME': (float(metadata['Exif.Photo.ExposureTime'].value), '[s] exposure time in seconds'),
+     'ISO': (int(metadata['Exif.Photo.ISOSpeedRatings'].value), 'ISO speed'),
+     'INSTRUME': (str(metadata['Exif.Image.Model'].value), 'Camera manufacturer and model'),
+     #'APERTURE': ('f/' + str(float(metadata['Exif.Photo.ApertureValue'].value)), 'Aperture'),
+     'APERTURE': (aperture, 'Aperture'),
 #       'COMMENT': ('Command: ' + rastro_command),
 #       'COMMENT': ('Created by rastro v' + VERSION + ' https://github.com/sanelson/rastro'),
-      #('COMMENT', 'Additional EXIF data'),
-      #('COMMENT', 'Sensor size: '),   # Get from rawpy
-    }
-    # Grab the metadata we want
-    #exif_data = {
-    #        '':'',
-    #}
-    #for key in metadata.exif_keys:
-    #  try:
-    #    # print(str(key) + "=" + str(metadata[key].value))
-    #    print(str(key) + "=" + str(metadata[key]))
-    #  except ExifValueError:
-    #    print("Unable to decode raw value for key [{}]".format(key))
-  
-    # Create io buffer to re-use with rawpy
-    byteio = io.BytesIO(metadata.buffer)
-  
-  #  # Operate on the IO buffer
-  #  with rawpy.imread(byteio) as rawimage:
-    color_planes = raw.reader(byteio)
+    #('COMMENT', 'Additional EXIF data'),
+    #('COMMENT', 'Sensor size: '),   # Get from rawpy
+  }
+  # Grab the metadata we want
+  #exif_data = {
+  #        '':'',
+  #}
+  #for key in metadata.exif_keys:
+  #  try:
+  #    # print(str(key) + "=" + str(metadata[key].value))
+  #    print(str(key) + "=" + str(metadata[key]))
+  #  except ExifValueError:
+  #    print("Unable to decode raw value for key [{}]".format(key))
+
+  return fits_header
+
+def frame_header(raw_frame, color_plane_name):
+  """
+    exif_header() of raw_frame, plus the origin of the region of interest in visible sensor pixels when only a
+    region was extracted (keywords as used by MaxIm DL for subframes).
+  """
+  fits_header = exif_header(raw_frame.metadata, color_plane_name)
+  if raw_frame.roi is not None:
+    x0, y0, width, height = raw_frame.roi
+    fits_header['XORGSUBF'] = (x0, '[px] Region of interest X origin on the sensor')
+    fits_header['YORGSUBF'] = (y0, '[px] Region of interest Y origin on the sensor')
+  return fits_header
+
+def add_rastro_cards(hdr, rastro_command, VERSION, history=()):
+  """Record how the file was made as COMMENT cards, and each line of history as a HISTORY card."""
+  hdr['COMMENT'] = 'Command: ' + rastro_command
+  hdr['COMMENT'] = 'Created by rastro v' + VERSION + ' https://github.com/sanelson/rastro'
+  for history_line in history:
+    hdr['HISTORY'] = history_line
+
+def image_hdu(color_plane, hdr, compression=None, name=None):
+  """
+    Image extension HDU for a color plane, tile compressed with one of COMPRESSION_TYPES when compression is
+    given.  Compression is always lossless: RICE only works losslessly on integer data, floating point planes
+    (e.g. calibrated ones) can use GZIP with quantization turned off.
+  """
+  if compression is None:
+    return fits.ImageHDU(color_plane, header=hdr, name=name)
+
+  if np.issubdtype(color_plane.dtype, np.floating):
+    if compression == 'rice':
+      raise ValueError("RICE compression would quantize floating point data, use gzip or gzip2 instead")
+    # quantize_level 0 stores the floating point values as is
+    return fits.CompImageHDU(color_plane, header=hdr, name=name, compression_type=COMPRESSION_TYPES[compression],
+                             quantize_level=0.0)
 
+  return fits.CompImageHDU(color_plane, header=hdr, name=name, compression_type=COMPRESSION_TYPES[compression])
+
+def plane_writer(fits_filename, color_plane, fits_header, rastro_command, VERSION, history=(), compression=None):
+  """
+    Write a single color plane (or any 2D array) to fits_filename with our custom header entries.  Each line of
+    history is recorded as a HISTORY card.
+
+    Compressed images can't be the primary HDU, so with compression the plane goes in the first extension after
+    an empty primary HDU.
+  """
+  with profiling.stage('encode'):
     # Incorporate our custom header entries into the standard header
     hdr = fits.Header()
     hdr.update(fits_header)
-    hdr['COMMENT'] = 'Command: ' + rastro_command
-    hdr['COMMENT'] = 'Created by rastro v' + VERSION + ' https://github.com/sanelson/rastro'
-    hdu = fits.PrimaryHDU(color_planes[color_plane_name]['2D'], header=hdr)
-  
-    hdul = fits.HDUList([hdu])
-  
-    fits_filename = raw_filename + '.' + color_plane_name + '.fits'
+    add_rastro_cards(hdr, rastro_command, VERSION, history)
+    if compression is None:
+      hdul = fits.HDUList([fits.PrimaryHDU(color_plane, header=hdr)])
+    else:
+      hdul = fits.HDUList([fits.PrimaryHDU(), image_hdu(color_plane, hdr, compression)])
+
+  with profiling.stage('write'):
+    hdul.writeto(fits_filename)
+  profiling.add_bytes_written(fits_filename)
+
+def plane_memmap_writer(fits_filename, color_plane, fits_header, rastro_command, VERSION, history=()):
+  """
+    Same output as plane_writer(), but the file is preallocated and the pixels are copied straight from the
+    color plane (typically a strided view) into a memory map of the data section.  No in-memory HDU copy
+    (byteswapped and BZERO shifted) of the plane is ever made.
+  """
+  with profiling.stage('write'):
+    write_plane_memmap(fits_filename, color_plane, fits_header, rastro_command, VERSION, history)
+  profiling.add_bytes_written(fits_filename)
+
+def write_plane_memmap(fits_filename, color_plane, fits_header, rastro_command, VERSION, history):
+  # A 1x1 HDU of the same dtype gives us the right BITPIX/BZERO cards, then the real dimensions are filled in
+  hdr = fits.PrimaryHDU(np.zeros((1, 1), dtype=color_plane.dtype)).header
+  hdr['NAXIS1'] = color_plane.shape[1]
+  hdr['NAXIS2'] = color_plane.shape[0]
+  hdr.update(fits_header)
+  add_rastro_cards(hdr, rastro_command, VERSION, history)
+
+  # Header, then the data section padded to a whole number of FITS blocks (truncate() zero fills)
+  header_size = len(hdr.tostring())
+  data_size = color_plane.size * color_plane.dtype.itemsize
+  hdr.tofile(fits_filename, overwrite=False)
+  with open(fits_filename, 'r+b') as fits_file:
+    fits_file.truncate(header_size + -(-data_size // FITS_BLOCK_SIZE) * FITS_BLOCK_SIZE)
+
+  # FITS data is big endian, and unsigned integers are stored signed with BZERO = 2^(bits - 1)
+  storage_dtype = color_plane.dtype.newbyteorder('>')
+  fits_data = np.memmap(fits_filename, dtype=storage_dtype, mode='r+', offset=header_size, shape=color_plane.shape)
+  fits_data[...] = color_plane
+  if color_plane.dtype.kind == 'u' and color_plane.dtype.itemsize > 1:
+    # Flipping the top bit of the unsigned value gives the two's complement of (value - BZERO)
+    np.bitwise_xor(fits_data, 1 << (8 * color_plane.dtype.itemsize - 1), out=fits_data, casting='unsafe')
+  fits_data.flush()
+  del fits_data
+
+def check_memmap_compression(memmap, compression):
+  """Raise ValueError for memory mapped output with compression, the file is preallocated uncompressed."""
+  if memmap and compression is not None:
+    raise ValueError("Memory mapped output can't be compressed, use either memmap or {} compression".format(compression))
+
+def single_channel_writer_header(raw_frame, color_plane_name, rastro_command, VERSION, memmap=False, compression=None):
+  check_memmap_compression(memmap, compression)
+
+  # Cached strided views onto the decoded sensor data, or a green plane computed from them
+  if color_plane_name in planes.GREEN_PLANE_NAMES:
+    with profiling.stage('encode'):
+      color_plane = planes.get_green_plane(raw_frame, color_plane_name, reuse=True)
+  else:
+    color_plane = raw_frame.color_planes[color_plane_name]['2D']
+
+  # EXIF and pixel data both come from the same RawFrame buffer
+  fits_header = frame_header(raw_frame, color_plane_name)
+
+  fits_filename = raw_frame.filename + '.' + color_plane_name + '.fits'
+  if memmap:
+    plane_memmap_writer(
+        fits_filename,
+        color_plane,
+        fits_header,
+        rastro_command,
+        VERSION,
+        history=raw_frame.history
+    )
+  else:
+    plane_writer(
+        fits_filename,
+        color_plane,
+        fits_header,
+        rastro_command,
+        VERSION,
+        history=raw_frame.history,
+        compression=compression
+    )
+
+def get_output_planes(raw_frame, color_plane_names=None, average_green=False, interpolated_green=False):
+  """
+    List of (name, 2D array) to write: the requested color planes (all of them by default), plus the average
+    of G1 and G2 as 'Gi' when average_green is set and the full resolution interpolated green as 'Gfull' when
+    interpolated_green is set (see rastro.extract.planes).
+  """
+  color_planes = raw_frame.color_planes
+  if color_plane_names is None:
+    color_plane_names = list(color_planes)
+
+  output_planes = [(color_plane_name, color_planes[color_plane_name]['2D']) for color_plane_name in color_plane_names]
+
+  if average_green:
+    output_planes.append(('Gi', planes.get_green_plane(raw_frame, 'Gi', reuse=True)))
+  if interpolated_green:
+    output_planes.append(('Gfull', planes.get_green_plane(raw_frame, 'Gfull', reuse=True)))
+
+  return output_planes
+
+def multi_plane_writer(raw_frame, rastro_command, VERSION, color_plane_names=None, average_green=False,
+                       separate_files=False, compression=None, memmap=False, interpolated_green=False):
+  """
+    Write every color plane (and optionally the averaged and/or interpolated green) of one decoded frame.
+
+    By default the planes are image extensions, named after the color plane, of a single <raw>.fits file.  The
+    primary HDU holds the EXIF translated header and each extension adds its own FILTER.  With separate_files
+    each plane goes to its own <raw>.<color plane>.fits, like single_channel_writer_header().  memmap only works
+    with separate_files, astropy writes a multi extension file in one go.
+  """
+  if memmap and not separate_files:
+    raise ValueError("Memory mapped output needs separate files, a multi extension file can't be memory mapped")
+  check_memmap_compression(memmap, compression)
+
+  with profiling.stage('encode'):
+    output_planes = get_output_planes(raw_frame, color_plane_names, average_green, interpolated_green)
+
+  if separate_files:
+    for color_plane_name, color_plane in output_planes:
+      fits_header = frame_header(raw_frame, color_plane_name)
+      fits_filename = raw_frame.filename + '.' + color_plane_name + '.fits'
+      if memmap:
+        plane_memmap_writer(fits_filename, color_plane, fits_header, rastro_command, VERSION, history=raw_frame.history)
+      else:
+        plane_writer(fits_filename, color_plane, fits_header, rastro_command, VERSION, history=raw_frame.history,
+                     compression=compression)
+    return
+
+  # One multi extension file
+  fits_header = frame_header(raw_frame, output_planes[0][0])
+  del fits_header['FILTER']
+
+  with profiling.stage('encode'):
+    hdr = fits.Header()
+    hdr.update(fits_header)
+    add_rastro_cards(hdr, rastro_command, VERSION, raw_frame.history)
+    hdul = fits.HDUList([fits.PrimaryHDU(header=hdr)])
+
+    for color_plane_name, color_plane in output_planes:
+      plane_hdr = fits.Header()
+      plane_hdr['FILTER'] = ('T' + color_plane_name[0], 'Spectral filter')
+      hdul.append(image_hdu(color_plane, plane_hdr, compression, name=color_plane_name))
+
+  fits_filename = raw_frame.filename + '.fits'
+  with profiling.stage('write'):
     hdul.writeto(fits_filename)
- 
+  profiling.add_bytes_written(fits_filename)
 
-def single_channel_writer(raw_filename, color_plane, color_plane_name, **options):
-  hdu = fits.PrimaryHDU(color_planes[color_plane_name]['2D'])
+def single_channel_writer(raw_frame, color_plane_name, **options):
+  hdu = fits.PrimaryHDU(raw_frame.color_planes[color_plane_name]['2D'])
 
   hdul = fits.HDUList([hdu])
 
-  fits_filename = raw_filename + '.' + color_plane_name + '.fits'
+  fits_filename = raw_frame.filename + '.' + color_plane_name + '.fits'
   hdul.writeto(fits_filename)
 
 
@@ -1,27 +1,236 @@
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+import numpy as np
 import tifffile # https://pypi.org/project/tifffile/  Good library for scientific image processing in TIFF format
 
-def all_channels_writer(raw_filename, color_planes, bit_depth_type, **options):
+from rastro import profiling
+from rastro.extract import planes
+
+# Lossless codecs by --codec name, as tifffile calls them.  deflate (zlib) is built in, tifffile needs the
+# optional imagecodecs package to encode the others.
+CODECS = {
+    'none': None,
+    'deflate': 'adobe_deflate',
+    'lzw': 'lzw',
+    'zstd': 'zstd',
+}
+IMAGECODECS_CODECS = ['lzw', 'zstd']
+
+# Codecs with a compression level, and the level used when none is given (deflate 6 is what we always wrote)
+DEFAULT_LEVELS = {
+    'deflate': 6,
+    'zstd': None,
+}
+
+# Levels tried by benchmark_codecs()
+BENCHMARK_LEVELS = {
+    'none': [None],
+    'deflate': [1, 6, 9],
+    'lzw': [None],
+    'zstd': [1, 5, 10, 19],
+}
+
+def check_codec(codec):
+  """Raise ValueError for an unknown codec, or one whose encoder isn't installed."""
+  if codec not in CODECS:
+    raise ValueError("Unknown TIFF codec {}, expected one of {}".format(codec, list(CODECS)))
+  if codec in IMAGECODECS_CODECS:
+    try:
+      import imagecodecs
+    except ImportError:
+      raise ValueError("{} TIFF compression needs imagecodecs (pip3 install imagecodecs), or use deflate or none".format(
+          codec))
+
+def tiff_options(codec='deflate', level=None, tile=None, threads=0, predictor=False):
+  """
+    tifffile.imwrite() options for lossless codec (one of CODECS) at level (DEFAULT_LEVELS when not given).
+
+    tile is the side of square tiles in pixels (a multiple of 16), strips are written when it's None.  Tiles
+    (or strips) are compressed on up to threads threads, 0 leaves it to tifffile.  predictor turns on
+    horizontal differencing, which usually makes smooth 16 bit data compress a lot better.
+  """
+  check_codec(codec)
+  if level is not None and codec not in DEFAULT_LEVELS:
+    raise ValueError("The {} TIFF codec has no compression levels".format(codec))
+
+  options = {}
+  if CODECS[codec] is not None:
+    options['compression'] = CODECS[codec]
+    options['maxworkers'] = threads or None
+    if level is None:
+      level = DEFAULT_LEVELS.get(codec)
+    if level is not None:
+      options['compressionargs'] = {'level': level}
+    if predictor:
+      options['predictor'] = True
+  if tile is not None:
+    if tile <= 0 or tile % 16:
+      raise ValueError("TIFF tiles have to be a positive multiple of 16 pixels, got {}".format(tile))
+    options['tile'] = (tile, tile)
+  return options
+
+def tiff_metadata(raw_frame, tiff_filename):
+  """tifffile metadata, with the region of interest (x0, y0, width, height on the sensor) when there is one."""
+  metadata = {'DocumentName': tiff_filename}
+  if raw_frame.roi is not None:
+    metadata['ROI'] = list(raw_frame.roi)
+  return metadata
+
+def all_channels_writer(raw_frame, bit_depth_type, memmap=False, **options):
+  color_planes = raw_frame.color_planes
+
   # Write color plane to file
   for color_plane_name in color_planes:
-    tiff_filename = raw_filename + "." + color_plane_name + ".tiff"
-    options['metadata'] = {'DocumentName': tiff_filename}
-    tifffile.imsave(tiff_filename, color_planes[color_plane_name]['2D'].astype(bit_depth_type), options)
+    tiff_filename = raw_frame.filename + "." + color_plane_name + ".tiff"
+    if memmap:
+      # Preallocate an uncompressed TIFF and fill it straight from the strided plane view, no astype() copy.
+      # Memory mapped TIFFs can't be compressed or tiled, so those options are ignored.
+      with profiling.stage('write'):
+        tiff_color_plane = tifffile.memmap(
+            tiff_filename,
+            shape=color_planes[color_plane_name]['2D'].shape,
+            dtype=bit_depth_type,
+            metadata=tiff_metadata(raw_frame, tiff_filename)
+        )
+        np.copyto(tiff_color_plane, color_planes[color_plane_name]['2D'], casting='unsafe')
+        tiff_color_plane.flush()
+        del tiff_color_plane
+    else:
+      options['metadata'] = tiff_metadata(raw_frame, tiff_filename)
+      with profiling.stage('encode'):
+        # One scratch buffer serves every plane (and frame), it's written out before the next plane is copied in
+        color_plane = color_planes[color_plane_name]['2D']
+        tiff_color_plane = planes.get_scratch_buffer('channel', color_plane.shape, bit_depth_type)
+        np.copyto(tiff_color_plane, color_plane, casting='unsafe')
+      with profiling.stage('write'):
+        tifffile.imwrite(tiff_filename, tiff_color_plane, **options)
+    profiling.add_bytes_written(tiff_filename)
+
+def rgb_writer(raw_frame, memmap=False, **options):
+  color_planes = raw_frame.color_planes
+  tiff_filename = raw_frame.filename + ".RGB.tiff"
+  shape = color_planes["R"]["2D"].shape + (3,)
+
+  if memmap:
+    # Preallocate an uncompressed interleaved RGB TIFF and write the channels straight into it.  Memory mapped
+    # TIFFs can't be compressed or tiled, so those options are ignored.
+    with profiling.stage('write'):
+      rgb_color_planes = tifffile.memmap(
+          tiff_filename,
+          shape=shape,
+          dtype='uint16',
+          photometric='rgb',
+          metadata=tiff_metadata(raw_frame, tiff_filename)
+      )
+      planes.interleave_rgb(color_planes, rgb_color_planes)
+      rgb_color_planes.flush()
+      del rgb_color_planes
+    profiling.add_bytes_written(tiff_filename)
+    return
 
-def rgb_writer(raw_filename, color_planes, **options):
-  # Average green color planes
   # We're going to write a 16bit TIFF file since an 8bit file would look like garbage, plus we would lose quite a 
   # large amount of the camera sensor and ADC sensitivity.
-  # Casting the averaged (float) value to uint16 appears to perform a floor() on the value.  1266.5 => 1266
-  green_color_plane = (( color_planes["G1"]["2D"] + color_planes["G2"]["2D"] ) / 2.0).astype('uint16')
-  red_color_plane = color_planes["R"]["2D"].astype('uint16')
-  blue_color_plane = color_planes["B"]["2D"].astype('uint16')
-
-  # Combine color plane arrays
-  # see: https://docs.scipy.org/doc/numpy/reference/generated/numpy.stack.html#numpy.stack
-  rgb_color_planes = np.stack((red_color_plane, green_color_plane, blue_color_plane), axis=-1)
+  # R, the floor of the (G1 + G2) / 2 average and B are interleaved in a single pass, no float64 sums, astype()
+  # copies or np.stack(), into a buffer reused from frame to frame.
+  with profiling.stage('encode'):
+    rgb_color_planes = planes.get_scratch_buffer('RGB', shape, 'uint16')
+    planes.interleave_rgb(color_planes, rgb_color_planes)
 
-  tiff_filename = raw_filename + ".RGB.tiff"
   options['photometric'] = 'rgb'
-  options['metadata'] = {'DocumentName': tiff_filename}
-  tifffile.imsave(tiff_filename, rgb_color_planes, options)
+  options['metadata'] = tiff_metadata(raw_frame, tiff_filename)
+  with profiling.stage('write'):
+    tifffile.imwrite(tiff_filename, rgb_color_planes, **options)
+  profiling.add_bytes_written(tiff_filename)
+
+def green_writer(raw_frame, green_plane_name, bit_depth_type='uint16', memmap=False, **options):
+  """Write one of planes.GREEN_PLANE_NAMES (averaged or full resolution interpolated green) to <raw>.<name>.tiff"""
+  tiff_filename = raw_frame.filename + "." + green_plane_name + ".tiff"
+  shape = planes.green_plane_shape(raw_frame, green_plane_name)
+
+  if memmap:
+    # Memory mapped TIFFs can't be compressed or tiled, so those options are ignored
+    with profiling.stage('write'):
+      green_color_plane = tifffile.memmap(
+          tiff_filename,
+          shape=shape,
+          dtype=bit_depth_type,
+          metadata=tiff_metadata(raw_frame, tiff_filename)
+      )
+      planes.get_green_plane(raw_frame, green_plane_name, out=green_color_plane)
+      green_color_plane.flush()
+      del green_color_plane
+    profiling.add_bytes_written(tiff_filename)
+    return
+
+  with profiling.stage('encode'):
+    green_color_plane = planes.get_green_plane(
+        raw_frame,
+        green_plane_name,
+        out=planes.get_scratch_buffer(green_plane_name, shape, bit_depth_type)
+    )
+
+  options['metadata'] = tiff_metadata(raw_frame, tiff_filename)
+  with profiling.stage('write'):
+    tifffile.imwrite(tiff_filename, green_color_plane, **options)
+  profiling.add_bytes_written(tiff_filename)
+
+def benchmark_codecs(raw_frame, codecs=None, tile=None, threads=0, predictor=False, repeat=3, scratch_dir=None):
+  """
+    Write raw_frame's RGB image (what rgb_writer() writes) with every level of BENCHMARK_LEVELS for each codec
+    (all the installed ones by default) and return a list of dictionaries with the codec, level, file size,
+    compression ratio and median write time and throughput (MB of image per second) of repeat writes.
+  """
+  if codecs is None:
+    codecs = []
+    for codec in CODECS:
+      try:
+        check_codec(codec)
+      except ValueError:
+        continue
+      codecs.append(codec)
+
+  rgb_color_planes = np.empty(raw_frame.color_planes['R']['2D'].shape + (3,), dtype='uint16')
+  planes.interleave_rgb(raw_frame.color_planes, rgb_color_planes)
+
+  results = []
+  scratch_dir = tempfile.mkdtemp(prefix='rastro-codecs-', dir=scratch_dir)
+  try:
+    tiff_filename = os.path.join(scratch_dir, 'benchmark.tiff')
+    for codec in codecs:
+      for level in BENCHMARK_LEVELS[codec]:
+        options = tiff_options(codec, level, tile, threads, predictor)
+        write_times = []
+        for _ in range(repeat):
+          start_time = time.perf_counter()
+          tifffile.imwrite(tiff_filename, rgb_color_planes, photometric='rgb', **options)
+          write_times.append(time.perf_counter() - start_time)
+        write_time = statistics.median(write_times)
+        file_size = os.path.getsize(tiff_filename)
+        results.append({
+            'codec': codec,
+            'level': level,
+            'bytes': file_size,
+            'ratio': rgb_color_planes.nbytes / file_size,
+            'write': write_time,
+            'mb_per_s': rgb_color_planes.nbytes / max(write_time, 1e-9) / 1e6,
+        })
+  finally:
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+
+  return results
 
+def print_codec_benchmark(results):
+  print("{:<8} {:>5} {:>12} {:>7} {:>10} {:>8}".format('codec', 'level', 'bytes', 'ratio', 'write [s]', 'MB/s'))
+  for result in results:
+    print("{:<8} {:>5} {:>12} {:>7.2f} {:>10.3f} {:>8.1f}".format(
+        result['codec'],
+        '-' if result['level'] is None else result['level'],
+        result['bytes'],
+        result['ratio'],
+        result['write'],
+        result['mb_per_s']
+    ))
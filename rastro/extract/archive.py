@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+
+"""
+rastro CFA archives (.rcfa): the visible sensor data of a RAW file, losslessly bit packed and compressed, along
+with everything rastro needs to process it again without libraw.
+
+Layout of a file:
+
+  MAGIC                  8 bytes
+  header length          little endian uint32
+  header                 UTF-8 JSON, see write_archive()
+  chunks                 back to back, at the offsets (from the end of the header) listed in the header
+
+Each color plane of the 2x2 CFA is stored on its own, cut into square tiles of plane pixels.  Every tile is
+bit packed to the frame's real bit depth (e.g. 14 bits per pixel for a 14 bit sensor) and then compressed on
+its own, with the built in zlib by default or zstd (smaller and faster to read, needs zstandard).  Reading one
+plane, or a region of interest, only decompresses the tiles it needs.
+
+The header keeps the rawpy details of the frame (raw pattern, color description, black and white levels, see
+RawFrame.raw_info) and the EXIF tags used by the FITS headers (EXIF_KEYS), so an archive can be used anywhere
+a RAW file can: RawFrame recognises raw.ARCHIVE_EXTENSION and reads the archive instead of decoding with libraw.
+"""
+
+import datetime
+import fractions
+import io
+import json
+import math
+import struct
+import zlib
+
+import numba
+import numpy as np
+
+from rastro import profiling
+from rastro.extract import raw
+
+ARCHIVE_EXTENSION = raw.ARCHIVE_EXTENSION
+
+MAGIC = b'RCFA\x00\x01\r\n'
+
+VERSION = 1
+
+CODECS = ['zlib', 'zstd']
+
+# zlib is always available, zstd is an optional extra
+DEFAULT_CODEC = 'zlib'
+
+DEFAULT_LEVELS = {
+    'zstd': 9,
+    'zlib': 6,
+}
+
+DEFAULT_TILE = 512
+
+# The EXIF tags fits.exif_header() translates, plus the camera make
+EXIF_KEYS = [
+    'Exif.Image.Make',
+    'Exif.Image.Model',
+    'Exif.Image.DateTime',
+    'Exif.Photo.ExposureTime',
+    'Exif.Photo.ISOSpeedRatings',
+    'Exif.Photo.ApertureValue',
+]
+
+# Bit packing, least significant bits first, so a value can straddle byte boundaries
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def pack_bits(values, bit_depth, out):
+  """Pack the flat unsigned integer array values into bytes at bit_depth bits each, out is uint8."""
+  accumulator = np.uint64(0)
+  bits = 0
+  j = 0
+  for i in range(values.size):
+    accumulator |= np.uint64(values[i]) << np.uint64(bits)
+    bits += bit_depth
+    while bits >= 8:
+      out[j] = np.uint8(accumulator & np.uint64(0xFF))
+      accumulator >>= np.uint64(8)
+      bits -= 8
+      j += 1
+  if bits > 0:
+    out[j] = np.uint8(accumulator & np.uint64(0xFF))
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def unpack_bits(packed, bit_depth, out):
+  """Inverse of pack_bits(), fills the flat array out."""
+  # All unsigned 64 bit, mixing in signed counters makes numba fall back to slow conversions
+  mask = np.uint64((1 << bit_depth) - 1)
+  depth = np.uint64(bit_depth)
+  accumulator = np.uint64(0)
+  bits = np.uint64(0)
+  j = 0
+  for i in range(out.size):
+    if bits < depth:
+      # At most two bytes are needed for a value of up to 16 bits
+      accumulator |= np.uint64(packed[j]) << bits
+      j += 1
+      bits += np.uint64(8)
+      if bits < depth:
+        accumulator |= np.uint64(packed[j]) << bits
+        j += 1
+        bits += np.uint64(8)
+    out[i] = accumulator & mask
+    accumulator >>= depth
+    bits -= depth
+
+def packed_size(value_count, bit_depth):
+  return (value_count * bit_depth + 7) // 8
+
+def import_zstandard():
+  """zstandard, an optional dependency only needed for zstd compressed archives."""
+  try:
+    import zstandard
+  except ImportError:
+    raise ValueError("zstd archives need zstandard (pip3 install zstandard), or use the zlib codec")
+  return zstandard
+
+def get_compressor(codec, level):
+  """Function compressing one chunk of bytes with codec (one of CODECS) at level."""
+  if codec not in CODECS:
+    raise ValueError("Unknown archive codec {}, expected one of {}".format(codec, CODECS))
+  if codec == 'zstd':
+    return import_zstandard().ZstdCompressor(level=level).compress
+  return lambda data: zlib.compress(data, level)
+
+def get_decompressor(codec):
+  if codec not in CODECS:
+    raise ValueError("Unknown archive codec {}, expected one of {}".format(codec, CODECS))
+  if codec == 'zstd':
+    return import_zstandard().ZstdDecompressor().decompress
+  return zlib.decompress
+
+# EXIF values are kept as (type, string) pairs, which turn back into the types pyexiv2 gives
+
+def encode_exif_value(value):
+  if isinstance(value, datetime.datetime):
+    return ['datetime', value.isoformat()]
+  if isinstance(value, fractions.Fraction):
+    return ['fraction', str(value)]
+  if isinstance(value, bool) or not isinstance(value, (int, float)):
+    return ['str', str(value)]
+  return [type(value).__name__, value]
+
+def decode_exif_value(encoded_value):
+  value_type, value = encoded_value
+  if value_type == 'datetime':
+    return datetime.datetime.fromisoformat(value)
+  if value_type == 'fraction':
+    return fractions.Fraction(value)
+  return value
+
+class ArchivedTag:
+  """Stands in for a pyexiv2 ExifTag, only value is available."""
+
+  def __init__(self, key, value):
+    self.key = key
+    self.value = value
+
+  def __str__(self):
+    return '<{} = {}>'.format(self.key, self.value)
+
+class ArchivedMetadata:
+  """Stands in for pyexiv2 ImageMetadata with the EXIF_KEYS tags stored in an archive."""
+
+  def __init__(self, exif):
+    self.tags = dict((key, ArchivedTag(key, decode_exif_value(value))) for key, value in exif.items())
+    self.exif_keys = list(self.tags)
+
+  def __getitem__(self, key):
+    return self.tags[key]
+
+def get_exif(metadata):
+  """The EXIF_KEYS tags of pyexiv2 metadata, encoded for the archive header.  Missing tags are left out."""
+  exif = {}
+  for key in EXIF_KEYS:
+    try:
+      exif[key] = encode_exif_value(metadata[key].value)
+    except (KeyError, ValueError):
+      continue
+  return exif
+
+def get_bit_depth(raw_image_visible):
+  """Bits needed for the largest value in the frame (at least 1), so packing is always lossless."""
+  return max(int(raw_image_visible.max()).bit_length(), 1)
+
+def get_plane_layout(shape, raw_pattern, color_plane_map):
+  """List of (name, (row offset, col offset), plane shape) for every CFA site of a visible image of shape."""
+  rows, cols = shape
+  layout = []
+  for color_plane_name, (row_offset, col_offset) in zip(color_plane_map, raw.get_color_plane_offsets(raw_pattern)):
+    plane_shape = (len(range(row_offset, rows, 2)), len(range(col_offset, cols, 2)))
+    layout.append((color_plane_name, (row_offset, col_offset), plane_shape))
+  return layout
+
+def get_tiles(plane_shape, tile):
+  """(row slice, col slice) of every tile of a plane, row by row."""
+  rows, cols = plane_shape
+  return [
+      (slice(row, min(row + tile, rows)), slice(col, min(col + tile, cols)))
+      for row in range(0, rows, tile)
+      for col in range(0, cols, tile)
+  ]
+
+def write_archive(archive_filename, raw_image_visible, raw_info, exif, codec=DEFAULT_CODEC, level=None,
+                  tile=DEFAULT_TILE, source=None):
+  """
+    Write the visible CFA array raw_image_visible to archive_filename.  raw_info is RawFrame.raw_info, exif the
+    encoded tags from get_exif() and source the name of the RAW file it came from.
+
+    The header holds: version, source, shape and dtype of the visible image, bit_depth, codec, level, tile,
+    raw_info, exif and planes, a list with the name, CFA offset, shape and chunk (offset, length) list of each
+    color plane.  Returns the header.
+  """
+  if level is None:
+    level = DEFAULT_LEVELS.get(codec)
+  if tile <= 0:
+    raise ValueError("Archive tiles need a positive size, got {}".format(tile))
+  compress = get_compressor(codec, level)
+
+  color_plane_map = raw.get_color_plane_map(raw_info['num_colors'] + 1, raw_info['color_desc'])
+  bit_depth = get_bit_depth(raw_image_visible)
+  if bit_depth > 16:
+    raise ValueError("Archives hold up to 16 bit sensor data, got {} bits".format(bit_depth))
+
+  with profiling.stage('encode'):
+    chunks = []
+    offset = 0
+    planes = []
+    for color_plane_name, (row_offset, col_offset), plane_shape in get_plane_layout(
+        raw_image_visible.shape, raw_info['raw_pattern'], color_plane_map):
+      color_plane = raw_image_visible[row_offset::2, col_offset::2]
+      plane_chunks = []
+      for tile_rows, tile_cols in get_tiles(plane_shape, tile):
+        values = np.ascontiguousarray(color_plane[tile_rows, tile_cols]).ravel()
+        packed = np.empty(packed_size(values.size, bit_depth), dtype=np.uint8)
+        pack_bits(values, bit_depth, packed)
+        chunk = compress(packed.tobytes())
+        chunks.append(chunk)
+        plane_chunks.append([offset, len(chunk)])
+        offset += len(chunk)
+      planes.append({
+          'name': color_plane_name,
+          'offset': [row_offset, col_offset],
+          'shape': list(plane_shape),
+          'chunks': plane_chunks,
+      })
+
+    header = {
+        'version': VERSION,
+        'source': source,
+        'shape': list(raw_image_visible.shape),
+        'dtype': raw_image_visible.dtype.str,
+        'bit_depth': bit_depth,
+        'codec': codec,
+        'level': level,
+        'tile': tile,
+        'raw_info': dict(raw_info, color_desc=raw_info['color_desc'].decode()),
+        'exif': exif,
+        'planes': planes,
+    }
+    header_bytes = json.dumps(header).encode()
+
+  with profiling.stage('write'):
+    with open(archive_filename, 'wb') as archive_file:
+      archive_file.write(MAGIC)
+      archive_file.write(struct.pack('<I', len(header_bytes)))
+      archive_file.write(header_bytes)
+      for chunk in chunks:
+        archive_file.write(chunk)
+  profiling.add_bytes_written(archive_filename)
+
+  return header
+
+def archive_writer(raw_frame, codec=DEFAULT_CODEC, level=None, tile=DEFAULT_TILE):
+  """batch.run() task, archive the whole visible sensor data of raw_frame to <raw>.rcfa"""
+  if raw_frame.roi is not None:
+    raise ValueError("Archives hold the whole visible sensor, they can't be written from a region of interest")
+
+  write_archive(
+      raw_frame.filename + ARCHIVE_EXTENSION,
+      raw_frame.raw_image_visible,
+      raw_frame.raw_info,
+      get_exif(raw_frame.metadata),
+      codec=codec,
+      level=level,
+      tile=tile,
+      source=raw_frame.filename
+  )
+
+class ArchiveReader:
+  """
+    Reads the header of an archive, and then tiles on demand.  source is a filename or the file contents (e.g.
+    prefetched by rastro.pipeline).  Use it as a context manager, or call close().
+  """
+
+  def __init__(self, source):
+    if isinstance(source, (bytes, bytearray)):
+      self.archive_file = io.BytesIO(source)
+      self.filename = None
+    else:
+      self.archive_file = open(source, 'rb')
+      self.filename = source
+
+    try:
+      with profiling.stage('read'):
+        magic = self.archive_file.read(len(MAGIC))
+        if magic != MAGIC:
+          raise ValueError("{} is not a rastro CFA archive".format(self.filename or 'Buffer'))
+        header_length, = struct.unpack('<I', self.archive_file.read(4))
+        self.header = json.loads(self.archive_file.read(header_length).decode())
+      self.data_offset = len(MAGIC) + 4 + header_length
+      if self.header['version'] > VERSION:
+        raise ValueError("{} is a version {} archive, this rastro reads up to version {}".format(
+            self.filename, self.header['version'], VERSION))
+    except Exception:
+      self.close()
+      raise
+
+    self.shape = tuple(self.header['shape'])
+    self.dtype = np.dtype(self.header['dtype'])
+    self.planes = dict((plane['name'], plane) for plane in self.header['planes'])
+    self.decompress = get_decompressor(self.header['codec'])
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    if self.archive_file is not None:
+      self.archive_file.close()
+      self.archive_file = None
+
+  @property
+  def raw_info(self):
+    raw_info = dict(self.header['raw_info'])
+    raw_info['color_desc'] = raw_info['color_desc'].encode()
+    return raw_info
+
+  @property
+  def metadata(self):
+    return ArchivedMetadata(self.header['exif'])
+
+  def read_tile(self, plane, tile_index, tile_shape):
+    chunk_offset, chunk_length = plane['chunks'][tile_index]
+    with profiling.stage('read'):
+      self.archive_file.seek(self.data_offset + chunk_offset)
+      chunk = self.archive_file.read(chunk_length)
+    profiling.add_bytes_read(chunk_length)
+
+    with profiling.stage('decode'):
+      packed = np.frombuffer(self.decompress(chunk), dtype=np.uint8)
+      values = np.empty(tile_shape[0] * tile_shape[1], dtype=self.dtype)
+      unpack_bits(packed, self.header['bit_depth'], values)
+    return values.reshape(tile_shape)
+
+  def read_plane(self, color_plane_name, rows=None, cols=None, out=None):
+    """
+      Read plane rows and cols (slices in plane pixels, all of them by default) of color_plane_name into out
+      (allocated when not given) and return it.  Only the tiles overlapping the region are decompressed.
+    """
+    plane = self.planes[color_plane_name]
+    plane_rows, plane_cols = plane['shape']
+    row0, row1, _ = (rows or slice(None)).indices(plane_rows)
+    col0, col1, _ = (cols or slice(None)).indices(plane_cols)
+    if out is None:
+      out = np.empty((max(row1 - row0, 0), max(col1 - col0, 0)), dtype=self.dtype)
+
+    tile = self.header['tile']
+    tiles_per_row = math.ceil(plane_cols / tile)
+    for tile_row in range(row0 // tile, math.ceil(row1 / tile)):
+      for tile_col in range(col0 // tile, math.ceil(col1 / tile)):
+        tile_row0, tile_col0 = tile_row * tile, tile_col * tile
+        tile_shape = (min(tile, plane_rows - tile_row0), min(tile, plane_cols - tile_col0))
+        values = self.read_tile(plane, tile_row * tiles_per_row + tile_col, tile_shape)
+
+        # Overlap of the tile and the region, in plane pixels
+        overlap_row0, overlap_row1 = max(row0, tile_row0), min(row1, tile_row0 + tile_shape[0])
+        overlap_col0, overlap_col1 = max(col0, tile_col0), min(col1, tile_col0 + tile_shape[1])
+        out[overlap_row0 - row0:overlap_row1 - row0, overlap_col0 - col0:overlap_col1 - col0] = values[
+            overlap_row0 - tile_row0:overlap_row1 - tile_row0, overlap_col0 - tile_col0:overlap_col1 - tile_col0]
+
+    return out
+
+  def read_cfa(self, roi=None):
+    """
+      The visible CFA array, or only the region of interest roi (x0, y0, width, height, aligned with
+      raw.align_roi()) of it, put back together from the color planes.
+    """
+    if roi is None:
+      x0, y0, width, height = 0, 0, self.shape[1], self.shape[0]
+    else:
+      x0, y0, width, height = roi
+
+    raw_image_visible = np.empty((height, width), dtype=self.dtype)
+    for plane in self.header['planes']:
+      row_offset, col_offset = plane['offset']
+      # An aligned origin is even, so each plane's sites in the region start at plane pixel origin / 2
+      self.read_plane(
+          plane['name'],
+          slice(y0 // 2, y0 // 2 + len(range(row_offset, height, 2))),
+          slice(x0 // 2, x0 // 2 + len(range(col_offset, width, 2))),
+          out=raw_image_visible[row_offset::2, col_offset::2]
+      )
+    return raw_image_visible
+
+def read_plane(archive_filename, color_plane_name, rows=None, cols=None):
+  """One color plane (or the rows and cols slices of it) of an archive, see ArchiveReader.read_plane()."""
+  with ArchiveReader(archive_filename) as archive_reader:
+    return archive_reader.read_plane(color_plane_name, rows, cols)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+"""
+Opt-in on-disk cache of decoded RAW sensor data.
+
+Each entry is the visible CFA array as a .npy file plus a small .json file with the rawpy details needed to
+slice it into color planes (and print stats).  Entries are keyed by a hash of the RAW file contents and the
+rawpy/libraw versions, so an edited file or a libraw upgrade never returns stale data.
+
+Cached arrays are loaded with np.load(mmap_mode='r'), so a repeat run over the same files costs a hash of the
+file and a page cache hit instead of a libraw decode.  The cache is bounded in size, the least recently used
+entries are evicted first (an entry's mtime is its last use).
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import rawpy
+
+def get_cache_key(buffer):
+  """Hex key for a RAW file's contents as decoded by this rawpy and libraw."""
+  key_hash = hashlib.blake2b(buffer, digest_size=20)
+  key_hash.update('rawpy {} libraw {}'.format(rawpy.__version__, rawpy.libraw_version).encode())
+  return key_hash.hexdigest()
+
+class PlaneCache:
+  """
+     Cache directory holding at most max_bytes of entries.  Only the directory and size limit are stored, so
+     it pickles cheaply and every batch worker process can share the same cache.
+  """
+
+  def __init__(self, cache_dir, max_bytes):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    os.makedirs(cache_dir, exist_ok=True)
+
+  def get_key(self, buffer):
+    return get_cache_key(buffer)
+
+  def get_filenames(self, key):
+    entry_prefix = os.path.join(self.cache_dir, key)
+    return entry_prefix + '.npy', entry_prefix + '.json'
+
+  def load(self, key):
+    """Return (raw_image_visible as a read only memory map, raw info dictionary) or None when not cached."""
+    npy_filename, json_filename = self.get_filenames(key)
+    try:
+      with open(json_filename) as json_file:
+        raw_info = json.load(json_file)
+      raw_image_visible = np.load(npy_filename, mmap_mode='r')
+    except (OSError, ValueError):
+      # Missing, evicted under us or half written by a crashed run, decode again
+      return None
+
+    # Mark as recently used
+    for filename in (npy_filename, json_filename):
+      try:
+        os.utime(filename)
+      except OSError:
+        pass
+
+    raw_info['color_desc'] = raw_info['color_desc'].encode()
+    return raw_image_visible, raw_info
+
+  def store(self, key, raw_image_visible, raw_info):
+    """Add an entry, then evict old ones until the cache fits in max_bytes again."""
+    npy_filename, json_filename = self.get_filenames(key)
+    raw_info = dict(raw_info, color_desc=raw_info['color_desc'].decode())
+
+    # Write to temporary names and rename, so concurrent workers never see a partial entry.  The .json is
+    # renamed last since load() reads it first.
+    for filename, write in (
+        (npy_filename, lambda f: np.save(f, raw_image_visible)),
+        (json_filename, lambda f: f.write(json.dumps(raw_info).encode()))
+    ):
+      temp_fd, temp_filename = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+      try:
+        with os.fdopen(temp_fd, 'wb') as temp_file:
+          write(temp_file)
+        os.replace(temp_filename, filename)
+      except BaseException:
+        os.unlink(temp_filename)
+        raise
+
+    self.evict()
+
+  def evict(self):
+    """Delete least recently used entries until the cache is no bigger than max_bytes."""
+    entries = {}
+    for entry in os.scandir(self.cache_dir):
+      key, extension = os.path.splitext(entry.name)
+      if extension not in ('.npy', '.json'):
+        continue
+      try:
+        stat = entry.stat()
+      except OSError:
+        continue
+      last_used, size = entries.get(key, (0, 0))
+      entries[key] = (max(last_used, stat.st_mtime), size + stat.st_size)
+
+    total_bytes = sum(size for last_used, size in entries.values())
+    for key, (last_used, size) in sorted(entries.items(), key=lambda entry: entry[1][0]):
+      if total_bytes <= self.max_bytes:
+        break
+      for filename in self.get_filenames(key):
+        try:
+          os.unlink(filename)
+        except OSError:
+          pass
+      total_bytes -= size
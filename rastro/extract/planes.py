@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+"""
+Plane combination kernels: the uninterpolated RGB image and the derived green planes, written straight into a
+caller supplied (e.g. memory mapped) output array.
+
+  Gi     the average of G1 and G2, half resolution like the other color planes (rawtran's "Gi" plane)
+  Gfull  full resolution green, G1 and G2 at their own sensor sites and bilinearly interpolated from the four
+         green neighbors at the red and blue sites
+
+and the block averaged RGB image behind previews (see rastro.convert.preview).
+
+The numba kernels make one pass over the input planes and never allocate, integer data is averaged with
+integer arithmetic (floor of the mean, like the float64 average cast to uint16 used to give).
+
+Writers that only need an output plane until it has been written put it in a scratch buffer (see
+get_scratch_buffer()), which the next frame of the same size reuses instead of allocating a new one.
+"""
+
+import threading
+
+import numba
+import numpy as np
+
+from rastro.extract import raw
+
+GREEN_PLANE_NAMES = ['Gi', 'Gfull']
+
+# Scratch buffers are per thread, so pipelined batches (rastro.pipeline) can write several frames at once
+_thread_state = threading.local()
+
+def get_scratch_buffer(name, shape, dtype):
+  """
+    This thread's buffer called name, reallocated only when the shape or dtype changes.  Its contents are only
+    valid until the next call with the same name in the same thread.
+  """
+  if not hasattr(_thread_state, 'buffers'):
+    _thread_state.buffers = {}
+  buffer = _thread_state.buffers.get(name)
+  if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != np.dtype(dtype):
+    buffer = _thread_state.buffers[name] = np.empty(shape, dtype=dtype)
+  return buffer
+
+# cache=True keeps the compiled kernels on disk, see stats.cfa_histograms()
+@numba.jit(nopython=True, nogil=True, cache=True)
+def interleave_rgb_kernel(red, green1, green2, blue, out):
+  """Integer kernel, out[..., 0] = R, out[..., 1] = floor((G1 + G2) / 2), out[..., 2] = B."""
+  rows, cols = red.shape
+  for row in range(rows):
+    for col in range(cols):
+      out[row, col, 0] = red[row, col]
+      out[row, col, 1] = (np.int64(green1[row, col]) + np.int64(green2[row, col])) >> 1
+      out[row, col, 2] = blue[row, col]
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def block_average_rgb_kernel(red, green1, green2, blue, factor, out):
+  """
+    out[row, col] = floor of the mean R, (G1 + G2) / 2 and B over each factor x factor block of the planes.
+    Planes are read row by row, trailing rows and columns that don't fill a block are left out.
+  """
+  rows, cols = out.shape[0], out.shape[1]
+  count = factor * factor
+  sums = np.zeros((cols, 3), dtype=np.int64)
+  for row in range(rows):
+    sums[:] = 0
+    for plane_row in range(row * factor, (row + 1) * factor):
+      for plane_col in range(cols * factor):
+        col = plane_col // factor
+        sums[col, 0] += red[plane_row, plane_col]
+        sums[col, 1] += np.int64(green1[plane_row, plane_col]) + np.int64(green2[plane_row, plane_col])
+        sums[col, 2] += blue[plane_row, plane_col]
+    for col in range(cols):
+      out[row, col, 0] = sums[col, 0] // count
+      out[row, col, 1] = sums[col, 1] // (2 * count)
+      out[row, col, 2] = sums[col, 2] // count
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def interpolate_edge_site(out, row, col, integer):
+  """Mean of the (two or three) orthogonal neighbors of a site on the edge of out."""
+  rows, cols = out.shape
+  total = 0.0
+  count = 0
+  if row > 0:
+    total += out[row - 1, col]
+    count += 1
+  if row < rows - 1:
+    total += out[row + 1, col]
+    count += 1
+  if col > 0:
+    total += out[row, col - 1]
+    count += 1
+  if col < cols - 1:
+    total += out[row, col + 1]
+    count += 1
+  value = total / count
+  if integer:
+    value = np.floor(value)
+  out[row, col] = value
+
+@numba.jit(nopython=True, nogil=True, cache=True)
+def interpolate_green_kernel(out, row_offset, col_offset, integer):
+  """
+    Fill the non green sites of a full resolution green plane whose green sites are already set.  Non green
+    sites are at (row_offset + 2i, col_offset + 2j) and the other (1 - row_offset, 1 - col_offset) ones, each
+    gets the mean of its (up to) four orthogonal neighbors, floored for integer data.
+  """
+  rows, cols = out.shape
+  for site_row_offset, site_col_offset in ((row_offset, col_offset), (1 - row_offset, 1 - col_offset)):
+    for row in range(site_row_offset, rows, 2):
+      if row == 0 or row == rows - 1:
+        for col in range(site_col_offset, cols, 2):
+          interpolate_edge_site(out, row, col, integer)
+        continue
+
+      # Interior rows, only the first and last column can be on the edge
+      col = site_col_offset
+      if col == 0:
+        interpolate_edge_site(out, row, col, integer)
+        col += 2
+      while col < cols - 1:
+        total = out[row - 1, col] + out[row + 1, col] + out[row, col - 1] + out[row, col + 1]
+        if integer:
+          out[row, col] = total // 4
+        else:
+          out[row, col] = total * 0.25
+        col += 2
+      if col == cols - 1:
+        interpolate_edge_site(out, row, col, integer)
+
+def is_integer(*arrays):
+  return all(np.issubdtype(array.dtype, np.integer) for array in arrays)
+
+def interleave_rgb(color_planes, out):
+  """
+    Write R, the averaged green and B of a color plane dictionary into the (rows, cols, 3) array out, e.g. a
+    memory mapped RGB TIFF, without any full size temporary.
+  """
+  red, green1, green2, blue = (color_planes[name]['2D'] for name in ('R', 'G1', 'G2', 'B'))
+  if is_integer(red, green1, green2, blue, out):
+    interleave_rgb_kernel(red, green1, green2, blue, out)
+  else:
+    # Calibrated float planes, still in place just not fused
+    np.copyto(out[..., 0], red, casting='unsafe')
+    raw.average_green_color_plane(green1, green2, out[..., 1])
+    np.copyto(out[..., 2], blue, casting='unsafe')
+
+def block_average_rgb(color_planes, factor, out=None):
+  """
+    RGB image of integer color planes shrunk by factor in each direction (see block_average_rgb_kernel()), into
+    out (allocated when not given) which is returned.
+  """
+  red, green1, green2, blue = (color_planes[name]['2D'] for name in ('R', 'G1', 'G2', 'B'))
+  if not is_integer(red, green1, green2, blue):
+    raise ValueError("Block averaging needs integer color planes, got {}".format(red.dtype))
+  if out is None:
+    out = np.empty((red.shape[0] // factor, red.shape[1] // factor, 3), dtype=red.dtype)
+  block_average_rgb_kernel(red, green1, green2, blue, factor, out)
+  return out
+
+def get_green_offsets(raw_frame):
+  """(row, col) sensor offsets of G1 and G2, which have to sit on a diagonal of the 2x2 Bayer pattern."""
+  color_plane_offsets = dict(zip(raw_frame.color_plane_map, raw.get_color_plane_offsets(raw_frame.raw_pattern)))
+  if 'G1' not in color_plane_offsets or 'G2' not in color_plane_offsets:
+    raise ValueError("Green planes need G1 and G2 color planes, got {}".format(list(color_plane_offsets)))
+
+  green1_offsets, green2_offsets = color_plane_offsets['G1'], color_plane_offsets['G2']
+  if green1_offsets[0] == green2_offsets[0] or green1_offsets[1] == green2_offsets[1]:
+    raise ValueError("Unsupported CFA pattern {}, G1 and G2 must be diagonal neighbors".format(
+        raw_frame.raw_pattern.tolist()))
+  return green1_offsets, green2_offsets
+
+def green_plane_shape(raw_frame, green_plane_name):
+  rows, cols = raw_frame.color_planes['G1']['2D'].shape
+  if green_plane_name == 'Gfull':
+    return (2 * rows, 2 * cols)
+  return (rows, cols)
+
+def get_green_plane(raw_frame, green_plane_name, out=None, reuse=False):
+  """
+    Compute green_plane_name (one of GREEN_PLANE_NAMES) of raw_frame into out, allocated with the green planes'
+    dtype when not given (or taken from the scratch buffer of that name with reuse), and return it.
+  """
+  if green_plane_name not in GREEN_PLANE_NAMES:
+    raise ValueError("Unknown green plane {}, expected one of {}".format(green_plane_name, GREEN_PLANE_NAMES))
+
+  green1_offsets, green2_offsets = get_green_offsets(raw_frame)
+  color_planes = raw_frame.color_planes
+  green1_color_plane = color_planes['G1']['2D']
+  green2_color_plane = color_planes['G2']['2D']
+  if out is None:
+    shape = green_plane_shape(raw_frame, green_plane_name)
+    dtype = np.result_type(green1_color_plane, green2_color_plane)
+    if reuse:
+      out = get_scratch_buffer(green_plane_name, shape, dtype)
+    else:
+      out = np.empty(shape, dtype=dtype)
+
+  if green_plane_name == 'Gi':
+    raw.average_green_color_plane(green1_color_plane, green2_color_plane, out)
+  else:
+    # Greens where they were on the sensor, then the red and blue sites in between
+    np.copyto(out[green1_offsets[0]::2, green1_offsets[1]::2], green1_color_plane, casting='unsafe')
+    np.copyto(out[green2_offsets[0]::2, green2_offsets[1]::2], green2_color_plane, casting='unsafe')
+    interpolate_green_kernel(out, green1_offsets[0], green2_offsets[1], is_integer(out))
+
+  return out
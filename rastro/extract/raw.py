@@ -3,41 +3,231 @@ import rawpy
 import io
 
 import numpy as np
-import numpy.ma as ma
 
 import pyexiv2
 from pyexiv2.exif import ExifTag, ExifValueError
 
-#class Image:
-#
-#  def __init__(self, file):
-#    self.file = file
-#
-#
-#
-#class MetaData:
-#  pass
-#
-#class Raw:
-#
-#  def __init__(self, file):
-#    self.file = file
-#
-#  def read(self):
-#    metadata = pyexiv2.ImageMetadata(self.file)
-#    metadata.read()
-#
-#    set_metadata(metadata)
-#
-#    # Create io buffer to re-use with rawpy
-#    byteio = io.BytesIO(metadata.buffer)
-#
-#    get_colorplanes(byteio)
-#
-#  def set_metadata(self, metadata):
-#    pass
-#
+from rastro import profiling
 
+# rastro CFA archives (see rastro.extract.archive) are recognised by their extension, so the archive module (and
+# numba) is only imported when one is opened
+ARCHIVE_EXTENSION = '.rcfa'
+
+def is_archive(filename):
+  return isinstance(filename, str) and filename.lower().endswith(ARCHIVE_EXTENSION)
+
+class RawFrame:
+  """
+     A single RAW file which is read from disk once and decoded lazily.
+
+     The file contents are read into one immutable buffer which is shared by pyexiv2 (EXIF) and rawpy
+     (pixels).  EXIF is only parsed when metadata is first accessed, the sensor data is only decoded when
+     the pixels are first accessed and the color plane views are cached, so writers and analyzers can all
+     be handed the same frame without paying for any of it twice.
+
+     history lists the processing steps (e.g. calibration) applied to the color planes after extraction, so
+     writers can record them in their output headers.
+
+     Color plane views point into libraw memory and are only valid until close() is called, use it as a
+     context manager:
+
+       with RawFrame(raw_filename) as raw_frame:
+         tiff.rgb_writer(raw_frame)
+
+     With a cache (rastro.extract.cache.PlaneCache) the visible sensor data and raw_info are memory mapped
+     from a previous decode of the same file contents when there is one, and stored after decoding otherwise.
+
+     With a region of interest roi (x0, y0, width, height in visible sensor pixels) raw_image_visible, and so
+     everything sliced, analyzed or written from it, is only that region.  The region is aligned to the CFA
+     pattern (see align_roi()) when the sensor data is first accessed, after which roi holds the aligned one.
+     The cache always holds the whole sensor, so one entry serves any region.
+
+     buffer is the file contents when they have already been read, e.g. prefetched by rastro.pipeline.
+
+     A rastro CFA archive (see rastro.extract.archive) can be opened in place of a RAW file.  Its sensor data,
+     raw_info and EXIF subset come from the archive, libraw is never used and only the tiles covering the
+     region of interest are decompressed.  Archives aren't cached, reading them is already cheap.
+  """
+
+  def __init__(self, filename, cache=None, roi=None, buffer=None):
+    self.filename = filename
+    self.cache = cache
+    self.roi = roi
+    self._buffer = buffer
+    self._metadata = None
+    self._rawimage = None
+    self._raw_image_visible = None
+    self._raw_info = None
+    self._cache_key = None
+    self._color_plane_map = None
+    self._color_planes = None
+    self._archive_reader = None
+    self.history = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    # Drop the cached views before libraw frees the memory they point to
+    self._color_planes = None
+    self._raw_image_visible = None
+    if self._rawimage is not None:
+      self._rawimage.close()
+      self._rawimage = None
+    if self._archive_reader is not None:
+      self._archive_reader.close()
+      self._archive_reader = None
+    self._metadata = None
+    self._buffer = None
+
+  @property
+  def buffer(self):
+    """The raw file contents, read from disk exactly once."""
+    if self._buffer is None:
+      # pyexiv2 and rawpy both need a bytes object (an mmap would just be copied into one), so read the
+      # file in one go and share the result.
+      with profiling.stage('read'), open(self.filename, 'rb') as raw_file:
+        self._buffer = raw_file.read()
+      profiling.add_bytes_read(len(self._buffer))
+    return self._buffer
+
+  @property
+  def archive_reader(self):
+    """ArchiveReader of a rastro CFA archive, None for RAW files."""
+    if self._archive_reader is None and is_archive(self.filename):
+      from rastro.extract import archive
+
+      # Only the header is read here, tiles are read as they're needed unless the contents were prefetched
+      self._archive_reader = archive.ArchiveReader(self._buffer if self._buffer is not None else self.filename)
+    return self._archive_reader
+
+  @property
+  def metadata(self):
+    """pyexiv2 ImageMetadata parsed from the shared buffer on first access (the EXIF subset of an archive)."""
+    if self._metadata is None and self.archive_reader is not None:
+      self._metadata = self.archive_reader.metadata
+    if self._metadata is None:
+      buffer = self.buffer
+      with profiling.stage('exif'):
+        # see: https://python3-exiv2.readthedocs.io/en/latest/api.html#buffer
+        metadata = pyexiv2.ImageMetadata.from_buffer(buffer)
+        metadata.read()
+      self._metadata = metadata
+    return self._metadata
+
+  @property
+  def rawimage(self):
+    """Open rawpy object backed by the shared buffer."""
+    if self._rawimage is None:
+      # BytesIO does not copy a bytes object and hands the very same object back from read(), which is
+      # what rawpy passes on to libraw.
+      buffer = self.buffer
+      with profiling.stage('decode'):
+        self._rawimage = rawpy.imread(io.BytesIO(buffer))
+    return self._rawimage
+
+  def load_archived(self):
+    """Fill in raw_image_visible and raw_info from an archive, returns False for RAW files."""
+    archive_reader = self.archive_reader
+    if archive_reader is None:
+      return False
+    self._raw_info = archive_reader.raw_info
+    if self.roi is not None:
+      self.roi = align_roi(self.roi, archive_reader.shape)
+    self._raw_image_visible = archive_reader.read_cfa(self.roi)
+    return True
+
+  def load_cached(self):
+    """Fill in raw_image_visible and raw_info from the cache, returns False when there is no entry (or cache)."""
+    if self.cache is None or is_archive(self.filename):
+      return False
+    buffer = self.buffer
+    with profiling.stage('cache'):
+      if self._cache_key is None:
+        self._cache_key = self.cache.get_key(buffer)
+      cached = self.cache.load(self._cache_key)
+    if cached is None:
+      return False
+    raw_image_visible, self._raw_info = cached
+    self.set_raw_image_visible(raw_image_visible)
+    return True
+
+  def set_raw_image_visible(self, raw_image_visible):
+    """Keep the whole visible sensor data, or a view of just the region of interest."""
+    if self.roi is not None:
+      self.roi = align_roi(self.roi, raw_image_visible.shape)
+      raw_image_visible = crop_roi(raw_image_visible, self.roi)
+    self._raw_image_visible = raw_image_visible
+
+  @property
+  def raw_image_visible(self):
+    """
+       Visible CFA sensor data (only the region of interest when there is one), decoded by libraw (or memory
+       mapped from the cache) on first access.
+    """
+    if self._raw_image_visible is None and not self.load_archived() and not self.load_cached():
+      rawimage = self.rawimage
+      with profiling.stage('decode'):
+        # Unpacks the sensor data
+        raw_image_visible = rawimage.raw_image_visible
+      if self.cache is not None:
+        raw_info = self.raw_info
+        with profiling.stage('cache'):
+          self.cache.store(self._cache_key, raw_image_visible, raw_info)
+      self.set_raw_image_visible(raw_image_visible)
+    return self._raw_image_visible
+
+  @property
+  def raw_info(self):
+    """
+       The rawpy details needed to interpret raw_image_visible (and reported by analyze stats), as a dictionary
+       which can be cached along with the sensor data.
+    """
+    if self._raw_info is None and self.archive_reader is not None:
+      self._raw_info = self.archive_reader.raw_info
+    if self._raw_info is None and not self.load_cached():
+      rawimage = self.rawimage
+      # The black and white levels need the sensor data unpacked
+      with profiling.stage('decode'):
+        self._raw_info = {
+            'raw_pattern': rawimage.raw_pattern.tolist(),
+            'color_desc': rawimage.color_desc,
+            'num_colors': rawimage.num_colors,
+            'black_level_per_channel': rawimage.black_level_per_channel,
+            'white_level': rawimage.white_level,
+            'camera_whitebalance': rawimage.camera_whitebalance,
+            'daylight_whitebalance': rawimage.daylight_whitebalance,
+            # Only ever printed
+            'raw_type': str(rawimage.raw_type),
+            'sizes': str(rawimage.sizes),
+        }
+    return self._raw_info
+
+  @property
+  def raw_pattern(self):
+    return np.array(self.raw_info['raw_pattern'])
+
+  @property
+  def color_plane_map(self):
+    if self._color_plane_map is None:
+      self._color_plane_map = get_color_plane_map(self.raw_info['num_colors'] + 1, self.raw_info['color_desc'])
+    return self._color_plane_map
+
+  @property
+  def color_planes(self):
+    """Cached color plane dictionary of strided views, see extract_color_planes()."""
+    if self._color_planes is None:
+      raw_image_visible = self.raw_image_visible
+      with profiling.stage('extract'):
+        self._color_planes = extract_color_planes(
+            raw_image_visible,
+            self.raw_pattern,
+            self.color_plane_map
+        )
+    return self._color_planes
 
 
 def get_color_plane_map(color_plane_count, color_desc):
@@ -57,10 +247,104 @@ def get_color_plane_map(color_plane_count, color_desc):
 
   return color_plane_map
 
-def reader(raw_filename):
+def get_color_plane_offsets(raw_pattern):
   """
-     Takes a RAW filename as an argument and returns a dictionary containing 1D and 2D representations of
-     the image data.
+     Takes the 2x2 CFA pattern reported by libraw (raw_pattern) and returns a list of (row, column) offsets
+     indexed by color plane index.  The offsets are relative to the top left corner of the visible image area.
+  """
+  pattern = np.asarray(raw_pattern)
+
+  # TODO: Support non Bayer sensors (e.g. Fuji X-Trans 6x6 patterns)
+  if pattern.shape != (2, 2):
+    raise ValueError("Unsupported CFA pattern shape {}, only 2x2 Bayer patterns are supported".format(pattern.shape))
+
+  color_plane_offsets = [None] * pattern.size
+  for (row, col), color_plane_index in np.ndenumerate(pattern):
+    if color_plane_index >= pattern.size or color_plane_offsets[color_plane_index] is not None:
+      raise ValueError("Unsupported CFA pattern {}, each color plane must appear exactly once".format(pattern.tolist()))
+    color_plane_offsets[color_plane_index] = (row, col)
+
+  return color_plane_offsets
+
+def align_roi(roi, shape):
+  """
+     Align a region of interest (x0, y0, width, height) to the 2x2 CFA pattern of a visible image of the given
+     (rows, cols) shape: the origin is moved down to even coordinates and the far edge up to even ones, so the
+     region only ever grows to whole CFA cells, then it is clipped to the image.  An even origin keeps
+     raw_pattern (and so the color plane names) valid for the cropped data.
+  """
+  x0, y0, width, height = roi
+  if width <= 0 or height <= 0 or x0 < 0 or y0 < 0:
+    raise ValueError("Invalid region of interest {}, expected x0,y0,width,height with a positive size".format(roi))
+
+  rows, cols = (dim - dim % 2 for dim in shape)
+  x1 = min(x0 + width + (x0 + width) % 2, cols)
+  y1 = min(y0 + height + (y0 + height) % 2, rows)
+  x0 -= x0 % 2
+  y0 -= y0 % 2
+  if x0 >= x1 or y0 >= y1:
+    raise ValueError("Region of interest {} is outside the {}x{} visible image".format(roi, shape[1], shape[0]))
+
+  return (x0, y0, x1 - x0, y1 - y0)
+
+def crop_roi(raw_image_visible, roi):
+  """View of an aligned region of interest (see align_roi()) of the visible CFA image."""
+  x0, y0, width, height = roi
+  return raw_image_visible[y0:y0 + height, x0:x0 + width]
+
+def extract_color_planes(raw_image_visible, raw_pattern, color_plane_map, copy=False):
+  """
+     Slice the visible CFA image into its color planes and return a color plane dictionary.
+
+     Each plane is a strided view ([r0::2, c0::2]) onto raw_image_visible, so no pixel data is copied unless
+     copy=True is passed.  Views are only valid for as long as raw_image_visible is, which matters when the
+     array belongs to an open rawpy object.
+
+     An odd number of visible rows or columns would give the planes different shapes, so the trailing row
+     and/or column is dropped and every plane ends up with the same half size shape.
+  """
+  color_plane_offsets = get_color_plane_offsets(raw_pattern)
+
+  # Trim to even dimensions so all the color planes line up
+  rows, cols = (dim - dim % 2 for dim in raw_image_visible.shape)
+
+  color_planes = {}
+  for i, (row_offset, col_offset) in enumerate(color_plane_offsets):
+    color_plane = raw_image_visible[row_offset:rows:2, col_offset:cols:2]
+    if copy:
+      color_plane = color_plane.copy()
+
+    color_planes[color_plane_map[i]] = {"2D": color_plane}
+
+  return color_planes
+
+def average_green_color_plane(green1_color_plane, green2_color_plane, out):
+  """
+    Write the average of the two green color planes into out (e.g. one channel of a memory mapped RGB TIFF)
+    without a float64 or overflowing intermediate.  Integer output gets floor((G1 + G2) / 2), floating point
+    output the exact average.
+  """
+  if (np.issubdtype(green1_color_plane.dtype, np.integer) and np.issubdtype(green2_color_plane.dtype, np.integer)
+      and np.issubdtype(out.dtype, np.integer)):
+    # (a & b) + ((a ^ b) >> 1) is the floor of the average and never exceeds the inputs' range
+    np.bitwise_xor(green1_color_plane, green2_color_plane, out=out, casting='unsafe')
+    np.right_shift(out, 1, out=out)
+    np.add(out, green1_color_plane & green2_color_plane, out=out, casting='unsafe')
+  elif np.issubdtype(out.dtype, np.floating):
+    # Summed in out's dtype, integer planes written into a float out must not wrap around in their own dtype
+    np.add(green1_color_plane, green2_color_plane, out=out, dtype=out.dtype)
+    out *= 0.5
+  else:
+    np.copyto(out, np.floor((green1_color_plane + green2_color_plane) / 2.0), casting='unsafe')
+
+def reader(raw_filename, copy=False, roi=None):
+  """
+     Takes a RAW filename (or file like object) as an argument and returns a dictionary containing 2D
+     representations of each color plane in the image data.
+
+     The planes are views onto a single copy of the visible sensor data, pass copy=True to get an
+     independent contiguous array per plane.  With roi (x0, y0, width, height, aligned with align_roi()) only
+     that region is copied and sliced.
   """
   # TODO: slurp out metadata in this function?
   # see: https://www.libraw.org/node/2352  not sure if rawpy supports this (yet).
@@ -71,24 +355,11 @@ def reader(raw_filename):
     # Extract individual color planes
     color_plane_map = get_color_plane_map(color_plane_count, raw.color_desc)
 
-    # Color plane dictionary 
-    # TODO: make this more pythony and use an OO approach
-    color_planes = {}
-    for i in range(color_plane_count):
-      color_planes[color_plane_map[i]] = {}
-
-      # TODO: Document exactly what is taking place with this numpy array transformation
-      mask = (raw.raw_colors_visible != i)
-      color_plane_masked = ma.masked_array(np.copy(raw.raw_image_visible), mask)
-      # TODO: Do camera sensors ever have an odd number of pixels in x/y?  This would skew results slightly.
-      half_size_shape = tuple(int(dim/2) for dim in raw.raw_image_visible.shape)
-      color_planes[color_plane_map[i]]["1D"] = color_plane_masked[~color_plane_masked.mask]
-
-      # Reshape the array
-      # TODO: Is this the best way?
-      # See: https://docs.scipy.org/doc/numpy/reference/generated/numpy.reshape.html
-      color_planes[color_plane_map[i]]["2D"] = np.reshape(color_planes[color_plane_map[i]]["1D"], half_size_shape)
-
-    return color_planes
-
+    # libraw frees raw_image_visible when the file is closed, so take one copy of the sensor data and hand
+    # out views onto it.
+    raw_image_visible = raw.raw_image_visible
+    if roi is not None:
+      raw_image_visible = crop_roi(raw_image_visible, align_roi(roi, raw_image_visible.shape))
+    raw_image_visible = np.copy(raw_image_visible)
 
+    return extract_color_planes(raw_image_visible, raw.raw_pattern, color_plane_map, copy=copy)
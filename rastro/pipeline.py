@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+rastro.pipeline: runs a batch.run() task over many RAW files in a single process, with the reading, decoding
+and encoding/writing of different files overlapped.
+
+  read    a reader thread reads the next files into memory ahead of the decoder
+  decode  a decoder thread has libraw decode the sensor data and slices the color planes
+  write   a pool of writer threads runs the task, i.e. the casts, compression and writing of the output files
+
+The stages are connected by bounded queues, so at most prefetch files are read ahead and only one decoded frame
+waits for a free writer: memory use stays at a few frames no matter how long the batch is.  libraw, zlib and
+numpy release the GIL while they work, so the disk is kept busy while the CPU decodes and compresses.  Writers
+build their output planes in per thread scratch buffers (see rastro.extract.planes.get_scratch_buffer()) which
+are reused from frame to frame instead of being allocated again.
+
+At the end the occupancy of every stage, the fraction of the wall time its threads were busy, is reported.  The
+busiest stage is the bottleneck: read on network storage, decode for a fast disk (use --jobs), write with heavy
+compression (use more writer threads).
+
+Per file times (and --profile 'other' time) include the time a file spent waiting in the queues.
+"""
+
+import contextlib
+import queue
+import threading
+import time
+
+from rastro import batch, profiling
+from rastro.extract import raw
+
+class PipelineFile:
+  """One file on its way through the pipeline, handed from stage to stage through the queues."""
+
+  def __init__(self, raw_filename, profile):
+    self.raw_filename = raw_filename
+    self.start_time = time.perf_counter()
+    self.file_profile = profiling.FileProfile() if profile else None
+    self.buffer = None
+    self.raw_frame = None
+    self.result = None
+    self.error = None
+    self.elapsed_time = None
+
+class StageOccupancy:
+  """Busy time of each stage's threads, added up from every thread."""
+
+  def __init__(self, thread_counts):
+    self.thread_counts = thread_counts
+    self.busy_times = dict.fromkeys(thread_counts, 0.0)
+    self.lock = threading.Lock()
+    self.start_time = time.perf_counter()
+
+  @contextlib.contextmanager
+  def busy(self, name):
+    start_time = time.perf_counter()
+    try:
+      yield
+    finally:
+      with self.lock:
+        self.busy_times[name] += time.perf_counter() - start_time
+
+  def occupancy(self):
+    """Fraction of the wall time so far each stage's threads spent working, between 0 and 1."""
+    wall_time = max(time.perf_counter() - self.start_time, 1e-9)
+    return {
+        name: self.busy_times[name] / (wall_time * thread_count)
+        for name, thread_count in self.thread_counts.items()
+    }
+
+  def report(self):
+    occupancy = self.occupancy()
+    print("Stage occupancy: {}, bottleneck: {}".format(
+        ", ".join(
+            "{} {:.0%}".format(name, occupancy[name])
+            + (" of {} threads".format(self.thread_counts[name]) if self.thread_counts[name] > 1 else "")
+            for name in self.thread_counts
+        ),
+        max(occupancy, key=occupancy.get)
+    ))
+
+def read_files(raw_filenames, read_queue, occupancy, profile):
+  """Reader thread, reads each file's contents into memory.  put() blocks while prefetch files are waiting."""
+  for raw_filename in raw_filenames:
+    pipeline_file = PipelineFile(raw_filename, profile)
+    with occupancy.busy('read'), profiling.activate(pipeline_file.file_profile):
+      try:
+        with profiling.stage('read'), open(raw_filename, 'rb') as raw_file:
+          pipeline_file.buffer = raw_file.read()
+        profiling.add_bytes_read(len(pipeline_file.buffer))
+      except Exception as error:
+        pipeline_file.error = error
+    read_queue.put(pipeline_file)
+  read_queue.put(None)
+
+def decode_files(read_queue, frame_queue, occupancy, writer_count, cache, roi):
+  """
+    Decoder thread, opens a RawFrame on each file's contents and decodes the color planes.  EXIF is left to be
+    parsed (if at all) by the writer.
+  """
+  while True:
+    pipeline_file = read_queue.get()
+    if pipeline_file is None:
+      break
+
+    if pipeline_file.error is None:
+      with occupancy.busy('decode'), profiling.activate(pipeline_file.file_profile):
+        raw_frame = raw.RawFrame(pipeline_file.raw_filename, cache=cache, roi=roi, buffer=pipeline_file.buffer)
+        try:
+          raw_frame.color_planes
+        except Exception as error:
+          pipeline_file.error = error
+          raw_frame.close()
+        else:
+          pipeline_file.raw_frame = raw_frame
+      # The RawFrame holds on to the contents for as long as it needs them
+      pipeline_file.buffer = None
+    frame_queue.put(pipeline_file)
+
+  for _ in range(writer_count):
+    frame_queue.put(None)
+
+def write_files(frame_queue, result_queue, occupancy, task, task_args, task_kwargs):
+  """Writer thread, runs the task on each decoded frame and closes it."""
+  while True:
+    pipeline_file = frame_queue.get()
+    if pipeline_file is None:
+      break
+
+    if pipeline_file.error is None:
+      with occupancy.busy('write'), profiling.activate(pipeline_file.file_profile):
+        try:
+          with pipeline_file.raw_frame as raw_frame:
+            pipeline_file.result = task(raw_frame, *task_args, **(task_kwargs or {}))
+        except Exception as error:
+          pipeline_file.error = error
+      pipeline_file.raw_frame = None
+    pipeline_file.elapsed_time = time.perf_counter() - pipeline_file.start_time
+    result_queue.put(pipeline_file)
+
+def run(task, raw_filenames, task_args=(), task_kwargs=None, threads=2, prefetch=2, on_result=None, cache=None,
+        profiler=None, roi=None):
+  """
+     Same as batch.run() with jobs=1 (task, on_result, cache, profiler and roi are used the same way), but with
+     up to prefetch files read ahead and the task run on threads writer threads.  Returns the list of
+     (raw_filename, error) tuples for the files that failed.
+
+     task_args and task_kwargs are shared by the writer threads, so the task must not modify them.
+  """
+  if threads < 1 or prefetch < 1:
+    raise ValueError("A pipeline needs at least one writer thread and one prefetched file, got {} and {}".format(
+        threads, prefetch))
+
+  total_count = len(raw_filenames)
+  failed = []
+  start_time = time.perf_counter()
+  profile = profiler is not None
+
+  read_queue = queue.Queue(maxsize=prefetch)
+  frame_queue = queue.Queue(maxsize=1)
+  result_queue = queue.Queue()
+  occupancy = StageOccupancy({'read': 1, 'decode': 1, 'write': threads})
+
+  # Daemon threads, so an interrupted batch doesn't hang waiting on them
+  stage_threads = [
+      threading.Thread(target=read_files, args=(raw_filenames, read_queue, occupancy, profile), daemon=True),
+      threading.Thread(target=decode_files, args=(read_queue, frame_queue, occupancy, threads, cache, roi), daemon=True),
+  ]
+  for _ in range(threads):
+    stage_threads.append(threading.Thread(
+        target=write_files,
+        args=(frame_queue, result_queue, occupancy, task, task_args, task_kwargs),
+        daemon=True
+    ))
+  for stage_thread in stage_threads:
+    stage_thread.start()
+
+  # Results are handed to on_result and the profiler from this thread only, in completion order
+  for done_count in range(1, total_count + 1):
+    pipeline_file = result_queue.get()
+    raw_filename = pipeline_file.raw_filename
+    try:
+      if pipeline_file.error is not None:
+        raise pipeline_file.error
+      if on_result is not None:
+        on_result(raw_filename, pipeline_file.result)
+      if profile:
+        profiler.add(raw_filename, pipeline_file.file_profile.as_dict(pipeline_file.elapsed_time))
+    except Exception as error:
+      failed.append((raw_filename, error))
+      batch.report_progress(done_count, total_count, raw_filename, error=error)
+    else:
+      batch.report_progress(done_count, total_count, raw_filename, pipeline_file.elapsed_time)
+
+  for stage_thread in stage_threads:
+    stage_thread.join()
+
+  batch.report_throughput(raw_filenames, failed, time.perf_counter() - start_time)
+  occupancy.report()
+
+  return failed
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""
+rastro.profiling: per stage timing of each file in a batch (--profile).
+
+The code paths that matter are wrapped in stage() blocks:
+
+  read       reading the RAW file into memory
+  exif       parsing EXIF
+  decode     libraw unpacking the sensor data
+  cache      loading or storing the decoded sensor data cache
+  extract    slicing the color planes
+  calibrate  applying master calibration frames
+  analysis   histograms, stats, bad pixel detection
+  encode     converting planes for output (casts, averaging, building HDUs)
+  write      writing output files, including any compression the TIFF/FITS library does while writing
+
+Stages nest, and each one only counts its own time, so e.g. the decode triggered from inside extract is not
+counted twice.  Time a file spent outside any stage is reported as 'other'.
+
+stage() does nothing unless a file is being profiled in this thread, so the instrumentation costs nothing
+normally.  The file being profiled is per thread, so the stages of a pipelined batch (rastro.pipeline), where
+one file is read, decoded and written by different threads, each land in that file's profile.
+"""
+
+import contextlib
+import csv
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+try:
+  import resource
+except ImportError:
+  # Not available on Windows, peak RSS just isn't reported there
+  resource = None
+
+STAGES = ['read', 'exif', 'decode', 'cache', 'extract', 'calibrate', 'analysis', 'encode', 'write', 'other']
+
+PERCENTILES = [50, 90, 99]
+
+class FileProfile:
+  """Stage times and byte counts of the file currently being processed."""
+
+  def __init__(self):
+    self.stages = {}
+    self.bytes_read = 0
+    self.bytes_written = 0
+    self.active_stages = []
+
+  def as_dict(self, elapsed_time):
+    """Picklable summary, with elapsed_time minus the stage times as 'other'."""
+    stages = dict(self.stages)
+    stages['other'] = max(elapsed_time - sum(stages.values()), 0.0)
+    return {
+        'elapsed': elapsed_time,
+        'stages': stages,
+        'bytes_read': self.bytes_read,
+        'bytes_written': self.bytes_written,
+        'peak_rss': get_peak_rss(),
+    }
+
+# current is set while a file is being profiled in this thread
+_thread_state = threading.local()
+
+def get_current():
+  return getattr(_thread_state, 'current', None)
+
+def start_file():
+  _thread_state.current = FileProfile()
+  return _thread_state.current
+
+def finish_file(elapsed_time):
+  file_profile = get_current()
+  _thread_state.current = None
+  return file_profile.as_dict(elapsed_time)
+
+@contextlib.contextmanager
+def activate(file_profile):
+  """Profile into file_profile in this thread for the duration, e.g. for one stage of a pipelined file."""
+  previous = get_current()
+  _thread_state.current = file_profile
+  try:
+    yield file_profile
+  finally:
+    _thread_state.current = previous
+
+@contextlib.contextmanager
+def stage(name):
+  file_profile = get_current()
+  if file_profile is None:
+    yield
+    return
+
+  file_profile.active_stages.append(name)
+  start_time = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed_time = time.perf_counter() - start_time
+    file_profile.active_stages.pop()
+    file_profile.stages[name] = file_profile.stages.get(name, 0.0) + elapsed_time
+    # Exclusive times, the enclosing stage doesn't get this one's time as well
+    if file_profile.active_stages:
+      parent_name = file_profile.active_stages[-1]
+      file_profile.stages[parent_name] = file_profile.stages.get(parent_name, 0.0) - elapsed_time
+
+def add_bytes_read(byte_count):
+  file_profile = get_current()
+  if file_profile is not None:
+    file_profile.bytes_read += byte_count
+
+def add_bytes_written(filename):
+  """Count the size of an output file once it has been written."""
+  file_profile = get_current()
+  if file_profile is not None:
+    file_profile.bytes_written += os.path.getsize(filename)
+
+def get_peak_rss():
+  """Peak resident set size of this process so far in bytes, or None where it isn't available."""
+  if resource is None:
+    return None
+  # Linux reports kilobytes (macOS bytes, but that's not a platform libraw builds are usually tuned on)
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class BatchProfile:
+  """Collects the per file profiles of a batch (in the parent process) and reports totals and percentiles."""
+
+  def __init__(self):
+    self.files = []
+    self.start_time = time.perf_counter()
+
+  def add(self, raw_filename, file_profile):
+    self.files.append(dict(file_profile, filename=raw_filename))
+
+  def summary(self):
+    wall_time = time.perf_counter() - self.start_time
+    elapsed_times = [file_profile['elapsed'] for file_profile in self.files]
+
+    stages = {}
+    for name in STAGES + ['elapsed']:
+      if name == 'elapsed':
+        times = np.array(elapsed_times)
+      else:
+        times = np.array([file_profile['stages'].get(name, 0.0) for file_profile in self.files])
+      if not times.size or not times.any():
+        continue
+      stage_summary = {'total': float(times.sum()), 'mean': float(times.mean())}
+      for q in PERCENTILES:
+        stage_summary['p{}'.format(q)] = float(np.percentile(times, q))
+      stage_summary['max'] = float(times.max())
+      stages[name] = stage_summary
+
+    peak_rss = [file_profile['peak_rss'] for file_profile in self.files if file_profile['peak_rss'] is not None]
+    bytes_read = sum(file_profile['bytes_read'] for file_profile in self.files)
+    bytes_written = sum(file_profile['bytes_written'] for file_profile in self.files)
+    return {
+        'files': len(self.files),
+        'wall_time': wall_time,
+        'bytes_read': bytes_read,
+        'bytes_written': bytes_written,
+        'read_mb_per_s': bytes_read / max(wall_time, 1e-9) / 1e6,
+        'written_mb_per_s': bytes_written / max(wall_time, 1e-9) / 1e6,
+        'peak_rss': max(peak_rss) if peak_rss else None,
+        'stages': stages,
+    }
+
+  def print_summary(self, summary):
+    print("{:<10} {:>9} {:>9} {:>9} {:>9} {:>9} {:>6}".format('stage', 'total [s]', 'p50 [s]', 'p90 [s]', 'p99 [s]', 'max [s]', 'share'))
+    total_time = sum(stage_summary['total'] for name, stage_summary in summary['stages'].items() if name != 'elapsed')
+    for name, stage_summary in summary['stages'].items():
+      print("{:<10} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>6}".format(
+          name,
+          stage_summary['total'],
+          stage_summary['p50'],
+          stage_summary['p90'],
+          stage_summary['p99'],
+          stage_summary['max'],
+          '' if name == 'elapsed' else '{:.0%}'.format(stage_summary['total'] / max(total_time, 1e-9))
+      ))
+    print("Read {:.1f} MB ({:.1f} MB/s), wrote {:.1f} MB ({:.1f} MB/s), peak RSS {}".format(
+        summary['bytes_read'] / 1e6,
+        summary['read_mb_per_s'],
+        summary['bytes_written'] / 1e6,
+        summary['written_mb_per_s'],
+        '{:.0f} MB'.format(summary['peak_rss'] / 1e6) if summary['peak_rss'] is not None else 'n/a'
+    ))
+
+  def write(self, profile_filename):
+    """
+      Print the summary and write it to profile_filename: JSON (summary plus every file's stages) for a .json
+      filename, otherwise CSV with one row per stage.
+    """
+    summary = self.summary()
+    self.print_summary(summary)
+
+    if profile_filename.endswith('.json'):
+      with open(profile_filename, 'w') as profile_file:
+        json.dump({'summary': summary, 'files': self.files}, profile_file, indent=2)
+    else:
+      columns = ['total', 'mean'] + ['p{}'.format(q) for q in PERCENTILES] + ['max']
+      with open(profile_filename, 'w', newline='') as profile_file:
+        writer = csv.writer(profile_file)
+        writer.writerow(['stage'] + columns)
+        for name, stage_summary in summary['stages'].items():
+          writer.writerow([name] + [stage_summary[column] for column in columns])
+        # Batch totals as extra rows, so the file stays a single table
+        for name in ('files', 'wall_time', 'bytes_read', 'bytes_written', 'peak_rss'):
+          writer.writerow([name, summary[name]] + [''] * (len(columns) - 1))
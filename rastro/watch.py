@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""
+rastro.watch: convert and check RAW files as they are written to a directory, e.g. by tethered capture.
+
+An asyncio loop polls the directory and treats a file as finished once its size and mtime have stopped
+changing for settle_time seconds.  Finished files go through a bounded queue to a pool of workers (the same
+batch.process_file() the batch commands use), so when conversion falls behind the scanner simply waits instead
+of piling up work.  Each frame gets quick stats and a latency report: how long after the camera finished
+writing it the output was ready.
+"""
+
+import asyncio
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import basename
+
+from rastro import batch, profiling
+from rastro.catalog import RAW_EXTENSIONS
+
+def quick_stats(raw_frame):
+  """Median, max and saturated pixel count per color plane, from one pass over the sensor data."""
+  from rastro.analyze import stats
+
+  raw_image_visible = raw_frame.raw_image_visible
+  with profiling.stage('analysis'):
+    histograms = stats.color_plane_histograms(raw_image_visible, raw_frame.raw_pattern, raw_frame.color_plane_map)
+  white_level = raw_frame.raw_info['white_level']
+
+  plane_stats = {}
+  for color_plane_name in raw_frame.color_plane_map:
+    hist = histograms[color_plane_name]
+    plane_stats[color_plane_name] = {
+        'median': stats.histogram_percentile(hist, 50),
+        'max': int(hist.nonzero()[0][-1]),
+        'saturated': int(hist[white_level:].sum()),
+    }
+  return plane_stats
+
+def ingest_frame(raw_frame, writer=None, writer_args=(), writer_kwargs=None):
+  """
+    batch.process_file() task, quick stats of the untouched sensor data and then (optionally) writer, which
+    may calibrate the planes in place.
+  """
+  plane_stats = quick_stats(raw_frame)
+  if writer is not None:
+    writer(raw_frame, *writer_args, **(writer_kwargs or {}))
+  return plane_stats
+
+def report_frame(done_count, raw_filename, latency, wait_time, elapsed_time, plane_stats):
+  print("[{}] {} ready {:.2f}s after capture (queued {:.2f}s, processing {:.2f}s) | {}".format(
+      done_count,
+      basename(raw_filename),
+      latency,
+      wait_time,
+      elapsed_time,
+      '  '.join(
+          "{} med {:.0f} max {} sat {}".format(color_plane_name, values['median'], values['max'], values['saturated'])
+          for color_plane_name, values in plane_stats.items()
+      )
+  ))
+  sys.stdout.flush()
+
+def list_raw_files(directory):
+  try:
+    entries = list(os.scandir(directory))
+  except OSError:
+    return {}
+
+  raw_files = {}
+  for entry in entries:
+    if entry.is_file() and os.path.splitext(entry.name)[1].lower() in RAW_EXTENSIONS:
+      try:
+        stat = entry.stat()
+      except OSError:
+        # Deleted or renamed since the scandir()
+        continue
+      raw_files[entry.path] = (stat.st_size, stat.st_mtime)
+  return raw_files
+
+async def scan_directory(directory, queue, poll_interval, settle_time, process_existing, idle_timeout):
+  """Put (raw_filename, time seen finished) on queue for every RAW file once it stops changing."""
+  seen = set() if process_existing else set(list_raw_files(directory))
+  # raw_filename: ((size, mtime), when that size and mtime were first seen)
+  changing = {}
+  last_activity = time.time()
+
+  while True:
+    now = time.time()
+    for raw_filename, size_mtime in list_raw_files(directory).items():
+      if raw_filename in seen:
+        continue
+
+      last_activity = now
+      previous = changing.get(raw_filename)
+      if previous is None or previous[0] != size_mtime:
+        changing[raw_filename] = (size_mtime, now)
+      elif now - previous[1] >= settle_time and size_mtime[0] > 0:
+        seen.add(raw_filename)
+        del changing[raw_filename]
+        # Blocks while the workers are behind, which is the backpressure
+        await queue.put((raw_filename, time.time()))
+
+    if idle_timeout is not None and not changing and queue.empty() and now - last_activity >= idle_timeout:
+      return
+
+    await asyncio.sleep(poll_interval)
+
+async def process_frames(queue, executor, task_args, cache, profiler, roi, results, failed):
+  loop = asyncio.get_running_loop()
+  while True:
+    raw_filename, queued_time = await queue.get()
+    try:
+      elapsed_time, plane_stats, file_profile = await loop.run_in_executor(
+          executor,
+          batch.process_file,
+          ingest_frame,
+          raw_filename,
+          task_args,
+          None,
+          cache,
+          profiler is not None,
+          roi
+      )
+    except Exception as error:
+      failed.append((raw_filename, error))
+      print("[{}] {} FAILED: {}".format(len(results) + len(failed), basename(raw_filename), error), file=sys.stderr)
+    else:
+      done_time = time.time()
+      try:
+        latency = done_time - os.stat(raw_filename).st_mtime
+      except OSError:
+        latency = float('nan')
+      results.append(latency)
+      if profiler is not None:
+        profiler.add(raw_filename, file_profile)
+      report_frame(len(results) + len(failed), raw_filename, latency, done_time - elapsed_time - queued_time,
+                   elapsed_time, plane_stats)
+    finally:
+      queue.task_done()
+
+async def watch_loop(directory, task_args, jobs, poll_interval, settle_time, process_existing, idle_timeout, cache,
+                     profiler, roi, results, failed):
+  if jobs <= 1:
+    # A single worker thread keeps the event loop (and so the directory scan) responsive
+    executor = ThreadPoolExecutor(max_workers=1)
+  else:
+    executor = batch.process_pool(jobs)
+
+  # One frame waiting per worker is plenty, anything more just adds latency
+  queue = asyncio.Queue(maxsize=max(jobs, 1))
+  workers = [
+      asyncio.ensure_future(process_frames(queue, executor, task_args, cache, profiler, roi, results, failed))
+      for _ in range(max(jobs, 1))
+  ]
+  try:
+    await scan_directory(directory, queue, poll_interval, settle_time, process_existing, idle_timeout)
+    await queue.join()
+  finally:
+    for worker in workers:
+      worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    executor.shutdown(wait=True)
+
+def watch(directory, task=None, task_args=(), task_kwargs=None, jobs=1, poll_interval=0.5, settle_time=1.0,
+          process_existing=False, idle_timeout=None, cache=None, profiler=None, roi=None):
+  """
+    Run task(raw_frame, *task_args, **task_kwargs) (any batch.run() task, e.g. a writer) plus quick stats on
+    every RAW file written to directory, until interrupted or idle_timeout seconds pass without a new file.
+    Returns the list of (raw_filename, error) for the files that failed.  profiler is an optional
+    rastro.profiling.BatchProfile, written by the caller once watching stops.  roi is an optional region of
+    interest (x0, y0, width, height) to crop every frame to.
+  """
+  if jobs == 0:
+    jobs = os.cpu_count() or 1
+  if not os.path.isdir(directory):
+    raise ValueError("Not a directory [{}]".format(directory))
+
+  print("Watching {} (Ctrl-C to stop)".format(directory))
+  # Latency of every processed frame, filled in as they finish so an interrupt still gets a summary
+  results = []
+  failed = []
+  try:
+    asyncio.run(watch_loop(
+        directory,
+        (task, task_args, task_kwargs),
+        jobs,
+        poll_interval,
+        settle_time,
+        process_existing,
+        idle_timeout,
+        cache,
+        profiler,
+        roi,
+        results,
+        failed
+    ))
+  except KeyboardInterrupt:
+    print("Stopped")
+
+  if results:
+    print("Processed {} frames, {} failed, latency median {:.2f}s max {:.2f}s".format(
+        len(results), len(failed), statistics.median(results), max(results)))
+
+  return failed
@@ -28,8 +28,16 @@ setup(
   author_email = "sanelson@siliconfuture.net",
   url = "https://github.com/sanelson/rastro",
   install_requires=[
-      'numpy', 'tiffile', 'matplotlib', 'rawpy', 'numba', 'astropy', 'py3exiv2', 'scikit-image'
+      'numpy', 'tiffile', 'matplotlib', 'rawpy', 'numba', 'astropy', 'py3exiv2', 'scikit-image', 'Pillow'
   ],
+  extras_require={
+      # analyze stats --summary to .parquet files
+      'parquet': ['pyarrow'],
+      # convert tiff --codec lzw / zstd
+      'tiff': ['imagecodecs'],
+      # convert archive --codec zstd
+      'archive': ['zstandard'],
+  },
   classifiers=[
       "Programming Language :: Python :: 3",
       "Development Status :: 3 - Alpha",
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shared fixtures: synthetic 14 bit Bayer frames and a RawFrame over them, so no camera files are needed.
+
+py3exiv2 needs the exiv2 C++ library and is often missing from test environments.  The modules under test only
+import it (EXIF is never read from a synthetic frame), so a bare stand in is registered when it isn't installed.
+"""
+
+import sys
+import types
+
+import numpy as np
+import pytest
+
+try:
+  import pyexiv2
+except ImportError:
+  class ExifValueError(Exception):
+    pass
+
+  pyexiv2 = types.ModuleType('pyexiv2')
+  pyexiv2.exif = types.ModuleType('pyexiv2.exif')
+  pyexiv2.exif.ExifTag = object
+  pyexiv2.exif.ExifValueError = ExifValueError
+  sys.modules['pyexiv2'] = pyexiv2
+  sys.modules['pyexiv2.exif'] = pyexiv2.exif
+
+from rastro.extract import raw
+
+WHITE_LEVEL = 2**14 - 1
+
+class FakeRawPy:
+  """Just the rawpy.RawPy attributes rastro reads, for an already decoded Canon style RGBG frame."""
+
+  def __init__(self, raw_image_visible):
+    self.raw_image_visible = raw_image_visible
+    self.raw_pattern = np.array([[0, 1], [3, 2]], dtype=np.uint8)
+    self.color_desc = b'RGBG'
+    self.num_colors = 3
+    self.black_level_per_channel = [2048, 2048, 2048, 2048]
+    self.white_level = WHITE_LEVEL
+    self.camera_whitebalance = [2.0, 1.0, 1.5, 1.0]
+    self.daylight_whitebalance = [2.1, 0.9, 1.2, 0.0]
+    self.raw_type = 'RawType.Flat'
+    self.sizes = 'ImageSizes(height={}, width={})'.format(*raw_image_visible.shape)
+
+  def close(self):
+    pass
+
+class SyntheticRawFrame(raw.RawFrame):
+  """RawFrame whose rawpy object is a FakeRawPy, everything downstream of the decode runs the real code."""
+
+  def __init__(self, raw_image_visible, filename='synthetic.cr2', roi=None):
+    super().__init__(filename, roi=roi)
+    self._rawimage = FakeRawPy(raw_image_visible)
+
+def synthetic_cfa(rows, cols, seed=0):
+  """A sky-like 14 bit CFA frame: bias, a gradient, read noise and a few bright pixels."""
+  rng = np.random.default_rng(seed)
+  cfa = rng.integers(-24, 25, size=(rows, cols), dtype=np.int32)
+  cfa += 2048 + (np.arange(cols, dtype=np.int32) * 200 // cols)[np.newaxis, :]
+  star_count = max(rows * cols // 500, 1)
+  cfa[rng.integers(0, rows, star_count), rng.integers(0, cols, star_count)] += rng.integers(500, WHITE_LEVEL, star_count)
+  return np.clip(cfa, 0, WHITE_LEVEL).astype(np.uint16)
+
+@pytest.fixture
+def cfa():
+  return synthetic_cfa(60, 80)
+
+@pytest.fixture
+def raw_frame(cfa):
+  with SyntheticRawFrame(cfa) as frame:
+    yield frame
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+import numpy as np
+import pytest
+
+from rastro.extract import archive
+
+@pytest.mark.parametrize('bit_depth', [1, 7, 12, 14, 16])
+def test_pack_bits_round_trip(bit_depth):
+  rng = np.random.default_rng(bit_depth)
+  # An odd count, so the last value ends part way through a byte
+  values = rng.integers(0, 2**bit_depth, size=1001).astype(np.uint16)
+  packed = np.empty(archive.packed_size(values.size, bit_depth), dtype=np.uint8)
+  archive.pack_bits(values, bit_depth, packed)
+  unpacked = np.empty_like(values)
+  archive.unpack_bits(packed, bit_depth, unpacked)
+  np.testing.assert_array_equal(unpacked, values)
+
+def test_archive_round_trip(tmp_path, raw_frame):
+  archive_filename = str(tmp_path / 'frame.rcfa')
+  date_time = datetime.datetime(2020, 3, 10, 21, 0, 0)
+  exif = {
+      'Exif.Image.Model': archive.encode_exif_value('Synthetic'),
+      'Exif.Image.DateTime': archive.encode_exif_value(date_time),
+  }
+  # A tile size that doesn't divide the 30 x 40 planes
+  header = archive.write_archive(archive_filename, raw_frame.raw_image_visible, raw_frame.raw_info, exif,
+                                 codec='zlib', tile=16, source=raw_frame.filename)
+  assert header['codec'] == 'zlib'
+  assert header['bit_depth'] == archive.get_bit_depth(raw_frame.raw_image_visible)
+
+  with archive.ArchiveReader(archive_filename) as archive_reader:
+    np.testing.assert_array_equal(archive_reader.read_cfa(), raw_frame.raw_image_visible)
+    np.testing.assert_array_equal(archive_reader.read_cfa((2, 4, 20, 12)), raw_frame.raw_image_visible[4:16, 2:22])
+    np.testing.assert_array_equal(
+        archive_reader.read_plane('G2', slice(5, 25), slice(10, 33)),
+        raw_frame.color_planes['G2']['2D'][5:25, 10:33]
+    )
+    assert archive_reader.raw_info == raw_frame.raw_info
+    assert archive_reader.metadata['Exif.Image.Model'].value == 'Synthetic'
+    assert archive_reader.metadata['Exif.Image.DateTime'].value == date_time
+
+def test_archive_reader_rejects_other_files(tmp_path):
+  not_an_archive = tmp_path / 'frame.cr2'
+  not_an_archive.write_bytes(b'II*\x00' + bytes(100))
+  with pytest.raises(ValueError):
+    archive.ArchiveReader(str(not_an_archive))
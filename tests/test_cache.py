@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+
+from rastro.extract import cache
+
+def entry_bytes(plane_cache, key):
+  return sum(os.path.getsize(filename) for filename in plane_cache.get_filenames(key))
+
+def test_cache_key_follows_the_file_contents():
+  assert cache.get_cache_key(b'frame one') == cache.get_cache_key(b'frame one')
+  assert cache.get_cache_key(b'frame one') != cache.get_cache_key(b'frame two')
+
+def test_store_and_load(tmp_path, raw_frame):
+  plane_cache = cache.PlaneCache(str(tmp_path), 2**30)
+  key = plane_cache.get_key(b'frame one')
+  assert plane_cache.load(key) is None
+
+  plane_cache.store(key, raw_frame.raw_image_visible, raw_frame.raw_info)
+  raw_image_visible, raw_info = plane_cache.load(key)
+  assert isinstance(raw_image_visible, np.memmap)
+  np.testing.assert_array_equal(raw_image_visible, raw_frame.raw_image_visible)
+  assert raw_info == raw_frame.raw_info
+
+def test_least_recently_used_entries_are_evicted(tmp_path, raw_frame):
+  plane_cache = cache.PlaneCache(str(tmp_path), 2**30)
+  keys = [plane_cache.get_key(contents) for contents in (b'frame one', b'frame two', b'frame three')]
+  for age, key in zip((300, 200, 100), keys):
+    plane_cache.store(key, raw_frame.raw_image_visible, raw_frame.raw_info)
+    for filename in plane_cache.get_filenames(key):
+      os.utime(filename, (os.path.getmtime(filename) - age,) * 2)
+
+  # Using the oldest entry makes the second one the least recently used
+  assert plane_cache.load(keys[0]) is not None
+  plane_cache.max_bytes = entry_bytes(plane_cache, keys[0]) * 2
+  plane_cache.evict()
+
+  assert plane_cache.load(keys[1]) is None
+  assert plane_cache.load(keys[0]) is not None
+  assert plane_cache.load(keys[2]) is not None
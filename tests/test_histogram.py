@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from rastro.analyze import histogram
+
+@pytest.fixture
+def values():
+  rng = np.random.default_rng(2)
+  return rng.integers(0, 2**12, size=50000)
+
+@pytest.mark.parametrize('bins, range_min, range_max', [(50, 100, 3000), (7, 0, 4095), (256, 1000, 1999)])
+def test_rebin_histogram_matches_numpy(values, bins, range_min, range_max):
+  hist = np.bincount(values, minlength=2**12)
+  rebinned_hist, bin_edges = histogram.rebin_histogram(hist, bins, range_min, range_max)
+  expected_hist, expected_edges = np.histogram(values, bins=bins, range=(range_min, range_max))
+  np.testing.assert_array_equal(rebinned_hist, expected_hist)
+  np.testing.assert_allclose(bin_edges, expected_edges)
+
+def test_rebin_histogram_uses_one_bin_per_adu_for_narrow_ranges(values):
+  hist = np.bincount(values, minlength=2**12)
+  rebinned_hist, bin_edges = histogram.rebin_histogram(hist, 100, 10, 19)
+  assert len(rebinned_hist) == 10
+  np.testing.assert_array_equal(rebinned_hist, hist[10:20])
+
+@pytest.mark.parametrize('bins, range_min, range_max', [(10, -1, 100), (10, 200, 100), (10, 0, 4096), (0, 0, 100)])
+def test_rebin_histogram_rejects_bad_ranges(bins, range_min, range_max):
+  with pytest.raises(ValueError):
+    histogram.rebin_histogram(np.zeros(4096, dtype=np.int64), bins, range_min, range_max)
+
+def test_merge_histograms():
+  merged = histogram.merge_histograms({}, {'R': np.array([1, 2], dtype=np.uint32)})
+  histogram.merge_histograms(merged, {'R': np.array([3, 4], dtype=np.uint32), 'B': np.array([5, 6])})
+  assert merged['R'].dtype == np.int64
+  np.testing.assert_array_equal(merged['R'], [4, 6])
+  np.testing.assert_array_equal(merged['B'], [5, 6])
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from rastro.calibrate import master
+
+def write_master(prefix, planes):
+  """Master FITS files as written by rastro stack, <prefix>.<color plane>.fits"""
+  for color_plane_name, plane in planes.items():
+    fits.PrimaryHDU(plane.astype(np.float32)).writeto('{}.{}.fits'.format(prefix, color_plane_name))
+
+def prepare_dark(tmp_path, raw_frame, value):
+  shape = raw_frame.color_planes['R']['2D'].shape
+  write_master(str(tmp_path / 'dark'), dict((name, np.full(shape, value)) for name in raw_frame.color_planes))
+  calibration_dir = tmp_path / 'calibration'
+  calibration_dir.mkdir()
+  master.prepare_masters(str(calibration_dir), dark_prefix=str(tmp_path / 'dark'))
+  return str(calibration_dir)
+
+def test_dark_subtraction_clips_without_a_pedestal(tmp_path, raw_frame):
+  calibration_dir = prepare_dark(tmp_path, raw_frame, 2048.0)
+  raw_image_visible = raw_frame.raw_image_visible.copy()
+  color_plane = raw_frame.color_planes['R']['2D'].astype(np.int64)
+
+  history = master.calibrate_color_planes(raw_frame.color_planes, calibration_dir, 'uint16')
+  assert history == ['Dark subtracted: ' + str(tmp_path / 'dark')]
+  calibrated = raw_frame.color_planes['R']['2D']
+  assert calibrated.dtype == np.uint16
+  np.testing.assert_array_equal(calibrated, np.clip(color_plane - 2048, 0, None))
+  # The sensor data the planes were sliced from is left alone
+  np.testing.assert_array_equal(raw_frame.raw_image_visible, raw_image_visible)
+
+def test_pedestal_keeps_the_negative_noise(tmp_path, raw_frame):
+  calibration_dir = prepare_dark(tmp_path, raw_frame, 2048.0)
+  color_plane = raw_frame.color_planes['G1']['2D'].astype(np.int64)
+
+  history = master.calibrate_color_planes(raw_frame.color_planes, calibration_dir, 'uint16', pedestal=100)
+  assert history[-1] == 'Pedestal added: 100 ADU'
+  np.testing.assert_array_equal(raw_frame.color_planes['G1']['2D'], color_plane - 2048 + 100)
+
+def test_integer_output_is_clipped_to_the_output_dtype(tmp_path, raw_frame):
+  calibration_dir = prepare_dark(tmp_path, raw_frame, 0.0)
+  master.calibrate_color_planes(raw_frame.color_planes, calibration_dir, 'uint8')
+  assert raw_frame.color_planes['B']['2D'].max() == 255
+
+def test_float_output_is_neither_offset_nor_clipped(tmp_path, raw_frame):
+  calibration_dir = prepare_dark(tmp_path, raw_frame, 2048.0)
+  color_plane = raw_frame.color_planes['G2']['2D'].astype(np.float32)
+
+  history = master.calibrate_color_planes(raw_frame.color_planes, calibration_dir, 'float32', pedestal=100)
+  assert not any(line.startswith('Pedestal') for line in history)
+  calibrated = raw_frame.color_planes['G2']['2D']
+  assert calibrated.dtype == np.float32
+  assert calibrated.min() < 0
+  np.testing.assert_array_equal(calibrated, color_plane - 2048)
+
+def test_flat_is_normalized_to_its_median(tmp_path, raw_frame):
+  shape = raw_frame.color_planes['R']['2D'].shape
+  flat = np.full(shape, 2000.0)
+  flat[0, 0] = 1000.0
+  write_master(str(tmp_path / 'flat'), dict((name, flat) for name in raw_frame.color_planes))
+  calibration_dir = str(tmp_path)
+  master.prepare_masters(calibration_dir, flat_prefix=str(tmp_path / 'flat'))
+  color_plane = raw_frame.color_planes['R']['2D'].astype(np.float32)
+
+  master.calibrate_color_planes(raw_frame.color_planes, calibration_dir, 'float32')
+  calibrated = raw_frame.color_planes['R']['2D']
+  assert calibrated[0, 0] == color_plane[0, 0] * 2
+  np.testing.assert_array_equal(calibrated[1:], color_plane[1:])
+
+def test_region_of_interest_uses_the_same_window_of_the_masters(tmp_path, raw_frame, cfa):
+  from conftest import SyntheticRawFrame
+
+  shape = raw_frame.color_planes['R']['2D'].shape
+  dark = np.arange(shape[0] * shape[1], dtype=np.float32).reshape(shape)
+  write_master(str(tmp_path / 'dark'), dict((name, dark) for name in raw_frame.color_planes))
+  calibration_dir = str(tmp_path)
+  master.prepare_masters(calibration_dir, dark_prefix=str(tmp_path / 'dark'))
+
+  master.calibrate_color_planes(raw_frame.color_planes, calibration_dir, 'float32')
+  full_frame = raw_frame.color_planes['B']['2D'].copy()
+  with SyntheticRawFrame(cfa, roi=(10, 6, 20, 14)) as roi_frame:
+    master.calibrate_color_planes(roi_frame.color_planes, calibration_dir, 'float32', roi=roi_frame.roi)
+    np.testing.assert_array_equal(roi_frame.color_planes['B']['2D'], full_frame[3:10, 5:15])
+
+def test_mismatched_masters_are_rejected(tmp_path, raw_frame):
+  write_master(str(tmp_path / 'dark'), dict((name, np.zeros((4, 4))) for name in raw_frame.color_planes))
+  master.prepare_masters(str(tmp_path), dark_prefix=str(tmp_path / 'dark'))
+  with pytest.raises(ValueError):
+    master.calibrate_color_planes(raw_frame.color_planes, str(tmp_path), 'uint16')
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from rastro.extract import planes
+
+def block_sums(color_plane, factor):
+  rows, cols = color_plane.shape[0] // factor, color_plane.shape[1] // factor
+  blocks = color_plane[:rows * factor, :cols * factor].astype(np.int64).reshape(rows, factor, cols, factor)
+  return blocks.sum(axis=(1, 3))
+
+@pytest.mark.parametrize('factor', [1, 3, 4, 7])
+def test_block_average_rgb_matches_numpy(raw_frame, factor):
+  color_planes = raw_frame.color_planes
+  rgb = planes.block_average_rgb(color_planes, factor)
+
+  # Floor of the block means, trailing rows and columns that don't fill a block are left out
+  count = factor * factor
+  red, green1, green2, blue = (block_sums(color_planes[name]['2D'], factor) for name in ('R', 'G1', 'G2', 'B'))
+  assert rgb.shape == red.shape + (3,)
+  assert rgb.dtype == color_planes['R']['2D'].dtype
+  np.testing.assert_array_equal(rgb[..., 0], red // count)
+  np.testing.assert_array_equal(rgb[..., 1], (green1 + green2) // (2 * count))
+  np.testing.assert_array_equal(rgb[..., 2], blue // count)
+
+def test_block_average_rgb_needs_integer_planes(raw_frame):
+  color_planes = dict((name, {'2D': plane['2D'].astype(np.float32)}) for name, plane in raw_frame.color_planes.items())
+  with pytest.raises(ValueError):
+    planes.block_average_rgb(color_planes, 2)
+
+def test_interleave_rgb_averages_the_greens(raw_frame):
+  color_planes = raw_frame.color_planes
+  out = np.empty(color_planes['R']['2D'].shape + (3,), dtype=np.uint16)
+  planes.interleave_rgb(color_planes, out)
+  np.testing.assert_array_equal(out[..., 0], color_planes['R']['2D'])
+  np.testing.assert_array_equal(
+      out[..., 1], (color_planes['G1']['2D'].astype(np.int64) + color_planes['G2']['2D']) // 2)
+  np.testing.assert_array_equal(out[..., 2], color_planes['B']['2D'])
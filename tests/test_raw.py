@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from rastro.extract import raw
+
+from conftest import SyntheticRawFrame, synthetic_cfa
+
+def test_color_plane_map_numbers_the_greens():
+  assert raw.get_color_plane_map(4, b'RGBG') == ['R', 'G1', 'B', 'G2']
+
+def test_color_plane_offsets():
+  # Canon style R G / G B, with the second green (index 3) on the second row
+  assert raw.get_color_plane_offsets([[0, 1], [3, 2]]) == [(0, 0), (0, 1), (1, 1), (1, 0)]
+  assert raw.get_color_plane_offsets([[1, 2], [0, 3]]) == [(1, 0), (0, 0), (0, 1), (1, 1)]
+
+@pytest.mark.parametrize('raw_pattern', [
+    [[0, 1, 2], [3, 0, 1]],
+    [[0, 1], [1, 2]],
+    [[0, 1], [4, 2]],
+])
+def test_color_plane_offsets_reject_unsupported_patterns(raw_pattern):
+  with pytest.raises(ValueError):
+    raw.get_color_plane_offsets(raw_pattern)
+
+@pytest.mark.parametrize('roi, shape, aligned', [
+    ((0, 0, 10, 10), (100, 100), (0, 0, 10, 10)),
+    # The origin moves down and the far edge up to even coordinates, so the region only grows
+    ((3, 5, 10, 10), (100, 100), (2, 4, 12, 12)),
+    # Clipped to the image, whose odd trailing row and column don't count
+    ((90, 90, 50, 50), (100, 100), (90, 90, 10, 10)),
+    ((90, 90, 50, 50), (101, 101), (90, 90, 10, 10)),
+])
+def test_align_roi(roi, shape, aligned):
+  assert raw.align_roi(roi, shape) == aligned
+
+@pytest.mark.parametrize('roi', [(0, 0, 0, 10), (0, 0, 10, -1), (-2, 0, 10, 10), (100, 0, 10, 10)])
+def test_align_roi_rejects_empty_regions(roi):
+  with pytest.raises(ValueError):
+    raw.align_roi(roi, (100, 100))
+
+def test_crop_roi_is_a_view(cfa):
+  cropped = raw.crop_roi(cfa, (2, 4, 12, 6))
+  assert cropped.shape == (6, 12)
+  assert np.shares_memory(cropped, cfa)
+  np.testing.assert_array_equal(cropped, cfa[4:10, 2:14])
+
+def test_extract_color_planes():
+  cfa = synthetic_cfa(7, 9)
+  color_planes = raw.extract_color_planes(cfa, [[0, 1], [3, 2]], ['R', 'G1', 'B', 'G2'])
+
+  # The odd trailing row and column are dropped so every plane has the same shape
+  for color_plane_name, (row_offset, col_offset) in [('R', (0, 0)), ('G1', (0, 1)), ('B', (1, 1)), ('G2', (1, 0))]:
+    color_plane = color_planes[color_plane_name]['2D']
+    assert color_plane.shape == (3, 4)
+    assert np.shares_memory(color_plane, cfa)
+    np.testing.assert_array_equal(color_plane, cfa[row_offset:6:2, col_offset:8:2])
+
+  copied_planes = raw.extract_color_planes(cfa, [[0, 1], [3, 2]], ['R', 'G1', 'B', 'G2'], copy=True)
+  assert not np.shares_memory(copied_planes['R']['2D'], cfa)
+  np.testing.assert_array_equal(copied_planes['R']['2D'], color_planes['R']['2D'])
+
+def test_raw_frame_region_of_interest(cfa):
+  with SyntheticRawFrame(cfa, roi=(3, 5, 10, 10)) as raw_frame:
+    np.testing.assert_array_equal(raw_frame.raw_image_visible, cfa[4:16, 2:14])
+    assert raw_frame.roi == (2, 4, 12, 12)
+    np.testing.assert_array_equal(raw_frame.color_planes['R']['2D'], cfa[4:16:2, 2:14:2])
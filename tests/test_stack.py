@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+from astropy.stats import sigma_clip
+
+from rastro.calibrate import stack
+
+def test_combine_mean_and_median():
+  band = np.array([1, 2, 3, 10], dtype=np.uint16).reshape(4, 1, 1)
+  mean = stack.combine(band, 'mean')
+  median = stack.combine(band, 'median')
+  assert mean.dtype == np.float32 and median.dtype == np.float32
+  assert mean[0, 0] == 4.0
+  assert median[0, 0] == 2.5
+
+def test_combine_rejects_unknown_methods():
+  with pytest.raises(ValueError):
+    stack.combine(np.zeros((2, 1, 1), dtype=np.uint16), 'mode')
+
+def test_sigma_clipped_mean_matches_astropy():
+  rng = np.random.default_rng(1)
+  band = rng.normal(2048, 10, size=(15, 20, 30))
+  # A cosmic ray in one frame of 60 different pixels
+  rows, cols = np.unravel_index(rng.choice(20 * 30, 60, replace=False), (20, 30))
+  band[rng.integers(0, 15, 60), rows, cols] += 3000
+  band = np.rint(band).astype(np.uint16)
+
+  expected = sigma_clip(band.astype(np.float64), sigma=3.0, maxiters=5, axis=0).mean(axis=0)
+  combined = stack.combine(band, 'sigma_clip', sigma=3.0, iterations=5)
+  np.testing.assert_allclose(combined, expected.filled(np.nan), rtol=1e-6)
+  assert combined.max() < 2200
+
+def test_sigma_clipped_mean_never_empties_a_pixel():
+  # Both frames are exactly one standard deviation from their median, so sigma < 1 clips both of them
+  band = np.array([100, 110], dtype=np.uint16).reshape(2, 1, 1)
+  combined = stack.combine(band, 'sigma_clip', sigma=0.5, iterations=5)
+  assert combined[0, 0] == 105.0
+
+def test_band_rows_fit_the_memory_limit():
+  frame_count, color_plane_count, cols = 20, 4, 3000
+  for method, (per_value, per_pixel) in stack.BAND_BYTES_PER_ELEMENT.items():
+    memory_limit = 256 * 1024 * 1024
+    band_rows = stack.get_band_rows(frame_count, color_plane_count, cols, memory_limit, method)
+    assert band_rows >= 1
+    assert band_rows * color_plane_count * cols * (frame_count * per_value + per_pixel) <= memory_limit
+
+@pytest.mark.parametrize('raw_filenames, sigma', [([], 3.0), (['a.cr2', 'b.cr2'], 0.0)])
+def test_stack_rejects_bad_input_up_front(tmp_path, raw_filenames, sigma):
+  with pytest.raises(ValueError):
+    stack.stack(raw_filenames, str(tmp_path / 'master'), 'dark', 'sigma_clip', 'rastro stack', '0', sigma=sigma)